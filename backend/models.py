@@ -4,6 +4,15 @@ from datetime import datetime, timezone
 from decimal import Decimal
 import uuid
 
+def currency_code(value):
+    # Blank CSV cells mean the base currency
+    if value is None or not str(value).strip():
+        return None
+    code = str(value).strip().upper()
+    if len(code) != 3 or not code.isalpha():
+        raise ValueError("Currency must be a 3-letter ISO 4217 code")
+    return code
+
 class UserBase(BaseModel):
     email: EmailStr
     full_name: str
@@ -49,10 +58,17 @@ class TransactionCreate(BaseModel):
     quantity: int
     unit_price: Decimal
     transaction_date: datetime
+    sales_channel: Optional[str] = None
+    customer_segment: Optional[str] = None
+    currency: Optional[str] = None
+
+    _currency = validator('currency', pre=True, allow_reuse=True)(currency_code)
 
 class Transaction(TransactionCreate):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     total_amount: Decimal = Decimal("0")
+    base_amount: Optional[Decimal] = None
+    fx_rate: Optional[Decimal] = None
     status: str = "pending"
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     processed_at: Optional[datetime] = None
@@ -67,6 +83,12 @@ class CommissionCalculation(BaseModel):
     adjustments: Decimal = Decimal("0")
     final_amount: Decimal
     holdback_amount: Decimal = Decimal("0")
+    eligibility_rule_id: Optional[str] = None
+    nfm_multiplier: Optional[Decimal] = None
+    credit_percent: Decimal = Decimal("100")
+    credit_assignment_id: Optional[str] = None
+    currency: Optional[str] = None
+    fx_rate: Optional[Decimal] = None
     calculation_date: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     status: str = "calculated"
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -74,10 +96,17 @@ class CommissionCalculation(BaseModel):
 class CommissionPlanCreate(BaseModel):
     name: str
     plan_type: str
-    rules: Dict[str, Any]
+    rules: List[Dict[str, Any]] = []
     effective_start: datetime
     effective_end: Optional[datetime] = None
 
+    @validator('rules', pre=True)
+    def rules_as_list(cls, value):
+        # Early plans were stored with a rules mapping rather than a rule list
+        if isinstance(value, dict):
+            return value.get('rules', [])
+        return value
+
 class CommissionPlan(CommissionPlanCreate):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     status: str = "draft"
@@ -111,6 +140,21 @@ class Spiff(SpiffCreate):
     created_by: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class SpiffCredit(BaseModel):
+    calculation_id: str
+    sales_rep_id: str
+    amount: Decimal
+
+class SpiffAward(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    spiff_id: str
+    transaction_id: str
+    amount: Decimal
+    credits: List[SpiffCredit]
+    status: str = "credited"
+    retroactive: bool = False
+    awarded_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
 # Enhanced Partner Model with Documents and Approvals
 class PartnerDocument(BaseModel):
     document_type: str
@@ -192,17 +236,51 @@ class PayoutCreate(BaseModel):
     user_id: str
     payout_period_start: datetime
     payout_period_end: datetime
+    currency: Optional[str] = None
+
+    _currency = validator('currency', pre=True, allow_reuse=True)(currency_code)
 
 class Payout(PayoutCreate):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    payout_run_id: Optional[str] = None
+    calculation_count: int = 0
     total_commission: Decimal = Decimal("0")
     adjustments: Decimal = Decimal("0")
     deductions: Decimal = Decimal("0")
     net_payout: Decimal = Decimal("0")
+    fx_rate: Optional[Decimal] = None
+    payout_amount: Optional[Decimal] = None
     status: str = "pending"
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     processed_at: Optional[datetime] = None
 
+class PayoutRunCreate(BaseModel):
+    payout_period_start: datetime
+    payout_period_end: datetime
+    adjustments: Dict[str, Decimal] = {}
+    deductions: Dict[str, Decimal] = {}
+    currencies: Dict[str, str] = {}
+
+    @validator('currencies', pre=True)
+    def currency_codes(cls, value):
+        return {user_id: currency_code(code) for user_id, code in (value or {}).items() if currency_code(code)}
+
+class FXRateCreate(BaseModel):
+    from_currency: str
+    to_currency: str
+    rate: Decimal = Field(gt=0)
+    effective_date: datetime
+
+    _currencies = validator('from_currency', 'to_currency', pre=True, allow_reuse=True)(currency_code)
+
+class FXRate(FXRateCreate):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class ReconciliationCreate(BaseModel):
+    period_start: datetime
+    period_end: datetime
+
 class TerritoryCreate(BaseModel):
     name: str
     region: str
@@ -307,6 +385,7 @@ class AuditLog(BaseModel):
     resource_id: str
     state_before: Optional[Dict[str, Any]] = None
     state_after: Optional[Dict[str, Any]] = None
+    state_diff: Optional[Dict[str, Any]] = None
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class CustomRoleCreate(BaseModel):
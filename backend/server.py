@@ -1,31 +1,62 @@
-from fastapi import FastAPI, APIRouter, Depends, HTTPException, status, WebSocket, WebSocketDisconnect, Header, UploadFile, File, Request
+from fastapi import FastAPI, APIRouter, BackgroundTasks, Depends, HTTPException, status, WebSocket, WebSocketDisconnect, Header, UploadFile, File, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+import asyncio
 import os
 import logging
 from pathlib import Path
 from typing import List, Optional
 from datetime import datetime, timedelta, timezone
 import json
+import uuid
 from decimal import Decimal
 import csv
 import io
 
+ROOT_DIR = Path(__file__).parent
+# Before the utils imports: several of them read their settings from the environment at import time
+load_dotenv(ROOT_DIR / '.env')
+
 # Import models and utilities
+from pydantic import ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
 from models import *
 from models import CustomRoleCreate, CustomRole, CustomGroupCreate, CustomGroup
-from utils.security import verify_password, get_password_hash, create_access_token, verify_token, encrypt_sensitive_data, decrypt_sensitive_data
+from utils.security import hash_password_async, verify_password_async, password_pool, PasswordPoolBusy, create_access_token, verify_token, encrypt_sensitive_data, decrypt_sensitive_data
 from utils.validators import validate_credit_distribution, validate_commission_plan_logic, validate_financial_precision, calculate_sla_hours, check_sla_breach
-
-ROOT_DIR = Path(__file__).parent
-load_dotenv(ROOT_DIR / '.env')
+from utils.commission_engine import compile_plan, get_compiled_plan, PlanCompilationError
+from utils.commission_queue import CommissionQueue
+from utils.indexes import ensure_indexes
+from utils.codec import CODEC_OPTIONS
+from utils.periods import period_bounds, date_range_filter
+from utils.pagination import paginate, ndjson_response, json_default
+from utils.exports import FORMATS as EXPORT_FORMATS, MEDIA_TYPES as EXPORT_MEDIA_TYPES, csv_chunks, payment_xml_chunks, file_chunks, spool as spool_export
+from utils.user_cache import UserCache
+from utils.eligibility import EligibilityIndex
+from utils.nfm import NFMCache, apply as apply_nfm_multipliers
+from utils.credit_splits import SUPERSEDED, SplitConflict, load_assignments, party, party_credits, resplit, split_calculation
+from utils.payout_runs import new_run, acquire as acquire_payout_run, execute as execute_payout_run
+from utils.reconciliation import new_reconciliation, execute as execute_reconciliation
+from utils.spiff_engine import SpiffIndex, insert_awards, replay as replay_spiff
+from utils.fx import FXRateCache, FXRateMissing
+from utils.quota_attainment import AttainmentReconciler, apply as apply_attainment
+from utils.ws_manager import ConnectionManager
+from utils.pubsub import create_pubsub
+from utils.dashboard_push import DashboardPush, DIRTY_TOPIC as DASHBOARD_DIRTY_TOPIC, SECTIONS as DASHBOARD_SECTIONS, SHARED_TOPIC as DASHBOARD_TOPIC, dashboard_topic
+from utils.audit_sink import AuditSink
+from utils.audit_archive import AuditPartitions
+from utils.transaction_ingest import CHUNK_SIZE as INGEST_CHUNK_SIZE, MAX_REPORTED_ERRORS, BodyEncodingError, iter_records, build_transactions
+from utils.product_import import new_job, spool_upload, run_import
+from utils.rollups import PERIOD_GRANULARITY, apply_calculations, apply_status_change, read_totals, rebuild as rebuild_rollups
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+db = client.get_database(os.environ['DB_NAME'], codec_options=CODEC_OPTIONS)
 
 # Create the main app
 app = FastAPI(title="SPM/PPM Enterprise System")
@@ -37,37 +68,20 @@ api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
 
 # WebSocket manager for real-time updates
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-        self.user_connections: dict = {}  # user_id -> websocket
-
-    async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-        self.user_connections[user_id] = websocket
-
-    def disconnect(self, websocket: WebSocket, user_id: str):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        if user_id in self.user_connections:
-            del self.user_connections[user_id]
-
-    async def send_personal_message(self, message: dict, user_id: str):
-        if user_id in self.user_connections:
-            try:
-                await self.user_connections[user_id].send_text(json.dumps(message))
-            except:
-                pass
+manager = ConnectionManager(
+    max_queue=int(os.environ.get('WS_MAX_QUEUE', '256')),
+    send_timeout=float(os.environ.get('WS_SEND_TIMEOUT_SECONDS', '5')),
+    pubsub=create_pubsub(os.environ.get('PUBSUB_BACKEND', 'memory'), db)
+)
 
-    async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(json.dumps(message))
-            except:
-                pass
+user_cache = UserCache(
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', '10000')),
+    ttl_seconds=float(os.environ.get('USER_CACHE_TTL_SECONDS', '60'))
+)
 
-manager = ConnectionManager()
+async def load_user(user_id: str) -> Optional[User]:
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0, "google_id": 0})
+    return User(**user) if user else None
 
 # Dependency to get current user from token
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -76,11 +90,11 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     if payload is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
     
-    user = await db.users.find_one({"id": payload.get("sub")}, {"_id": 0})
+    user = await user_cache.get(payload.get("sub"), load_user)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
     
-    return User(**user)
+    return user
 
 # Role-based access control
 def require_role(allowed_roles: List[str]):
@@ -90,6 +104,16 @@ def require_role(allowed_roles: List[str]):
         return current_user
     return role_checker
 
+audit_partitions = AuditPartitions(db, Path(os.environ.get('AUDIT_ARCHIVE_DIR', ROOT_DIR / 'audit_archive')))
+
+audit_sink = AuditSink(
+    audit_partitions.collection_for,
+    Path(os.environ.get('AUDIT_SPILL_DIR', ROOT_DIR / 'audit_spool')),
+    batch_size=int(os.environ.get('AUDIT_FLUSH_SIZE', '500')),
+    flush_interval=float(os.environ.get('AUDIT_FLUSH_INTERVAL_SECONDS', '1')),
+    store_diffs=os.environ.get('AUDIT_STORE_DIFFS', 'false').lower() == 'true'
+)
+
 # Helper function for audit logs
 async def create_audit_log(user_id: str, action_type: str, resource_type: str, resource_id: str, state_before: Optional[dict], state_after: Optional[dict]):
     audit = AuditLog(
@@ -100,9 +124,19 @@ async def create_audit_log(user_id: str, action_type: str, resource_type: str, r
         state_before=state_before,
         state_after=state_after
     )
-    doc = audit.model_dump()
-    doc['timestamp'] = doc['timestamp'].isoformat()
-    await db.audit_logs.insert_one(doc)
+    await audit_sink.emit(audit.model_dump())
+
+async def list_page(collection, query: dict, response: Response, limit: int = 100, cursor: Optional[str] = None, stream: bool = False):
+    """Return one keyset page (next cursor in X-Next-Cursor) or stream the whole result as NDJSON."""
+    try:
+        if stream:
+            return ndjson_response(collection, query, cursor)
+        docs, next_cursor = await paginate(collection, query, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return docs
 
 # ============= AUTHENTICATION ENDPOINTS =============
 
@@ -114,13 +148,13 @@ async def register(user_data: UserCreate):
     
     user_dict = user_data.model_dump()
     if user_data.password:
-        user_dict['password'] = get_password_hash(user_data.password)
+        try:
+            user_dict['password'] = await hash_password_async(user_data.password)
+        except PasswordPoolBusy as e:
+            raise HTTPException(status_code=503, detail=str(e))
     
     user_obj = User(**{k: v for k, v in user_dict.items() if k not in ['password', 'google_id']})
     doc = user_obj.model_dump()
-    for key in ['created_at', 'updated_at']:
-        if key in doc and isinstance(doc[key], datetime):
-            doc[key] = doc[key].isoformat()
     
     doc['password'] = user_dict.get('password')
     doc['google_id'] = user_dict.get('google_id')
@@ -134,12 +168,16 @@ async def register(user_data: UserCreate):
 @api_router.post("/auth/login", response_model=Token)
 async def login(credentials: UserLogin):
     user = await db.users.find_one({"email": credentials.email}, {"_id": 0})
-    if not user or not verify_password(credentials.password, user.get('password', '')):
+    if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    for key in ['created_at', 'updated_at']:
-        if key in user and isinstance(user[key], str):
-            user[key] = datetime.fromisoformat(user[key])
+    try:
+        valid, new_hash = await verify_password_async(credentials.password, user.get('password', ''))
+    except PasswordPoolBusy as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    if new_hash:
+        await db.users.update_one({"id": user['id']}, {"$set": {"password": new_hash}})
     
     user_obj = User(**{k: v for k, v in user.items() if k not in ['password', 'google_id']})
     access_token = create_access_token(data={"sub": user_obj.id, "role": user_obj.role})
@@ -160,20 +198,22 @@ async def google_login(token: dict):
         user_dict = user_create.model_dump()
         user_obj = User(**{k: v for k, v in user_dict.items() if k not in ['password', 'google_id']})
         doc = user_obj.model_dump()
-        for key in ['created_at', 'updated_at']:
-            if key in doc and isinstance(doc[key], datetime):
-                doc[key] = doc[key].isoformat()
         doc['google_id'] = google_id
         await db.users.insert_one(doc)
     else:
-        for key in ['created_at', 'updated_at']:
-            if key in user and isinstance(user[key], str):
-                user[key] = datetime.fromisoformat(user[key])
         user_obj = User(**{k: v for k, v in user.items() if k not in ['password', 'google_id']})
     
     access_token = create_access_token(data={"sub": user_obj.id, "role": user_obj.role})
     return Token(access_token=access_token, user=user_obj)
 
+@api_router.get("/auth/cache")
+async def get_user_cache_stats(current_user: User = Depends(require_role(["admin"]))):
+    return user_cache.stats()
+
+@api_router.get("/auth/password-pool")
+async def get_password_pool_stats(current_user: User = Depends(require_role(["admin"]))):
+    return password_pool.stats()
+
 @api_router.get("/auth/me", response_model=User)
 async def get_me(current_user: User = Depends(get_current_user)):
     return current_user
@@ -183,10 +223,6 @@ async def get_me(current_user: User = Depends(get_current_user)):
 @api_router.get("/users", response_model=List[User])
 async def list_users(current_user: User = Depends(require_role(["admin", "manager"]))):
     users = await db.users.find({}, {"_id": 0, "password": 0, "google_id": 0}).to_list(1000)
-    for u in users:
-        for key in ['created_at', 'updated_at']:
-            if key in u and isinstance(u[key], str):
-                u[key] = datetime.fromisoformat(u[key])
     return users
 
 @api_router.patch("/users/{user_id}")
@@ -197,8 +233,9 @@ async def update_user(user_id: str, update_data: dict, current_user: User = Depe
     if not update_dict:
         raise HTTPException(status_code=400, detail="No valid fields to update")
     
-    update_dict['updated_at'] = datetime.now(timezone.utc).isoformat()
+    update_dict['updated_at'] = datetime.now(timezone.utc)
     result = await db.users.update_one({"id": user_id}, {"$set": update_dict})
+    user_cache.invalidate(user_id)
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
@@ -215,60 +252,43 @@ async def create_product(product_data: ProductCreate, current_user: User = Depen
     
     product = Product(**product_data.model_dump(), eligible=True)
     doc = product.model_dump()
-    for key in ['created_at', 'updated_at']:
-        doc[key] = doc[key].isoformat()
-    for key in ['gross_margin_percent', 'base_commission_rate']:
-        doc[key] = str(doc[key])
     
-    await db.products.insert_one(doc)
+    try:
+        await db.products.insert_one(doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail=f"A product with SKU {product.sku} already exists")
     await create_audit_log(current_user.id, "product_created", "product", product.id, None, doc)
     return product
 
 @api_router.get("/products", response_model=List[Product])
 async def list_products(current_user: User = Depends(get_current_user)):
     products = await db.products.find({}, {"_id": 0}).to_list(1000)
-    for p in products:
-        for key in ['created_at', 'updated_at']:
-            if isinstance(p[key], str):
-                p[key] = datetime.fromisoformat(p[key])
-        for key in ['gross_margin_percent', 'base_commission_rate']:
-            p[key] = Decimal(p[key])
     return products
 
-@api_router.post("/products/bulk-upload")
-async def bulk_upload_products(file: UploadFile = File(...), current_user: User = Depends(require_role(["admin", "finance"]))):
+@api_router.post("/products/bulk-upload", status_code=202)
+async def bulk_upload_products(background_tasks: BackgroundTasks, file: UploadFile = File(...), current_user: User = Depends(require_role(["admin", "finance"]))):
     if not file.filename.endswith('.csv'):
         raise HTTPException(status_code=400, detail="Only CSV files are supported")
     
-    content = await file.read()
-    csv_file = io.StringIO(content.decode('utf-8'))
-    reader = csv.DictReader(csv_file)
-    
-    products_created = 0
-    errors = []
+    path = await spool_upload(file)
+    job = new_job(file.filename, current_user.id)
+    await db.import_jobs.insert_one(job)
+    background_tasks.add_task(import_products, job['id'], path, current_user.id)
     
-    for row in reader:
-        try:
-            product = Product(
-                sku=row['sku'],
-                name=row['name'],
-                category=row['category'],
-                commission_rate_code=row['commission_rate_code'],
-                gross_margin_percent=Decimal(row['gross_margin_percent']),
-                base_commission_rate=Decimal(row['base_commission_rate']),
-                eligible=True
-            )
-            doc = product.model_dump()
-            for key in ['created_at', 'updated_at']:
-                doc[key] = doc[key].isoformat()
-            for key in ['gross_margin_percent', 'base_commission_rate']:
-                doc[key] = str(doc[key])
-            await db.products.insert_one(doc)
-            products_created += 1
-        except Exception as e:
-            errors.append({"row": row, "error": str(e)})
-    
-    return {"products_created": products_created, "errors": errors}
+    return {"job_id": job['id'], "status": job['status']}
+
+async def import_products(job_id: str, path: str, user_id: str):
+    job = await run_import(db, job_id, path)
+    if job:
+        summary = {k: job.get(k) for k in ["status", "rows_processed", "products_created", "products_updated", "rejected"]}
+        await create_audit_log(user_id, "products_bulk_uploaded", "import_job", job_id, None, summary)
+
+@api_router.get("/products/bulk-upload/{job_id}")
+async def get_product_import(job_id: str, current_user: User = Depends(require_role(["admin", "finance"]))):
+    job = await db.import_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    return job
 
 # ============= TRANSACTION ENDPOINTS =============
 
@@ -279,85 +299,336 @@ async def create_transaction(txn_data: TransactionCreate, current_user: User = D
     
     transaction = Transaction(**txn_data_dict)
     doc = transaction.model_dump()
-    doc['transaction_date'] = doc['transaction_date'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
-    for key in ['unit_price', 'total_amount']:
-        doc[key] = str(doc[key])
     
     await db.transactions.insert_one(doc)
-    await process_transaction_commission(transaction.id)
+    await commission_queue.enqueue([transaction.id])
     await manager.broadcast({"type": "transaction_created", "transaction_id": transaction.id})
     
     return transaction
 
+@api_router.post("/transactions/batch")
+async def create_transaction_batch(request: Request, format: Optional[str] = None, current_user: User = Depends(require_role(["admin", "manager"]))):
+    fmt = format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+    if fmt not in ["csv", "ndjson"]:
+        raise HTTPException(status_code=400, detail="Format must be csv or ndjson")
+    
+    batch_id = str(uuid.uuid4())
+    result = {"batch_id": batch_id, "received": 0, "inserted": 0, "rejected": 0, "errors": []}
+    
+    async def flush(records):
+        docs, errors = build_transactions(records)
+        result['received'] += len(records)
+        result['rejected'] += len(errors)
+        result['errors'].extend(errors[:MAX_REPORTED_ERRORS - len(result['errors'])])
+        if not docs:
+            return
+        for doc in docs:
+            doc['batch_id'] = batch_id
+        await db.transactions.insert_many(docs, ordered=True)
+        # Calculated by the queue workers, so a crash after the insert cannot strand them as pending
+        await commission_queue.enqueue([doc['id'] for doc in docs])
+        result['inserted'] += len(docs)
+    
+    records = []
+    try:
+        async for record in iter_records(request.stream(), fmt):
+            records.append(record)
+            if len(records) >= INGEST_CHUNK_SIZE:
+                await flush(records)
+                records = []
+    except BodyEncodingError as e:
+        # Earlier chunks are stored and queued; report them with the error
+        await create_audit_log(current_user.id, "transaction_batch_created", "transaction_batch", batch_id, None,
+                               {**{k: v for k, v in result.items() if k != "errors"}, "error": str(e)})
+        raise HTTPException(status_code=400, detail={**result, "error": str(e)})
+    if records:
+        await flush(records)
+    
+    await manager.broadcast({"type": "transactions_batch_created", "batch_id": batch_id, "count": result['inserted']})
+    await create_audit_log(current_user.id, "transaction_batch_created", "transaction_batch", batch_id, None,
+                           {k: v for k, v in result.items() if k != "errors"})
+    
+    return result
+
 @api_router.get("/transactions", response_model=List[Transaction])
-async def list_transactions(current_user: User = Depends(get_current_user), limit: int = 100):
+async def list_transactions(response: Response, current_user: User = Depends(get_current_user), limit: int = 100, cursor: Optional[str] = None, stream: bool = False):
     query = {}
     if current_user.role == "partner" or current_user.role == "rep":
         query["sales_rep_id"] = current_user.id
     
-    transactions = await db.transactions.find(query, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
-    for t in transactions:
-        for key in ['transaction_date', 'created_at']:
-            if key in t and isinstance(t[key], str):
-                t[key] = datetime.fromisoformat(t[key])
-        if 'processed_at' in t and t['processed_at'] and isinstance(t['processed_at'], str):
-            t['processed_at'] = datetime.fromisoformat(t['processed_at'])
-        for key in ['unit_price', 'total_amount']:
-            t[key] = Decimal(t[key])
-    return transactions
+    return await list_page(db.transactions, query, response, limit, cursor, stream)
 
 # ============= COMMISSION CALCULATION & EARNINGS =============
 
+eligibility_index = EligibilityIndex(refresh_seconds=float(os.environ.get('ELIGIBILITY_REFRESH_SECONDS', '60')))
+nfm_cache = NFMCache(
+    maxsize=int(os.environ.get('NFM_CACHE_SIZE', '10000')),
+    ttl_seconds=float(os.environ.get('NFM_CACHE_TTL_SECONDS', '300'))
+)
+spiff_index = SpiffIndex(refresh_seconds=float(os.environ.get('SPIFF_REFRESH_SECONDS', '60')))
+BASE_CURRENCY = os.environ.get('BASE_CURRENCY', 'USD')
+fx_rates = FXRateCache(
+    BASE_CURRENCY,
+    refresh_seconds=float(os.environ.get('FX_REFRESH_SECONDS', '300')),
+    on_change=lambda: requeue_pending_fx()
+)
+attainment_reconciler = AttainmentReconciler(
+    interval_seconds=float(os.environ.get('QUOTA_RECONCILE_SECONDS', '3600')),
+    on_corrected=lambda user_ids: dashboard_push.mark(user_ids, "quota")
+)
+
+async def get_active_plan():
+    return await db.commission_plans.find_one({"plan_type": "individual", "status": "active"}, {"_id": 0})
+
 async def process_transaction_commission(transaction_id: str):
-    transaction = await db.transactions.find_one({"id": transaction_id}, {"_id": 0})
-    if not transaction:
+    await process_commission_batch([transaction_id])
+
+async def process_commission_batch(transaction_ids: List[str]):
+    # Queue delivery is at-least-once, so skip anything an earlier attempt already processed
+    transactions = await db.transactions.find(
+        {"id": {"$in": transaction_ids}, "status": {"$ne": "processed"}}, {"_id": 0}
+    ).to_list(len(transaction_ids))
+    # An attempt that stored calculations but died before marking its transactions must not store them twice
+    calculated = set(await db.commission_calculations.distinct("transaction_id", {"transaction_id": {"$in": [t['id'] for t in transactions]}}))
+    if calculated:
+        logger.warning("Finishing %d transactions that already have calculations", len(calculated))
+        await finish_calculated([t for t in transactions if t['id'] in calculated])
+        transactions = [t for t in transactions if t['id'] not in calculated]
+    if not transactions:
         return
     
-    plan = await db.commission_plans.find_one({"plan_type": "individual", "status": "active"}, {"_id": 0})
+    await notify_commissions(await calculate_commissions(transactions))
+
+async def calculate_commissions(transactions: List[dict]) -> dict:
+    """Calculate, store and roll up commissions for a batch; returns a per-rep summary."""
+    plan = await get_active_plan()
     if not plan:
-        return
-    
-    total_amount = Decimal(transaction['total_amount'])
-    base_rate = Decimal('0.05')
-    commission_amount = validate_financial_precision(total_amount * base_rate)
-    
-    calculation = CommissionCalculation(
-        transaction_id=transaction_id,
-        sales_rep_id=transaction['sales_rep_id'],
-        plan_id=plan['id'],
-        base_amount=total_amount,
-        commission_amount=commission_amount,
-        final_amount=commission_amount
+        return {}
+    
+    # Commissions are kept in the base currency; transactions without a rate wait for one
+    transactions, unconverted = fx_rates.normalize(transactions)
+    if unconverted:
+        logger.warning("No FX rate for %d transactions, holding them as pending_fx", len(unconverted))
+        await db.transactions.update_many({"id": {"$in": [t['id'] for t in unconverted]}}, {"$set": {"status": "pending_fx"}})
+    if not transactions:
+        return {}
+    
+    program = get_compiled_plan(plan)
+    commissions = program.evaluate_transactions(transactions)
+    rule_ids = [None] * len(transactions)
+    if len(eligibility_index):
+        # Rules match on the product's category; one lookup covers the batch
+        products = await db.products.find(
+            {"id": {"$in": list({t['product_id'] for t in transactions})}}, {"_id": 0, "id": 1, "category": 1}
+        ).to_list(None)
+        commissions, rule_ids = eligibility_index.apply(transactions, commissions, {p['id']: p['category'] for p in products})
+    profiles = await nfm_cache.get_many(db.nfms, [t['sales_rep_id'] for t in transactions])
+    commissions, multipliers = apply_nfm_multipliers(profiles, transactions, commissions)
+    spiff_awards = spiff_index.awards(transactions) if len(spiff_index) else [[]] * len(transactions)
+    splits = await load_assignments(db.credit_assignments, [t['id'] for t in transactions])
+    
+    docs = []
+    awards = []
+    for transaction, commission_amount, rule_id, multiplier, earned in zip(transactions, commissions, rule_ids, multipliers, spiff_awards):
+        adjustments = sum((amount for _, amount in earned), Decimal("0"))
+        calculation = CommissionCalculation(
+            transaction_id=transaction['id'],
+            sales_rep_id=transaction['sales_rep_id'],
+            plan_id=plan['id'],
+            base_amount=transaction['total_amount'],
+            commission_amount=commission_amount,
+            adjustments=adjustments,
+            final_amount=commission_amount + adjustments,
+            eligibility_rule_id=rule_id,
+            nfm_multiplier=multiplier,
+            currency=transaction.get('currency'),
+            fx_rate=transaction.get('fx_rate')
+        )
+        doc = calculation.model_dump()
+        split = splits.get(transaction['id'])
+        credited = split_calculation(doc, split) if split else [doc]
+        docs.extend(credited)
+        awards.extend(SpiffAward(
+            spiff_id=spiff_id,
+            transaction_id=transaction['id'],
+            amount=amount,
+            credits=party_credits(amount, credited)
+        ).model_dump() for spiff_id, amount in earned)
+    
+    await db.commission_calculations.insert_many(docs)
+    await insert_awards(db.spiff_awards, awards)
+    await apply_calculations(db.earnings_rollups, docs)
+    quota_reps = await apply_attainment(db.quotas, docs, {t['id']: t for t in transactions})
+    await db.transactions.update_many(
+        {"id": {"$in": [t['id'] for t in transactions]}},
+        {"$set": {"status": "processed", "processed_at": datetime.now(timezone.utc)}}
     )
-    
-    doc = calculation.model_dump()
-    doc['calculation_date'] = doc['calculation_date'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
-    for key in ['base_amount', 'commission_amount', 'adjustments', 'final_amount', 'holdback_amount']:
-        doc[key] = str(doc[key])
-    
-    await db.commission_calculations.insert_one(doc)
-    await db.transactions.update_one({"id": transaction_id}, {"$set": {"status": "processed", "processed_at": datetime.now(timezone.utc).isoformat()}})
-    
-    await manager.send_personal_message(
-        {"type": "commission_calculated", "transaction_id": transaction_id, "amount": str(commission_amount)},
-        transaction['sales_rep_id']
+    converted = [t for t in transactions if t.get('fx_rate') is not None]
+    if converted:
+        await db.transactions.bulk_write([
+            UpdateOne({"id": t['id']}, {"$set": {"base_amount": t['base_amount'], "fx_rate": t['fx_rate']}}) for t in converted
+        ], ordered=False)
+    
+    summary = {}
+    for doc in docs:
+        merge_commission_summaries(summary, {doc['sales_rep_id']: {"count": 1, "amount": doc['final_amount'], "transaction_id": doc['transaction_id']}})
+    dashboard_push.mark(summary.keys(), "earnings")
+    dashboard_push.mark(quota_reps, "quota")
+    return summary
+
+async def finish_calculated(transactions: List[dict]):
+    """Redo the follow-up writes for transactions whose calculations an interrupted attempt already stored.
+
+    Nothing records how far that attempt got, so every step is one that can
+    run twice: awards skip duplicates, and rollups and quota attainment are
+    rebuilt from the stored calculations instead of incremented.
+    """
+    ids = [t['id'] for t in transactions]
+    docs = await db.commission_calculations.find(
+        {"transaction_id": {"$in": ids}, "status": {"$ne": SUPERSEDED}}, {"_id": 0}
+    ).to_list(None)
+    by_transaction = {}
+    for doc in docs:
+        by_transaction.setdefault(doc['transaction_id'], []).append(doc)
+    
+    converted, _ = fx_rates.normalize(transactions)
+    if len(spiff_index):
+        await insert_awards(db.spiff_awards, [SpiffAward(
+            spiff_id=spiff_id,
+            transaction_id=transaction['id'],
+            amount=amount,
+            credits=party_credits(amount, by_transaction[transaction['id']])
+        ).model_dump() for transaction, earned in zip(converted, spiff_index.awards(converted))
+            if transaction['id'] in by_transaction for spiff_id, amount in earned])
+    
+    rep_ids = sorted({doc['sales_rep_id'] for doc in docs})
+    for rep_id in rep_ids:
+        await rebuild_rollups(db, repair=True, sales_rep_id=rep_id)
+    quota_ids = await db.quotas.distinct("id", {"user_id": {"$in": rep_ids}, "status": "active"})
+    if quota_ids:
+        await attainment_reconciler.run_once(db, quota_ids)
+    
+    await db.transactions.update_many(
+        {"id": {"$in": ids}},
+        {"$set": {"status": "processed", "processed_at": datetime.now(timezone.utc)}}
     )
+    fx_converted = [t for t in converted if t.get('fx_rate') is not None]
+    if fx_converted:
+        await db.transactions.bulk_write([
+            UpdateOne({"id": t['id']}, {"$set": {"base_amount": t['base_amount'], "fx_rate": t['fx_rate']}}) for t in fx_converted
+        ], ordered=False)
+    dashboard_push.mark(rep_ids, "earnings", "quota")
+
+def merge_commission_summaries(totals: dict, summary: dict):
+    for rep_id, rep_summary in summary.items():
+        current = totals.setdefault(rep_id, {"count": 0, "amount": Decimal("0")})
+        current['count'] += rep_summary['count']
+        current['amount'] += rep_summary['amount']
+        current['transaction_id'] = rep_summary.get('transaction_id')
+
+async def notify_commissions(summary: dict):
+    """Send each rep one message covering all of their new commissions."""
+    for rep_id, rep_summary in summary.items():
+        message = {"type": "commission_calculated", "amount": str(rep_summary['amount']), "count": rep_summary['count']}
+        if rep_summary['count'] == 1:
+            message['transaction_id'] = rep_summary['transaction_id']
+        await manager.send_personal_message(message, rep_id)
+
+commission_queue = CommissionQueue(
+    db.commission_queue,
+    process_commission_batch,
+    workers=int(os.environ.get('COMMISSION_QUEUE_WORKERS', '4')),
+    batch_size=int(os.environ.get('COMMISSION_QUEUE_BATCH_SIZE', '200')),
+    max_pending=int(os.environ.get('COMMISSION_QUEUE_MAX_PENDING', '100000')),
+    retry_base_seconds=float(os.environ.get('COMMISSION_QUEUE_RETRY_BASE_SECONDS', '1')),
+    retry_max_seconds=float(os.environ.get('COMMISSION_QUEUE_RETRY_MAX_SECONDS', '300'))
+)
+
+@api_router.get("/commissions/queue")
+async def get_commission_queue_stats(current_user: User = Depends(require_role(["admin", "finance"]))):
+    return await commission_queue.stats()
+
+def earnings_match(period: str, **filters) -> dict:
+    try:
+        start, end = period_bounds(period)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {**filters, **date_range_filter("calculation_date", start, end)}
+
+async def aggregate_earnings(match: dict) -> dict:
+    """Sum final amounts per rep with a single $group; returns {sales_rep_id: totals}."""
+    results = await db.commission_calculations.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": "$sales_rep_id",
+            "total_earnings": {"$sum": "$final_amount"},
+            "calculation_count": {"$sum": 1}
+        }}
+    ]).to_list(None)
+    return {r['_id']: r for r in results}
+
+async def earnings_totals(user_ids: List[str], period: str = "all") -> dict:
+    """Per-rep totals for the current period, read from rollups where a bucket exists for it."""
+    if not user_ids:
+        return {}
+    if period in PERIOD_GRANULARITY:
+        return await read_totals(db.earnings_rollups, user_ids, PERIOD_GRANULARITY[period])
+    return await aggregate_earnings(earnings_match(period, sales_rep_id={"$in": user_ids}))
+
+async def get_rep_earnings(user_id: str, period: str = "all") -> Decimal:
+    totals = await earnings_totals([user_id], period)
+    return totals.get(user_id, {}).get('total_earnings', Decimal("0"))
 
 @api_router.get("/commissions/my-earnings")
-async def get_my_earnings(current_user: User = Depends(get_current_user)):
-    calculations = await db.commission_calculations.find({"sales_rep_id": current_user.id}, {"_id": 0}).to_list(1000)
-    
-    for c in calculations:
-        for key in ['calculation_date', 'created_at']:
-            if isinstance(c[key], str):
-                c[key] = datetime.fromisoformat(c[key])
-        for key in ['base_amount', 'commission_amount', 'adjustments', 'final_amount', 'holdback_amount']:
-            c[key] = Decimal(c[key])
+async def get_my_earnings(period: str = "all", limit: int = 100, current_user: User = Depends(get_current_user)):
+    match = earnings_match(period, sales_rep_id=current_user.id)
+    totals = (await earnings_totals([current_user.id], period)).get(current_user.id, {})
+    calculations = await db.commission_calculations.find(match, {"_id": 0}).sort("calculation_date", -1).limit(limit).to_list(limit)
     
-    total_earnings = sum(Decimal(c['final_amount']) for c in calculations)
-    return {"total_earnings": str(total_earnings), "calculations": calculations}
+    return {
+        "period": period,
+        "total_earnings": str(totals.get('total_earnings', Decimal("0"))),
+        "calculation_count": totals.get('calculation_count', 0),
+        "calculations": calculations
+    }
+
+@api_router.post("/commissions/status")
+async def update_calculation_status(status_data: dict, current_user: User = Depends(require_role(["admin", "finance"]))):
+    calculation_ids = status_data.get('calculation_ids') or []
+    new_status = status_data.get('status')
+    if not calculation_ids or new_status not in ["calculated", "approved", "rejected", "on_hold"]:
+        raise HTTPException(status_code=400, detail="calculation_ids and a valid status are required")
+    
+    calculations = await db.commission_calculations.find(
+        {"id": {"$in": calculation_ids}, "status": {"$nin": [new_status, SUPERSEDED]}},
+        {"_id": 0, "id": 1, "sales_rep_id": 1, "plan_id": 1, "calculation_date": 1, "final_amount": 1, "status": 1, "payout_run_id": 1, "payout_id": 1}
+    ).to_list(len(calculation_ids))
+    if not calculations:
+        return {"updated": 0}
+    # A payout has already counted claimed calculations; changing them would leave it wrong
+    if any(c.get('payout_run_id') or c.get('payout_id') for c in calculations):
+        raise HTTPException(status_code=409, detail="Some calculations are claimed by a payout and can no longer change status")
+    
+    # Each calculation changes only from the status it was read with, and only those that did are rolled up
+    async def change(calculation):
+        return await db.commission_calculations.find_one_and_update(
+            {"id": calculation['id'], "status": calculation['status'], "payout_run_id": None, "payout_id": None},
+            {"$set": {"status": new_status}},
+            {"_id": 1}
+        )
+    results = await asyncio.gather(*(change(c) for c in calculations))
+    updated = [c for c, result in zip(calculations, results) if result is not None]
+    await apply_status_change(db.earnings_rollups, updated, new_status)
+    dashboard_push.mark({c['sales_rep_id'] for c in updated}, "earnings")
+    
+    await create_audit_log(current_user.id, "calculation_status_updated", "commission_calculation", ",".join(calculation_ids[:50]), None, {"status": new_status, "count": len(updated)})
+    return {"updated": len(updated)}
+
+@api_router.post("/commissions/rollups/reconcile")
+async def reconcile_earnings_rollups(reconcile_data: dict, current_user: User = Depends(require_role(["admin"]))):
+    report = await rebuild_rollups(db, repair=bool(reconcile_data.get('repair')), sales_rep_id=reconcile_data.get('sales_rep_id'))
+    await create_audit_log(current_user.id, "rollups_reconciled", "earnings_rollup", reconcile_data.get('sales_rep_id') or "all", None, report)
+    return report
 
 # ============= COMMISSION PLAN ENDPOINTS =============
 
@@ -366,14 +637,13 @@ async def create_commission_plan(plan_data: CommissionPlanCreate, current_user:
     validation = validate_commission_plan_logic(plan_data.rules)
     if not validation['valid']:
         raise HTTPException(status_code=400, detail=validation.get('error', 'Invalid plan logic'))
+    try:
+        compile_plan(plan_data.model_dump())
+    except PlanCompilationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     plan = CommissionPlan(**plan_data.model_dump(), created_by=current_user.id)
     doc = plan.model_dump()
-    doc['effective_start'] = doc['effective_start'].isoformat()
-    if doc['effective_end']:
-        doc['effective_end'] = doc['effective_end'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
     
     await db.commission_plans.insert_one(doc)
     await create_audit_log(current_user.id, "plan_created", "commission_plan", plan.id, None, doc)
@@ -382,21 +652,24 @@ async def create_commission_plan(plan_data: CommissionPlanCreate, current_user:
 @api_router.get("/plans", response_model=List[CommissionPlan])
 async def list_commission_plans(current_user: User = Depends(require_role(["admin", "finance", "manager"]))):
     plans = await db.commission_plans.find({}, {"_id": 0}).to_list(100)
-    for p in plans:
-        p['effective_start'] = datetime.fromisoformat(p['effective_start'])
-        if p.get('effective_end'):
-            p['effective_end'] = datetime.fromisoformat(p['effective_end'])
-        p['created_at'] = datetime.fromisoformat(p['created_at'])
-        p['updated_at'] = datetime.fromisoformat(p['updated_at'])
     return plans
 
 @api_router.patch("/plans/{plan_id}")
 async def update_plan(plan_id: str, update_data: dict, current_user: User = Depends(require_role(["admin", "finance"]))):
-    plan = await db.plans.find_one({"id": plan_id}, {"_id": 0})
+    plan = await db.commission_plans.find_one({"id": plan_id}, {"_id": 0})
     if not plan:
         raise HTTPException(status_code=404, detail="Plan not found")
     
-    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
+    if 'rules' in update_data:
+        validation = validate_commission_plan_logic(update_data['rules'])
+        if not validation['valid']:
+            raise HTTPException(status_code=400, detail=validation.get('error', 'Invalid plan logic'))
+        try:
+            compile_plan({**plan, 'rules': update_data['rules']})
+        except PlanCompilationError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    update_data['updated_at'] = datetime.now(timezone.utc)
     await db.commission_plans.update_one({"id": plan_id}, {"$set": update_data})
     await create_audit_log(current_user.id, "plan_updated", "commission_plan", plan_id, plan, update_data)
     return {"message": "Plan updated successfully"}
@@ -407,24 +680,39 @@ async def update_plan(plan_id: str, update_data: dict, current_user: User = Depe
 async def create_credit_assignment(assignment_data: CreditAssignmentCreate, current_user: User = Depends(require_role(["admin", "manager"]))):
     if not validate_credit_distribution(assignment_data.assignments):
         raise HTTPException(status_code=400, detail="Credit distribution must equal 100%")
+    if not all(party(a) for a in assignment_data.assignments):
+        raise HTTPException(status_code=400, detail="Each assignment needs a user_id")
+    locked = await db.commission_calculations.find_one(
+        {"transaction_id": assignment_data.transaction_id, "status": {"$nin": ["calculated", SUPERSEDED]}}, {"_id": 0, "id": 1}
+    )
+    if locked:
+        raise HTTPException(status_code=409, detail="Commissions for this transaction are already approved or paid")
     
     assignment = CreditAssignment(**assignment_data.model_dump())
     doc = assignment.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['total_credit_percent'] = str(doc['total_credit_percent'])
     
     await db.credit_assignments.insert_one(doc)
+    # Transactions calculated before the assignment existed are re-split now
+    try:
+        removed, created = await resplit(db, assignment.model_dump())
+    except SplitConflict as e:
+        # Calculations were approved since the check above; the assignment must not apply later either
+        await db.credit_assignments.delete_one({"id": assignment.id})
+        raise HTTPException(status_code=409, detail=str(e))
+    if created:
+        # Quota credit moves with the split; recomputed, like the rollups, so a retry cannot count it twice
+        quota_reps = sorted({c['sales_rep_id'] for c in removed + created})
+        quota_ids = await db.quotas.distinct("id", {"user_id": {"$in": quota_reps}, "status": "active"})
+        if quota_ids:
+            await attainment_reconciler.run_once(db, quota_ids)
+        dashboard_push.mark(quota_reps, "quota")
+    dashboard_push.mark({c['sales_rep_id'] for c in removed + created}, "earnings")
     await create_audit_log(current_user.id, "credit_assignment_created", "credit_assignment", assignment.id, None, doc)
     return assignment
 
 @api_router.get("/credit-assignments")
-async def list_credit_assignments(current_user: User = Depends(get_current_user)):
-    assignments = await db.credit_assignments.find({}, {"_id": 0}).to_list(1000)
-    for a in assignments:
-        if isinstance(a['created_at'], str):
-            a['created_at'] = datetime.fromisoformat(a['created_at'])
-        a['total_credit_percent'] = Decimal(a['total_credit_percent'])
-    return assignments
+async def list_credit_assignments(response: Response, current_user: User = Depends(get_current_user), limit: int = 100, cursor: Optional[str] = None, stream: bool = False):
+    return await list_page(db.credit_assignments, {}, response, limit, cursor, stream)
 
 # ============= SPIFF ENDPOINTS =============
 
@@ -432,49 +720,83 @@ async def list_credit_assignments(current_user: User = Depends(get_current_user)
 async def create_spiff(spiff_data: SpiffCreate, current_user: User = Depends(require_role(["admin", "finance"]))):
     spiff = Spiff(**spiff_data.model_dump(), created_by=current_user.id)
     doc = spiff.model_dump()
-    doc['start_date'] = doc['start_date'].isoformat()
-    doc['end_date'] = doc['end_date'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['incentive_amount'] = str(doc['incentive_amount'])
     
     await db.spiffs.insert_one(doc)
+    spiff_index.upsert(spiff.model_dump())
     await create_audit_log(current_user.id, "spiff_created", "spiff", spiff.id, None, doc)
+    dashboard_push.mark([], "spiffs")
     return spiff
 
 @api_router.get("/spiffs")
 async def list_spiffs(current_user: User = Depends(get_current_user)):
     spiffs = await db.spiffs.find({}, {"_id": 0}).to_list(100)
-    for s in spiffs:
-        for key in ['start_date', 'end_date', 'created_at']:
-            if isinstance(s[key], str):
-                s[key] = datetime.fromisoformat(s[key])
-        s['incentive_amount'] = Decimal(s['incentive_amount'])
     return spiffs
 
 @api_router.get("/spiffs/active")
 async def get_active_spiffs(current_user: User = Depends(get_current_user)):
-    now = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
     spiffs = await db.spiffs.find({
         "status": "active",
         "start_date": {"$lte": now},
         "end_date": {"$gte": now}
     }, {"_id": 0}).to_list(100)
     
-    for s in spiffs:
-        for key in ['start_date', 'end_date', 'created_at']:
-            if isinstance(s[key], str):
-                s[key] = datetime.fromisoformat(s[key])
-        s['incentive_amount'] = Decimal(s['incentive_amount'])
     return spiffs
 
 @api_router.patch("/spiffs/{spiff_id}")
 async def update_spiff(spiff_id: str, update_data: dict, current_user: User = Depends(require_role(["admin", "finance"]))):
-    result = await db.spiffs.update_one({"id": spiff_id}, {"$set": update_data})
-    if result.modified_count == 0:
+    spiff = await db.spiffs.find_one({"id": spiff_id}, {"_id": 0})
+    if not spiff:
         raise HTTPException(status_code=404, detail="Spiff not found")
+    # Validate the merged document so dates and amounts are stored typed
+    try:
+        updated = Spiff.model_validate({**spiff, **update_data}).model_dump()
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    update_data = {k: updated[k] for k in update_data if k in updated and k not in ["id", "created_by", "created_at"]}
+    
+    await db.spiffs.update_one({"id": spiff_id}, {"$set": update_data})
+    spiff_index.upsert({**spiff, **update_data})
     await create_audit_log(current_user.id, "spiff_updated", "spiff", spiff_id, None, update_data)
+    dashboard_push.mark([], "spiffs")
     return {"message": "Spiff updated successfully"}
 
+@api_router.post("/spiffs/{spiff_id}/replay", status_code=202)
+async def replay_spiff_awards(spiff_id: str, background_tasks: BackgroundTasks, start: Optional[datetime] = None, end: Optional[datetime] = None, current_user: User = Depends(require_role(["admin", "finance"]))):
+    spiff = await db.spiffs.find_one({"id": spiff_id}, {"_id": 0})
+    if not spiff:
+        raise HTTPException(status_code=404, detail="Spiff not found")
+    if spiff['status'] != "active":
+        raise HTTPException(status_code=400, detail="Only active spiffs can be replayed")
+    if spiff.get('replay', {}).get('status') == "running":
+        raise HTTPException(status_code=409, detail="A replay of this spiff is already running")
+    
+    replay_state = {"status": "running", "start": start, "end": end, "started_at": datetime.now(timezone.utc)}
+    await db.spiffs.update_one({"id": spiff_id}, {"$set": {"replay": replay_state}})
+    background_tasks.add_task(run_spiff_replay, spiff, start, end, current_user.id)
+    return {"spiff_id": spiff_id, "status": "running"}
+
+async def run_spiff_replay(spiff: dict, start: Optional[datetime], end: Optional[datetime], user_id: str):
+    try:
+        result = await replay_spiff(db, spiff, start, end)
+    except Exception as e:
+        logger.exception("Replaying spiff %s failed", spiff['id'])
+        await db.spiffs.update_one({"id": spiff['id']}, {"$set": {"replay.status": "failed", "replay.error": str(e), "replay.finished_at": datetime.now(timezone.utc)}})
+        return
+    
+    rep_ids = result.pop('sales_rep_ids')
+    await db.spiffs.update_one({"id": spiff['id']}, {"$set": {
+        "replay.status": "completed",
+        "replay.finished_at": datetime.now(timezone.utc),
+        **{f"replay.{k}": v for k, v in result.items()}
+    }})
+    dashboard_push.mark(rep_ids, "earnings")
+    await create_audit_log(user_id, "spiff_replayed", "spiff", spiff['id'], None, result)
+
+@api_router.get("/spiffs/index")
+async def get_spiff_index_stats(current_user: User = Depends(require_role(["admin", "finance"]))):
+    return spiff_index.stats()
+
 # ============= PARTNER ENDPOINTS =============
 
 @api_router.post("/partners/register")
@@ -490,8 +812,6 @@ async def register_partner(partner_data: dict):
     )
     
     doc = partner.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
     doc['phone'] = partner_data.get('phone')
     doc['website'] = partner_data.get('website')
     doc['business_type'] = partner_data.get('business_type')
@@ -506,42 +826,26 @@ async def register_partner(partner_data: dict):
         'signed_agreement': partner_data.get('signed_agreement')
     }
     doc['review_history'] = []
-    doc['submitted_at'] = datetime.now(timezone.utc).isoformat()
+    doc['submitted_at'] = datetime.now(timezone.utc)
     
     await db.partners.insert_one(doc)
     await db.users.update_one({"id": partner.user_id}, {"$set": {"active": False}})
+    user_cache.invalidate(partner.user_id)
     await create_audit_log(partner.user_id, "partner_registered", "partner", partner.id, None, doc)
     
     return {"message": "Partner registered successfully. Pending admin approval.", "partner_id": partner.id}
 
 @api_router.get("/partners/all")
-async def get_all_partners(current_user: User = Depends(get_current_user)):
+async def get_all_partners(response: Response, current_user: User = Depends(get_current_user), limit: int = 100, cursor: Optional[str] = None, stream: bool = False):
+    query = {}
     if current_user.role == "partner":
-        partners = await db.partners.find({"user_id": current_user.id}, {"_id": 0}).to_list(10)
-    else:
-        partners = await db.partners.find({}, {"_id": 0}).to_list(1000)
-    
-    for p in partners:
-        for key in ['created_at', 'updated_at']:
-            if key in p and isinstance(p[key], str):
-                p[key] = datetime.fromisoformat(p[key])
-        if 'submitted_at' in p and isinstance(p['submitted_at'], str):
-            p['submitted_at'] = datetime.fromisoformat(p['submitted_at'])
-        if 'approved_at' in p and isinstance(p['approved_at'], str):
-            p['approved_at'] = datetime.fromisoformat(p['approved_at'])
-    return partners
+        query["user_id"] = current_user.id
+    
+    return await list_page(db.partners, query, response, limit, cursor, stream)
 
 @api_router.get("/partners/pending")
 async def get_pending_partners(current_user: User = Depends(require_role(["admin", "finance"]))):
     partners = await db.partners.find({}, {"_id": 0}).to_list(1000)
-    for p in partners:
-        for key in ['created_at', 'updated_at']:
-            if key in p and isinstance(p[key], str):
-                p[key] = datetime.fromisoformat(p[key])
-        if 'submitted_at' in p and isinstance(p['submitted_at'], str):
-            p['submitted_at'] = datetime.fromisoformat(p['submitted_at'])
-        if 'approved_at' in p and isinstance(p['approved_at'], str):
-            p['approved_at'] = datetime.fromisoformat(p['approved_at'])
     return partners
 
 @api_router.post("/partners/{partner_id}/approve")
@@ -552,10 +856,10 @@ async def approve_partner(partner_id: str, review_data: dict, current_user: User
     
     update_data = {
         "status": "approved",
-        "approved_at": datetime.now(timezone.utc).isoformat(),
+        "approved_at": datetime.now(timezone.utc),
         "approved_by": current_user.id,
         "onboarding_progress": 100,
-        "updated_at": datetime.now(timezone.utc).isoformat()
+        "updated_at": datetime.now(timezone.utc)
     }
     
     review_history = partner.get('review_history', [])
@@ -563,12 +867,13 @@ async def approve_partner(partner_id: str, review_data: dict, current_user: User
         "action": "approved",
         "comments": review_data.get('comments', ''),
         "reviewer": current_user.full_name,
-        "date": datetime.now(timezone.utc).isoformat()
+        "date": datetime.now(timezone.utc)
     })
     update_data['review_history'] = review_history
     
     await db.partners.update_one({"id": partner_id}, {"$set": update_data})
     await db.users.update_one({"id": partner['user_id']}, {"$set": {"active": True}})
+    user_cache.invalidate(partner['user_id'])
     await create_audit_log(current_user.id, "partner_approved", "partner", partner_id, partner, update_data)
     
     return {"message": "Partner approved successfully"}
@@ -582,9 +887,9 @@ async def reject_partner(partner_id: str, review_data: dict, current_user: User
     update_data = {
         "status": "rejected",
         "rejection_reason": review_data.get('reason', 'Application did not meet requirements'),
-        "rejected_at": datetime.now(timezone.utc).isoformat(),
+        "rejected_at": datetime.now(timezone.utc),
         "rejected_by": current_user.id,
-        "updated_at": datetime.now(timezone.utc).isoformat()
+        "updated_at": datetime.now(timezone.utc)
     }
     
     review_history = partner.get('review_history', [])
@@ -592,7 +897,7 @@ async def reject_partner(partner_id: str, review_data: dict, current_user: User
         "action": "rejected",
         "comments": review_data.get('reason', ''),
         "reviewer": current_user.full_name,
-        "date": datetime.now(timezone.utc).isoformat()
+        "date": datetime.now(timezone.utc)
     })
     update_data['review_history'] = review_history
     
@@ -610,7 +915,7 @@ async def request_more_info(partner_id: str, review_data: dict, current_user: Us
     update_data = {
         "status": "more_info_needed",
         "info_request": review_data.get('message', ''),
-        "updated_at": datetime.now(timezone.utc).isoformat()
+        "updated_at": datetime.now(timezone.utc)
     }
     
     review_history = partner.get('review_history', [])
@@ -618,7 +923,7 @@ async def request_more_info(partner_id: str, review_data: dict, current_user: Us
         "action": "requested_more_info",
         "comments": review_data.get('message', ''),
         "reviewer": current_user.full_name,
-        "date": datetime.now(timezone.utc).isoformat()
+        "date": datetime.now(timezone.utc)
     })
     update_data['review_history'] = review_history
     
@@ -635,7 +940,7 @@ async def update_partner(partner_id: str, update_data: dict, current_user: User
     
     allowed_fields = ['tier', 'status', 'notes']
     update_dict = {k: v for k, v in update_data.items() if k in allowed_fields}
-    update_dict['updated_at'] = datetime.now(timezone.utc).isoformat()
+    update_dict['updated_at'] = datetime.now(timezone.utc)
     
     await db.partners.update_one({"id": partner_id}, {"$set": update_dict})
     await create_audit_log(current_user.id, "partner_updated", "partner", partner_id, partner, update_dict)
@@ -651,13 +956,14 @@ async def deactivate_partner(partner_id: str, deactivate_data: dict, current_use
     update_data = {
         "status": "inactive",
         "deactivation_reason": deactivate_data.get('reason', ''),
-        "deactivated_at": datetime.now(timezone.utc).isoformat(),
+        "deactivated_at": datetime.now(timezone.utc),
         "deactivated_by": current_user.id,
-        "updated_at": datetime.now(timezone.utc).isoformat()
+        "updated_at": datetime.now(timezone.utc)
     }
     
     await db.partners.update_one({"id": partner_id}, {"$set": update_data})
     await db.users.update_one({"id": partner['user_id']}, {"$set": {"active": False}})
+    user_cache.invalidate(partner['user_id'])
     await create_audit_log(current_user.id, "partner_deactivated", "partner", partner_id, partner, update_data)
     
     return {"message": "Partner deactivated successfully"}
@@ -668,10 +974,6 @@ async def get_my_partner_info(current_user: User = Depends(get_current_user)):
     if not partner:
         raise HTTPException(status_code=404, detail="Partner profile not found")
     
-    for key in ['created_at', 'updated_at']:
-        if isinstance(partner[key], str):
-            partner[key] = datetime.fromisoformat(partner[key])
-    
     return partner
 
 # ============= APPROVAL WORKFLOW ENDPOINTS =============
@@ -680,11 +982,10 @@ async def get_my_partner_info(current_user: User = Depends(get_current_user)):
 async def create_approval_workflow(workflow_data: ApprovalWorkflowCreate, current_user: User = Depends(require_role(["admin", "finance", "manager"]))):
     workflow = ApprovalWorkflow(**workflow_data.model_dump(), initiated_by=current_user.id)
     doc = workflow.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
     
     await db.approval_workflows.insert_one(doc)
     await create_audit_log(current_user.id, "workflow_created", "workflow", workflow.id, None, doc)
+    dashboard_push.mark([s['approver_id'] for s in doc['steps']], "approvals")
     return workflow
 
 @api_router.get("/workflows")
@@ -697,10 +998,6 @@ async def list_workflows(current_user: User = Depends(get_current_user)):
         ]
     
     workflows = await db.approval_workflows.find(query, {"_id": 0}).to_list(100)
-    for w in workflows:
-        for key in ['created_at', 'updated_at']:
-            if isinstance(w[key], str):
-                w[key] = datetime.fromisoformat(w[key])
     return workflows
 
 @api_router.get("/workflows/my-approvals")
@@ -714,10 +1011,6 @@ async def get_my_pending_approvals(current_user: User = Depends(get_current_user
         }
     }, {"_id": 0}).to_list(100)
     
-    for w in workflows:
-        for key in ['created_at', 'updated_at']:
-            if isinstance(w[key], str):
-                w[key] = datetime.fromisoformat(w[key])
     return workflows
 
 @api_router.post("/workflows/{workflow_id}/approve")
@@ -733,7 +1026,7 @@ async def approve_workflow_step(workflow_id: str, step_data: dict, current_user:
     for step in workflow['steps']:
         if step['step_number'] == step_number and step['approver_id'] == current_user.id:
             step['status'] = 'approved'
-            step['timestamp'] = datetime.now(timezone.utc).isoformat()
+            step['timestamp'] = datetime.now(timezone.utc)
             step['comments'] = comments
             updated = True
             break
@@ -747,10 +1040,11 @@ async def approve_workflow_step(workflow_id: str, step_data: dict, current_user:
     
     await db.approval_workflows.update_one(
         {"id": workflow_id},
-        {"$set": {"steps": workflow['steps'], "status": workflow['status'], "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"steps": workflow['steps'], "status": workflow['status'], "updated_at": datetime.now(timezone.utc)}}
     )
     
     await create_audit_log(current_user.id, "workflow_approved", "workflow", workflow_id, None, {"step": step_number})
+    dashboard_push.mark([s['approver_id'] for s in workflow['steps']], "approvals")
     return {"message": "Step approved", "workflow_status": workflow['status']}
 
 @api_router.post("/workflows/{workflow_id}/reject")
@@ -765,7 +1059,7 @@ async def reject_workflow(workflow_id: str, rejection_data: dict, current_user:
     for step in workflow['steps']:
         if step['step_number'] == step_number and step['approver_id'] == current_user.id:
             step['status'] = 'rejected'
-            step['timestamp'] = datetime.now(timezone.utc).isoformat()
+            step['timestamp'] = datetime.now(timezone.utc)
             step['comments'] = comments
             break
     
@@ -773,10 +1067,11 @@ async def reject_workflow(workflow_id: str, rejection_data: dict, current_user:
     
     await db.approval_workflows.update_one(
         {"id": workflow_id},
-        {"$set": {"steps": workflow['steps'], "status": "rejected", "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"steps": workflow['steps'], "status": "rejected", "updated_at": datetime.now(timezone.utc)}}
     )
     
     await create_audit_log(current_user.id, "workflow_rejected", "workflow", workflow_id, None, {"step": step_number})
+    dashboard_push.mark([s['approver_id'] for s in workflow['steps']], "approvals")
     return {"message": "Workflow rejected"}
 
 @api_router.post("/workflows/{workflow_id}/recall")
@@ -790,90 +1085,255 @@ async def recall_workflow(workflow_id: str, current_user: User = Depends(get_cur
     
     await db.approval_workflows.update_one(
         {"id": workflow_id},
-        {"$set": {"status": "recalled", "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"status": "recalled", "updated_at": datetime.now(timezone.utc)}}
     )
     
     await create_audit_log(current_user.id, "workflow_recalled", "workflow", workflow_id, None, None)
+    dashboard_push.mark([s['approver_id'] for s in workflow['steps']], "approvals")
     return {"message": "Workflow recalled"}
 
 # ============= PAYOUT ENDPOINTS =============
 
 @api_router.post("/payouts")
 async def create_payout(payout_data: PayoutCreate, current_user: User = Depends(require_role(["admin", "finance"]))):
-    calculations = await db.commission_calculations.find({
-        "sales_rep_id": payout_data.user_id,
-        "calculation_date": {
-            "$gte": payout_data.payout_period_start.isoformat(),
-            "$lte": payout_data.payout_period_end.isoformat()
-        },
-        "status": "approved"
-    }, {"_id": 0}).to_list(1000)
-    
-    total_commission = sum(Decimal(c['final_amount']) for c in calculations)
-    
-    payout = Payout(
-        **payout_data.model_dump(),
-        total_commission=total_commission,
-        net_payout=total_commission
-    )
+    payout = Payout(**payout_data.model_dump())
+    if payout.currency and payout.currency != BASE_CURRENCY:
+        try:
+            payout.fx_rate = fx_rates.rate(BASE_CURRENCY, payout.currency, payout.payout_period_end)
+        except FXRateMissing as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    # Claim the calculations first, so neither a payout run nor another payout can pay them again
+    await db.commission_calculations.update_many({
+        "sales_rep_id": payout.user_id,
+        "calculation_date": {"$gte": payout.payout_period_start, "$lte": payout.payout_period_end},
+        "status": "approved",
+        "payout_run_id": None,
+        "payout_id": None
+    }, {"$set": {"payout_id": payout.id}})
+    totals = await db.commission_calculations.aggregate([
+        {"$match": {"payout_id": payout.id}},
+        {"$group": {"_id": None, "total_commission": {"$sum": "$final_amount"}, "calculation_count": {"$sum": 1}}}
+    ]).to_list(1)
+    
+    payout.total_commission = payout.net_payout = Decimal(totals[0]['total_commission']) if totals else Decimal("0")
+    payout.calculation_count = totals[0]['calculation_count'] if totals else 0
+    if payout.fx_rate is not None:
+        payout.payout_amount, _ = fx_rates.convert(payout.net_payout, BASE_CURRENCY, payout.currency, payout.payout_period_end)
     
     doc = payout.model_dump()
-    doc['payout_period_start'] = doc['payout_period_start'].isoformat()
-    doc['payout_period_end'] = doc['payout_period_end'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
-    for key in ['total_commission', 'adjustments', 'deductions', 'net_payout']:
-        doc[key] = str(doc[key])
     
     await db.payouts.insert_one(doc)
     await create_audit_log(current_user.id, "payout_created", "payout", payout.id, None, doc)
     return payout
 
+@api_router.post("/payouts/runs", status_code=202)
+async def create_payout_run(run_data: PayoutRunCreate, background_tasks: BackgroundTasks, current_user: User = Depends(require_role(["admin", "finance"]))):
+    if run_data.payout_period_end < run_data.payout_period_start:
+        raise HTTPException(status_code=400, detail="Payout period ends before it starts")
+    
+    run = new_run(run_data.payout_period_start, run_data.payout_period_end, run_data.adjustments, run_data.deductions, current_user.id,
+                  currencies={user_id: code for user_id, code in run_data.currencies.items() if code != BASE_CURRENCY})
+    try:
+        await db.payout_runs.insert_one(dict(run))
+        await create_audit_log(current_user.id, "payout_run_created", "payout_run", run['id'], None, run)
+    except DuplicateKeyError:
+        # One run per period: hand back the existing one, resuming it if it stalled
+        run = await db.payout_runs.find_one({"period_start": run['period_start'], "period_end": run['period_end']}, {"_id": 0})
+    
+    if run['status'] != "completed":
+        background_tasks.add_task(run_payout, run['id'])
+    return {k: run[k] for k in ["id", "status", "phase", "period_start", "period_end"]}
+
+async def run_payout(run_id: str):
+    run = await acquire_payout_run(db.payout_runs, run_id)
+    if not run:
+        # Finished, or another worker holds the lease
+        return
+    run = await execute_payout_run(db, run, fx=fx_rates)
+    if run['status'] == "completed":
+        paid = await db.payouts.distinct("user_id", {"payout_run_id": run_id})
+        dashboard_push.mark(paid, "earnings")
+        for user_id in paid:
+            await manager.send_personal_message({"type": "payout_created", "payout_run_id": run_id}, user_id)
+
+@api_router.get("/payouts/runs")
+async def list_payout_runs(current_user: User = Depends(require_role(["admin", "finance"]))):
+    return await db.payout_runs.find({}, {"_id": 0}).sort("period_start", -1).to_list(100)
+
+@api_router.get("/payouts/runs/{run_id}")
+async def get_payout_run(run_id: str, current_user: User = Depends(require_role(["admin", "finance"]))):
+    run = await db.payout_runs.find_one({"id": run_id}, {"_id": 0})
+    if not run:
+        raise HTTPException(status_code=404, detail="Payout run not found")
+    return run
+
+@api_router.post("/reconciliations", status_code=202)
+async def create_reconciliation(reconciliation_data: ReconciliationCreate, background_tasks: BackgroundTasks, current_user: User = Depends(require_role(["admin", "finance"]))):
+    if reconciliation_data.period_end < reconciliation_data.period_start:
+        raise HTTPException(status_code=400, detail="Reconciliation period ends before it starts")
+    
+    reconciliation = new_reconciliation(reconciliation_data.period_start, reconciliation_data.period_end, current_user.id)
+    await db.reconciliations.insert_one(dict(reconciliation))
+    await create_audit_log(current_user.id, "reconciliation_created", "reconciliation", reconciliation['id'], None, reconciliation)
+    background_tasks.add_task(run_reconciliation, reconciliation['id'])
+    return {k: reconciliation[k] for k in ["id", "status", "period_start", "period_end"]}
+
+@api_router.post("/reconciliations/{reconciliation_id}/resume", status_code=202)
+async def resume_reconciliation(reconciliation_id: str, background_tasks: BackgroundTasks, current_user: User = Depends(require_role(["admin", "finance"]))):
+    reconciliation = await db.reconciliations.find_one({"id": reconciliation_id}, {"_id": 0, "id": 1, "status": 1, "cursor": 1, "payees_done": 1})
+    if not reconciliation:
+        raise HTTPException(status_code=404, detail="Reconciliation not found")
+    if reconciliation['status'] != "completed":
+        background_tasks.add_task(run_reconciliation, reconciliation_id)
+    return reconciliation
+
+async def run_reconciliation(reconciliation_id: str):
+    # Same lease as payout runs: a stalled reconciliation is picked up from its checkpoint
+    reconciliation = await acquire_payout_run(db.reconciliations, reconciliation_id)
+    if reconciliation:
+        await execute_reconciliation(db, reconciliation)
+
+@api_router.get("/reconciliations")
+async def list_reconciliations(current_user: User = Depends(require_role(["admin", "finance"]))):
+    return await db.reconciliations.find({}, {"_id": 0}).sort("created_at", -1).to_list(100)
+
+@api_router.get("/reconciliations/{reconciliation_id}")
+async def get_reconciliation(reconciliation_id: str, current_user: User = Depends(require_role(["admin", "finance"]))):
+    reconciliation = await db.reconciliations.find_one({"id": reconciliation_id}, {"_id": 0})
+    if not reconciliation:
+        raise HTTPException(status_code=404, detail="Reconciliation not found")
+    return reconciliation
+
+@api_router.get("/reconciliations/{reconciliation_id}/findings")
+async def list_reconciliation_findings(reconciliation_id: str, response: Response, kind: Optional[str] = None, limit: int = 100, cursor: Optional[str] = None, stream: bool = False, current_user: User = Depends(require_role(["admin", "finance"]))):
+    query = {"reconciliation_id": reconciliation_id}
+    if kind:
+        query["kind"] = kind
+    return await list_page(db.reconciliation_findings, query, response, limit, cursor, stream)
+
 @api_router.get("/payouts")
-async def list_payouts(current_user: User = Depends(get_current_user)):
+async def list_payouts(response: Response, current_user: User = Depends(get_current_user), limit: int = 100, cursor: Optional[str] = None, stream: bool = False):
     query = {}
     if current_user.role in ["rep", "partner"]:
         query["user_id"] = current_user.id
     
-    payouts = await db.payouts.find(query, {"_id": 0}).to_list(100)
-    for p in payouts:
-        for key in ['payout_period_start', 'payout_period_end', 'created_at']:
-            if isinstance(p[key], str):
-                p[key] = datetime.fromisoformat(p[key])
-        if p.get('processed_at') and isinstance(p['processed_at'], str):
-            p['processed_at'] = datetime.fromisoformat(p['processed_at'])
-        for key in ['total_commission', 'adjustments', 'deductions', 'net_payout']:
-            p[key] = Decimal(p[key])
-    return payouts
+    return await list_page(db.payouts, query, response, limit, cursor, stream)
 
 @api_router.get("/payouts/my-payouts")
 async def get_my_payouts(current_user: User = Depends(get_current_user)):
     payouts = await db.payouts.find({"user_id": current_user.id}, {"_id": 0}).to_list(100)
-    for p in payouts:
-        for key in ['payout_period_start', 'payout_period_end', 'created_at']:
-            if isinstance(p[key], str):
-                p[key] = datetime.fromisoformat(p[key])
-        if p.get('processed_at') and isinstance(p['processed_at'], str):
-            p['processed_at'] = datetime.fromisoformat(p['processed_at'])
-        for key in ['total_commission', 'adjustments', 'deductions', 'net_payout']:
-            p[key] = Decimal(p[key])
     return payouts
 
 @api_router.post("/payouts/{payout_id}/approve")
 async def approve_payout(payout_id: str, current_user: User = Depends(require_role(["admin", "finance"]))):
     await db.payouts.update_one(
         {"id": payout_id},
-        {"$set": {"status": "approved", "processed_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"status": "approved", "processed_at": datetime.now(timezone.utc)}}
     )
     await create_audit_log(current_user.id, "payout_approved", "payout", payout_id, None, None)
     return {"message": "Payout approved"}
 
+EXPORT_SPOOL_DIR = Path(os.environ.get('EXPORT_SPOOL_DIR', ROOT_DIR / 'export_spool'))
+PAYOUT_CURRENCY = os.environ.get('PAYOUT_CURRENCY', BASE_CURRENCY)
+PAYOUT_DEBTOR_NAME = os.environ.get('PAYOUT_DEBTOR_NAME', 'Commission Payments')
+
+PAYOUT_LINE_COLUMNS = ["calculation_id", "transaction_id", "sales_rep_id", "plan_id", "calculation_date", "base_amount",
+                       "commission_amount", "adjustments", "final_amount", "status"]
+PAYOUT_COLUMNS = ["payout_id", "user_id", "full_name", "email", "payout_period_start", "payout_period_end", "calculation_count",
+                  "total_commission", "adjustments", "deductions", "net_payout", "currency", "fx_rate", "payout_amount", "status"]
+
+async def payout_line_rows(payout: dict):
+    query = {"payout_id": payout['id']}
+    if not payout.get('payout_run_id') and not await db.commission_calculations.find_one(query, {"_id": 1}):
+        # Manual payouts made before payouts claimed their calculations
+        query = {
+            "sales_rep_id": payout['user_id'],
+            "calculation_date": {"$gte": payout['payout_period_start'], "$lte": payout['payout_period_end']},
+            "status": "approved",
+            "payout_run_id": None
+        }
+    async for calculation in db.commission_calculations.find(query, {"_id": 0}).sort("calculation_date", 1).batch_size(1000):
+        calculation['calculation_id'] = calculation.pop('id')
+        yield calculation
+
+def payout_pipeline(match: dict) -> list:
+    return [
+        {"$match": match},
+        {"$sort": {"user_id": 1}},
+        {"$lookup": {"from": "users", "localField": "user_id", "foreignField": "id", "as": "payee"}},
+        {"$set": {"payout_id": "$id", "full_name": {"$arrayElemAt": ["$payee.full_name", 0]}, "email": {"$arrayElemAt": ["$payee.email", 0]}}},
+        {"$project": {"_id": 0, "payee": 0}}
+    ]
+
+async def payout_rows(match: dict):
+    async for payout in db.payouts.aggregate(payout_pipeline(match), allowDiskUse=True, batchSize=1000):
+        yield payout
+
+async def deliver_export(name: str, fmt: str, spool: bool, kind: str, source_id: str, user_id: str, columns: list, rows, bank_match: Optional[dict] = None):
+    """Stream an export, or spool it with a checksum (XLSX is always built on disk first)."""
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Format must be one of: {', '.join(EXPORT_FORMATS)}")
+    
+    chunks = None
+    if fmt == "csv":
+        chunks = csv_chunks(rows, columns)
+    elif fmt == "xml":
+        # The bank file pays the positive payouts; its header needs their count and sum up front
+        match = {**bank_match, "net_payout": {"$gt": Decimal("0")}}
+        totals = await db.payouts.aggregate([
+            {"$match": match},
+            {"$group": {"_id": None, "count": {"$sum": 1}, "total": {"$sum": {"$ifNull": ["$payout_amount", "$net_payout"]}}}}
+        ]).to_list(1)
+        count, total = (totals[0]['count'], totals[0]['total']) if totals else (0, Decimal("0"))
+        chunks = payment_xml_chunks(payout_rows(match), f"{name}-{source_id[:8]}", count, total, PAYOUT_CURRENCY, PAYOUT_DEBTOR_NAME)
+    
+    if not spool and fmt != "xlsx":
+        return StreamingResponse(chunks, media_type=EXPORT_MEDIA_TYPES[fmt],
+                                 headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'})
+    
+    record = await spool_export(EXPORT_SPOOL_DIR, name, fmt, chunks=chunks, rows=rows, columns=columns)
+    record.update(kind=kind, source_id=source_id, created_by=user_id)
+    await db.exports.insert_one(dict(record))
+    await create_audit_log(user_id, "export_created", kind, source_id, None, {k: record[k] for k in ["id", "filename", "sha256"]})
+    if spool:
+        return {k: v for k, v in record.items() if k != "path"}
+    return export_download(record)
+
+def export_download(record: dict) -> StreamingResponse:
+    return StreamingResponse(file_chunks(Path(record['path'])), media_type=EXPORT_MEDIA_TYPES[record['format']], headers={
+        "Content-Disposition": f'attachment; filename="{record["filename"]}"',
+        "Content-Length": str(record['size_bytes']),
+        "X-Checksum-SHA256": record['sha256']
+    })
+
 @api_router.get("/payouts/{payout_id}/export")
-async def export_payout(payout_id: str, format: str = "csv", current_user: User = Depends(require_role(["admin", "finance"]))):
+async def export_payout(payout_id: str, format: str = "csv", spool: bool = False, current_user: User = Depends(require_role(["admin", "finance"]))):
     payout = await db.payouts.find_one({"id": payout_id}, {"_id": 0})
     if not payout:
         raise HTTPException(status_code=404, detail="Payout not found")
     
-    return {"message": f"Payout export in {format} format", "data": payout}
+    # CSV/XLSX list the payout's calculation lines; XML is the bank transfer for the payout itself
+    return await deliver_export(f"payout-{payout_id[:8]}", format, spool, "payout", payout_id, current_user.id,
+                                PAYOUT_LINE_COLUMNS, payout_line_rows(payout), bank_match={"id": payout_id})
+
+@api_router.get("/payouts/runs/{run_id}/export")
+async def export_payout_run(run_id: str, format: str = "csv", spool: bool = False, current_user: User = Depends(require_role(["admin", "finance"]))):
+    run = await db.payout_runs.find_one({"id": run_id}, {"_id": 0, "status": 1, "period_start": 1})
+    if not run:
+        raise HTTPException(status_code=404, detail="Payout run not found")
+    if run['status'] != "completed":
+        raise HTTPException(status_code=409, detail="Payout run has not completed")
+    
+    return await deliver_export(f"payout-run-{run['period_start']:%Y%m%d}", format, spool, "payout_run", run_id, current_user.id,
+                                PAYOUT_COLUMNS, payout_rows({"payout_run_id": run_id}), bank_match={"payout_run_id": run_id})
+
+@api_router.get("/exports/{export_id}/download")
+async def download_export(export_id: str, current_user: User = Depends(require_role(["admin", "finance"]))):
+    record = await db.exports.find_one({"id": export_id}, {"_id": 0})
+    if not record or not Path(record['path']).exists():
+        raise HTTPException(status_code=404, detail="Export not found")
+    return export_download(record)
 
 # ============= TERRITORY ENDPOINTS =============
 
@@ -881,9 +1341,6 @@ async def export_payout(payout_id: str, format: str = "csv", current_user: User
 async def create_territory(territory_data: TerritoryCreate, current_user: User = Depends(require_role(["admin", "manager"]))):
     territory = Territory(**territory_data.model_dump())
     doc = territory.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
-    doc['account_potential'] = str(doc['account_potential'])
     
     await db.territories.insert_one(doc)
     await create_audit_log(current_user.id, "territory_created", "territory", territory.id, None, doc)
@@ -892,16 +1349,11 @@ async def create_territory(territory_data: TerritoryCreate, current_user: User =
 @api_router.get("/territories")
 async def list_territories(current_user: User = Depends(get_current_user)):
     territories = await db.territories.find({}, {"_id": 0}).to_list(100)
-    for t in territories:
-        for key in ['created_at', 'updated_at']:
-            if isinstance(t[key], str):
-                t[key] = datetime.fromisoformat(t[key])
-        t['account_potential'] = Decimal(t['account_potential'])
     return territories
 
 @api_router.patch("/territories/{territory_id}")
 async def update_territory(territory_id: str, update_data: dict, current_user: User = Depends(require_role(["admin", "manager"]))):
-    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
+    update_data['updated_at'] = datetime.now(timezone.utc)
     result = await db.territories.update_one({"id": territory_id}, {"$set": update_data})
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Territory not found")
@@ -913,7 +1365,7 @@ async def assign_territory(territory_id: str, assignment_data: dict, current_use
     rep_id = assignment_data.get('rep_id')
     await db.territories.update_one(
         {"id": territory_id},
-        {"$set": {"assigned_rep_id": rep_id, "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"assigned_rep_id": rep_id, "updated_at": datetime.now(timezone.utc)}}
     )
     await create_audit_log(current_user.id, "territory_assigned", "territory", territory_id, None, {"rep_id": rep_id})
     return {"message": "Territory assigned"}
@@ -924,16 +1376,13 @@ async def assign_territory(territory_id: str, assignment_data: dict, current_use
 async def create_quota(quota_data: QuotaCreate, current_user: User = Depends(require_role(["admin", "manager"]))):
     quota = Quota(**quota_data.model_dump())
     doc = quota.model_dump()
-    doc['period_start'] = doc['period_start'].isoformat()
-    doc['period_end'] = doc['period_end'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
-    for key in ['quota_amount', 'current_attainment', 'attainment_percent']:
-        doc[key] = str(doc[key])
     
     await db.quotas.insert_one(doc)
     await create_audit_log(current_user.id, "quota_created", "quota", quota.id, None, doc)
-    return quota
+    # Credit whatever was already sold in the period
+    await attainment_reconciler.run_once(db, [quota.id])
+    dashboard_push.mark([quota.user_id], "quota")
+    return await db.quotas.find_one({"id": quota.id}, {"_id": 0})
 
 @api_router.get("/quotas")
 async def list_quotas(current_user: User = Depends(get_current_user)):
@@ -942,12 +1391,6 @@ async def list_quotas(current_user: User = Depends(get_current_user)):
         query["user_id"] = current_user.id
     
     quotas = await db.quotas.find(query, {"_id": 0}).to_list(100)
-    for q in quotas:
-        for key in ['period_start', 'period_end', 'created_at', 'updated_at']:
-            if isinstance(q[key], str):
-                q[key] = datetime.fromisoformat(q[key])
-        for key in ['quota_amount', 'current_attainment', 'attainment_percent']:
-            q[key] = Decimal(q[key])
     return quotas
 
 @api_router.get("/quotas/my-quota")
@@ -955,21 +1398,27 @@ async def get_my_quota(current_user: User = Depends(get_current_user)):
     quota = await db.quotas.find_one({"user_id": current_user.id, "status": "active"}, {"_id": 0})
     if not quota:
         return {"message": "No active quota found"}
-    
-    for key in ['period_start', 'period_end', 'created_at', 'updated_at']:
-        if isinstance(quota[key], str):
-            quota[key] = datetime.fromisoformat(quota[key])
-    for key in ['quota_amount', 'current_attainment', 'attainment_percent']:
-        quota[key] = Decimal(quota[key])
     return quota
 
+# Changing any of these changes what the quota is credited with
+ATTAINMENT_FIELDS = {"user_id", "period_start", "period_end", "quota_amount", "quota_type", "status"}
+
+@api_router.post("/quotas/reconcile")
+async def reconcile_quota_attainment(current_user: User = Depends(require_role(["admin"]))):
+    report = await attainment_reconciler.run_once(db)
+    await create_audit_log(current_user.id, "quota_attainment_reconciled", "quota", "all", None, {k: report[k] for k in ["quotas", "corrected"]})
+    return report
+
 @api_router.patch("/quotas/{quota_id}")
 async def update_quota(quota_id: str, update_data: dict, current_user: User = Depends(require_role(["admin", "manager"]))):
-    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
-    result = await db.quotas.update_one({"id": quota_id}, {"$set": update_data})
-    if result.modified_count == 0:
+    update_data['updated_at'] = datetime.now(timezone.utc)
+    quota = await db.quotas.find_one_and_update({"id": quota_id}, {"$set": update_data}, {"_id": 0, "user_id": 1})
+    if not quota:
         raise HTTPException(status_code=404, detail="Quota not found")
     await create_audit_log(current_user.id, "quota_updated", "quota", quota_id, None, update_data)
+    if ATTAINMENT_FIELDS & update_data.keys():
+        await attainment_reconciler.run_once(db, [quota_id])
+    dashboard_push.mark([quota['user_id']], "quota")
     return {"message": "Quota updated"}
 
 @api_router.post("/quotas/bulk-import")
@@ -982,6 +1431,8 @@ async def bulk_import_quotas(file: UploadFile = File(...), current_user: User =
     reader = csv.DictReader(csv_file)
     
     quotas_created = 0
+    quota_users = set()
+    quota_ids = []
     for row in reader:
         try:
             quota = Quota(
@@ -993,17 +1444,16 @@ async def bulk_import_quotas(file: UploadFile = File(...), current_user: User =
                 assignment_method=row['assignment_method']
             )
             doc = quota.model_dump()
-            doc['period_start'] = doc['period_start'].isoformat()
-            doc['period_end'] = doc['period_end'].isoformat()
-            doc['created_at'] = doc['created_at'].isoformat()
-            doc['updated_at'] = doc['updated_at'].isoformat()
-            for key in ['quota_amount', 'current_attainment', 'attainment_percent']:
-                doc[key] = str(doc[key])
             await db.quotas.insert_one(doc)
             quotas_created += 1
+            quota_users.add(quota.user_id)
+            quota_ids.append(quota.id)
         except:
             pass
     
+    if quota_ids:
+        await attainment_reconciler.run_once(db, quota_ids)
+    dashboard_push.mark(quota_users, "quota")
     return {"quotas_created": quotas_created}
 
 # ============= FORECAST ENDPOINTS =============
@@ -1019,11 +1469,6 @@ async def create_forecast(forecast_data: ForecastCreate, current_user: User = De
     )
     
     doc = forecast.model_dump()
-    doc['period_start'] = doc['period_start'].isoformat()
-    doc['period_end'] = doc['period_end'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
-    for key in ['projected_revenue', 'projected_payout', 'projected_cos_percent', 'variance_from_current']:
-        doc[key] = str(doc[key])
     
     await db.forecasts.insert_one(doc)
     await create_audit_log(current_user.id, "forecast_created", "forecast", forecast.id, None, doc)
@@ -1032,12 +1477,6 @@ async def create_forecast(forecast_data: ForecastCreate, current_user: User = De
 @api_router.get("/forecasts")
 async def list_forecasts(current_user: User = Depends(require_role(["admin", "finance"]))):
     forecasts = await db.forecasts.find({}, {"_id": 0}).to_list(100)
-    for f in forecasts:
-        for key in ['period_start', 'period_end', 'created_at']:
-            if isinstance(f[key], str):
-                f[key] = datetime.fromisoformat(f[key])
-        for key in ['projected_revenue', 'projected_payout', 'projected_cos_percent', 'variance_from_current']:
-            f[key] = Decimal(f[key])
     return forecasts
 
 @api_router.get("/forecasts/scenarios")
@@ -1057,10 +1496,10 @@ async def create_ticket(ticket_data: TicketCreate, current_user: User = Depends(
     ticket = Ticket(**ticket_data.model_dump(), submitted_by=current_user.id, sla_hours=sla_hours)
     
     doc = ticket.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     
     await db.tickets.insert_one(doc)
     await create_audit_log(current_user.id, "ticket_created", "ticket", ticket.id, None, doc)
+    dashboard_push.mark([current_user.id], "tickets")
     return ticket
 
 @api_router.get("/tickets")
@@ -1071,9 +1510,6 @@ async def list_tickets(current_user: User = Depends(get_current_user)):
     
     tickets = await db.tickets.find(query, {"_id": 0}).to_list(100)
     for t in tickets:
-        t['created_at'] = datetime.fromisoformat(t['created_at'])
-        if t.get('resolved_at') and isinstance(t['resolved_at'], str):
-            t['resolved_at'] = datetime.fromisoformat(t['resolved_at'])
         t['sla_breach'] = check_sla_breach(t['created_at'], t['sla_hours'])
     return tickets
 
@@ -1081,36 +1517,40 @@ async def list_tickets(current_user: User = Depends(get_current_user)):
 async def get_my_tickets(current_user: User = Depends(get_current_user)):
     tickets = await db.tickets.find({"submitted_by": current_user.id}, {"_id": 0}).to_list(100)
     for t in tickets:
-        t['created_at'] = datetime.fromisoformat(t['created_at'])
-        if t.get('resolved_at') and isinstance(t['resolved_at'], str):
-            t['resolved_at'] = datetime.fromisoformat(t['resolved_at'])
         t['sla_breach'] = check_sla_breach(t['created_at'], t['sla_hours'])
     return tickets
 
 @api_router.patch("/tickets/{ticket_id}")
 async def update_ticket(ticket_id: str, update_data: dict, current_user: User = Depends(get_current_user)):
-    result = await db.tickets.update_one({"id": ticket_id}, {"$set": update_data})
-    if result.modified_count == 0:
+    ticket = await db.tickets.find_one_and_update({"id": ticket_id}, {"$set": update_data}, {"_id": 0, "submitted_by": 1})
+    if not ticket:
         raise HTTPException(status_code=404, detail="Ticket not found")
     await create_audit_log(current_user.id, "ticket_updated", "ticket", ticket_id, None, update_data)
+    dashboard_push.mark([ticket['submitted_by']], "tickets")
     return {"message": "Ticket updated"}
 
 @api_router.post("/tickets/{ticket_id}/assign")
 async def assign_ticket(ticket_id: str, assignment_data: dict, current_user: User = Depends(require_role(["admin", "manager"]))):
     assigned_to = assignment_data.get('assigned_to')
-    await db.tickets.update_one(
+    ticket = await db.tickets.find_one_and_update(
         {"id": ticket_id},
-        {"$set": {"assigned_to": assigned_to, "status": "assigned"}}
+        {"$set": {"assigned_to": assigned_to, "status": "assigned"}},
+        {"_id": 0, "submitted_by": 1}
     )
+    if ticket:
+        dashboard_push.mark([ticket['submitted_by']], "tickets")
     await create_audit_log(current_user.id, "ticket_assigned", "ticket", ticket_id, None, {"assigned_to": assigned_to})
     return {"message": "Ticket assigned"}
 
 @api_router.post("/tickets/{ticket_id}/resolve")
 async def resolve_ticket(ticket_id: str, resolution_data: dict, current_user: User = Depends(get_current_user)):
-    await db.tickets.update_one(
+    ticket = await db.tickets.find_one_and_update(
         {"id": ticket_id},
-        {"$set": {"status": "resolved", "resolved_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"status": "resolved", "resolved_at": datetime.now(timezone.utc)}},
+        {"_id": 0, "submitted_by": 1}
     )
+    if ticket:
+        dashboard_push.mark([ticket['submitted_by']], "tickets")
     await create_audit_log(current_user.id, "ticket_resolved", "ticket", ticket_id, None, resolution_data)
     return {"message": "Ticket resolved"}
 
@@ -1120,7 +1560,7 @@ async def add_ticket_comment(ticket_id: str, comment_data: dict, current_user: U
         "user_id": current_user.id,
         "user_name": current_user.full_name,
         "comment": comment_data.get('comment'),
-        "timestamp": datetime.now(timezone.utc).isoformat()
+        "timestamp": datetime.now(timezone.utc)
     }
     
     await db.tickets.update_one(
@@ -1135,15 +1575,9 @@ async def add_ticket_comment(ticket_id: str, comment_data: dict, current_user: U
 async def create_nfm(nfm_data: NFMCreate, current_user: User = Depends(require_role(["admin", "manager"]))):
     nfm = NFM(**nfm_data.model_dump())
     doc = nfm.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    for key in ['target_value', 'actual_value']:
-        doc[key] = str(doc[key])
-    if doc.get('multiplier_effect'):
-        doc['multiplier_effect'] = str(doc['multiplier_effect'])
-    if doc.get('threshold_requirement'):
-        doc['threshold_requirement'] = str(doc['threshold_requirement'])
     
     await db.nfms.insert_one(doc)
+    nfm_cache.invalidate(nfm.user_id)
     await create_audit_log(current_user.id, "nfm_created", "nfm", nfm.id, None, doc)
     return nfm
 
@@ -1154,88 +1588,119 @@ async def list_nfms(current_user: User = Depends(get_current_user)):
         query["user_id"] = current_user.id
     
     nfms = await db.nfms.find(query, {"_id": 0}).to_list(100)
-    for n in nfms:
-        if isinstance(n['created_at'], str):
-            n['created_at'] = datetime.fromisoformat(n['created_at'])
-        for key in ['target_value', 'actual_value']:
-            n[key] = Decimal(n[key])
-        if n.get('multiplier_effect'):
-            n['multiplier_effect'] = Decimal(n['multiplier_effect'])
-        if n.get('threshold_requirement'):
-            n['threshold_requirement'] = Decimal(n['threshold_requirement'])
     return nfms
 
 @api_router.patch("/nfms/{nfm_id}")
 async def update_nfm(nfm_id: str, update_data: dict, current_user: User = Depends(require_role(["admin", "manager"]))):
-    result = await db.nfms.update_one({"id": nfm_id}, {"$set": update_data})
-    if result.modified_count == 0:
+    nfm = await db.nfms.find_one({"id": nfm_id}, {"_id": 0})
+    if not nfm:
         raise HTTPException(status_code=404, detail="NFM not found")
+    # Validate the merged document so values used in calculation stay Decimal
+    try:
+        updated = NFM.model_validate({**nfm, **update_data}).model_dump()
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    update_data = {k: updated[k] for k in update_data if k in updated and k not in ["id", "created_at"]}
+    
+    await db.nfms.update_one({"id": nfm_id}, {"$set": update_data})
+    nfm_cache.invalidate(nfm['user_id'])
+    nfm_cache.invalidate(updated['user_id'])
     await create_audit_log(current_user.id, "nfm_updated", "nfm", nfm_id, None, update_data)
     return {"message": "NFM updated"}
 
+@api_router.get("/nfms/compliance")
+async def get_nfm_compliance(user_id: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    if current_user.role in ["rep", "partner"] or not user_id:
+        user_id = current_user.id
+    profile = (await nfm_cache.get_many(db.nfms, [user_id]))[user_id]
+    return {"user_id": user_id, **profile}
+
+@api_router.get("/nfms/cache")
+async def get_nfm_cache_stats(current_user: User = Depends(require_role(["admin"]))):
+    return nfm_cache.stats()
+
 # ============= ANALYTICS & DASHBOARD ENDPOINTS =============
 
-@api_router.get("/analytics/dashboard")
-async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
-    # Get user-specific stats
-    total_earnings = Decimal("0")
-    calculations = await db.commission_calculations.find({"sales_rep_id": current_user.id}, {"_id": 0}).to_list(1000)
-    if calculations:
-        total_earnings = sum(Decimal(c['final_amount']) for c in calculations)
-    
-    # Get quota attainment
-    quota = await db.quotas.find_one({"user_id": current_user.id, "status": "active"}, {"_id": 0})
-    quota_attainment = Decimal("0")
-    if quota:
-        quota_attainment = Decimal(quota['attainment_percent'])
-    
-    # Get active spiffs
-    now = datetime.now(timezone.utc).isoformat()
-    active_spiffs_count = await db.spiffs.count_documents({
-        "status": "active",
-        "start_date": {"$lte": now},
-        "end_date": {"$gte": now}
-    })
+APPROVER_ROLES = ["admin", "finance", "manager"]
+
+async def dashboard_section(section: str, user_id: Optional[str], period: str = "all", role: Optional[str] = None) -> dict:
+    """Compute one dashboard section; spiffs are the same for every user."""
+    if section == "earnings":
+        match = earnings_match(period, sales_rep_id=user_id)
+        total_earnings = await get_rep_earnings(user_id, period)
+        calculations = await db.commission_calculations.find(match, {"_id": 0}).sort("calculation_date", -1).limit(10).to_list(10)
+        return {"total_earnings": str(total_earnings), "recent_calculations": calculations}
+    
+    if section == "quota":
+        quota = await db.quotas.find_one({"user_id": user_id, "status": "active"}, {"_id": 0, "attainment_percent": 1})
+        return {"quota_attainment": str(quota['attainment_percent'] if quota else Decimal("0"))}
+    
+    if section == "spiffs":
+        now = datetime.now(timezone.utc)
+        active_spiffs_count = await db.spiffs.count_documents({
+            "status": "active",
+            "start_date": {"$lte": now},
+            "end_date": {"$gte": now}
+        })
+        return {"active_spiffs": active_spiffs_count}
     
-    # Get pending approvals count
-    pending_approvals = 0
-    if current_user.role in ["admin", "finance", "manager"]:
+    if section == "approvals":
+        if role not in APPROVER_ROLES:
+            return {"pending_approvals": 0}
         pending_approvals = await db.approval_workflows.count_documents({
             "steps": {
                 "$elemMatch": {
-                    "approver_id": current_user.id,
+                    "approver_id": user_id,
                     "status": "pending"
                 }
             }
         })
+        return {"pending_approvals": pending_approvals}
     
-    # Get open tickets
     open_tickets = await db.tickets.count_documents({
-        "submitted_by": current_user.id,
+        "submitted_by": user_id,
         "status": {"$in": ["new", "assigned", "investigating"]}
     })
-    
-    return {
-        "total_earnings": str(total_earnings),
-        "quota_attainment": str(quota_attainment),
-        "active_spiffs": active_spiffs_count,
-        "pending_approvals": pending_approvals,
-        "open_tickets": open_tickets,
-        "recent_calculations": calculations[:10] if calculations else []
-    }
+    return {"open_tickets": open_tickets}
+
+async def pushed_dashboard_section(section: str, user_id: Optional[str]) -> dict:
+    """dashboard_section for the push feed, with the same role check as GET /analytics/dashboard."""
+    role = None
+    if section == "approvals":
+        user = await user_cache.get(user_id, load_user)
+        role = user.role if user else None
+    return await dashboard_section(section, user_id, role=role)
+
+dashboard_push = DashboardPush(
+    pushed_dashboard_section,
+    manager.emit,
+    manager.publish,
+    manager.has_subscribers,
+    window=float(os.environ.get('DASHBOARD_PUSH_WINDOW_SECONDS', '1')),
+    max_snapshots=int(os.environ.get('DASHBOARD_SNAPSHOT_CACHE_SIZE', '10000'))
+)
+manager.listen(DASHBOARD_DIRTY_TOPIC, dashboard_push.receive)
+
+@api_router.get("/analytics/dashboard")
+async def get_dashboard_stats(period: str = "all", current_user: User = Depends(get_current_user)):
+    stats = {}
+    for section in DASHBOARD_SECTIONS:
+        stats.update(await dashboard_section(section, current_user.id, period, current_user.role))
+    return stats
 
 @api_router.get("/analytics/team-performance")
-async def get_team_performance(current_user: User = Depends(require_role(["admin", "manager", "finance"]))):
+async def get_team_performance(period: str = "all", current_user: User = Depends(require_role(["admin", "manager", "finance"]))):
     # Get all users and their performance
-    users = await db.users.find({"role": {"$in": ["rep", "partner"]}}, {"_id": 0}).to_list(100)
+    users = await db.users.find({"role": {"$in": ["rep", "partner"]}}, {"_id": 0, "id": 1, "full_name": 1}).to_list(None)
+    user_ids = [u['id'] for u in users]
+    totals = await earnings_totals(user_ids, period)
+    quotas = await db.quotas.find({"user_id": {"$in": user_ids}, "status": "active"}, {"_id": 0, "user_id": 1, "attainment_percent": 1}).to_list(None)
+    attainment_by_user = {q['user_id']: q['attainment_percent'] for q in quotas}
     
     performance_data = []
     for user in users:
-        calculations = await db.commission_calculations.find({"sales_rep_id": user['id']}, {"_id": 0}).to_list(1000)
-        total = sum(Decimal(c['final_amount']) for c in calculations) if calculations else Decimal("0")
-        
-        quota = await db.quotas.find_one({"user_id": user['id'], "status": "active"}, {"_id": 0})
-        attainment = Decimal(quota['attainment_percent']) if quota else Decimal("0")
+        total = totals.get(user['id'], {}).get('total_earnings', Decimal("0"))
+        attainment = attainment_by_user.get(user['id'], Decimal("0"))
         
         performance_data.append({
             "user_id": user['id'],
@@ -1256,16 +1721,20 @@ async def get_team_performance(current_user: User = Depends(require_role(["admin
 async def get_channel_health(current_user: User = Depends(require_role(["admin", "finance"]))):
     # Get partner health metrics
     partners = await db.partners.find({"status": "active"}, {"_id": 0}).to_list(100)
+    user_ids = [partner.get('user_id', '') for partner in partners]
+    
+    # One grouped volume query and one NFM lookup for every partner at once
+    volumes = await db.transactions.aggregate([
+        {"$match": {"sales_rep_id": {"$in": user_ids}}},
+        {"$group": {"_id": "$sales_rep_id", "total_volume": {"$sum": {"$ifNull": ["$base_amount", "$total_amount"]}}}}
+    ]).to_list(None)
+    volumes = {v['_id']: v['total_volume'] for v in volumes}
+    profiles = await nfm_cache.get_many(db.nfms, user_ids)
     
     health_data = []
     for partner in partners:
-        # Get partner transactions
-        transactions = await db.transactions.find({"sales_rep_id": partner.get('user_id', '')}, {"_id": 0}).to_list(1000)
-        total_volume = sum(Decimal(t['total_amount']) for t in transactions) if transactions else Decimal("0")
-        
-        # Get NFM compliance
-        nfms = await db.nfms.find({"user_id": partner.get('user_id', '')}, {"_id": 0}).to_list(100)
-        nfm_compliance = Decimal("100") if nfms else Decimal("0")
+        total_volume = volumes.get(partner.get('user_id', ''), Decimal("0"))
+        nfm_compliance = profiles[partner.get('user_id', '')]['compliance'] or Decimal("0")
         
         health_data.append({
             "partner_id": partner['id'],
@@ -1279,43 +1748,112 @@ async def get_channel_health(current_user: User = Depends(require_role(["admin",
     return health_data
 
 @api_router.get("/analytics/reports")
-async def generate_report(report_type: str, current_user: User = Depends(require_role(["admin", "finance"]))):
-    if report_type == "commission_summary":
-        calculations = await db.commission_calculations.find({}, {"_id": 0}).to_list(1000)
-        return {"report_type": "commission_summary", "data": calculations}
-    
-    elif report_type == "payout_reconciliation":
-        payouts = await db.payouts.find({}, {"_id": 0}).to_list(1000)
-        return {"report_type": "payout_reconciliation", "data": payouts}
-    
-    elif report_type == "partner_profitability":
-        partners = await db.partners.find({}, {"_id": 0}).to_list(100)
-        return {"report_type": "partner_profitability", "data": partners}
-    
-    return {"message": "Report type not found"}
+async def generate_report(report_type: str, response: Response, limit: int = 1000, cursor: Optional[str] = None, stream: bool = False, current_user: User = Depends(require_role(["admin", "finance"]))):
+    report_collections = {
+        "commission_summary": db.commission_calculations,
+        "payout_reconciliation": db.reconciliation_findings,
+        "partner_profitability": db.partners
+    }
+    if report_type not in report_collections:
+        return {"message": "Report type not found"}
+    
+    if report_type == "payout_reconciliation":
+        # Findings of the latest completed reconciliation (POST /reconciliations to run one)
+        reconciliation = await db.reconciliations.find_one({"status": "completed"}, {"_id": 0}, sort=[("created_at", -1)])
+        if not reconciliation:
+            raise HTTPException(status_code=404, detail="No completed reconciliation")
+        data = await list_page(db.reconciliation_findings, {"reconciliation_id": reconciliation['id']}, response, limit, cursor, stream)
+        if stream:
+            return data
+        return {"report_type": report_type, "reconciliation": reconciliation, "data": data, "next_cursor": response.headers.get("X-Next-Cursor")}
+    
+    data = await list_page(report_collections[report_type], {}, response, limit, cursor, stream)
+    if stream:
+        return data
+    return {"report_type": report_type, "data": data, "next_cursor": response.headers.get("X-Next-Cursor")}
+
+REPORT_EXPORTS = {
+    "commission_summary": ("commission_calculations", ["id", "transaction_id", "sales_rep_id", "plan_id", "calculation_date", "base_amount",
+                                                       "commission_amount", "adjustments", "final_amount", "status"]),
+    "payout_reconciliation": ("reconciliation_findings", ["kind", "reason", "user_id", "amount", "payout_id", "transaction_id", "calculation_id",
+                                                          "expected_total", "actual_total", "expected_count", "actual_count", "times_paid"]),
+    "partner_profitability": ("partners", ["id", "company_name", "contact_name", "tier", "status", "created_at"])
+}
 
 @api_router.post("/analytics/export")
 async def export_analytics(export_data: dict, current_user: User = Depends(require_role(["admin", "finance"]))):
-    format_type = export_data.get('format', 'pdf')
+    format_type = export_data.get('format', 'csv')
     report_type = export_data.get('report_type', 'commission_summary')
+    if report_type not in REPORT_EXPORTS:
+        raise HTTPException(status_code=404, detail="Report type not found")
+    if format_type == "xml":
+        raise HTTPException(status_code=400, detail="Reports export as csv or xlsx")
     
-    return {
-        "message": f"Export generated in {format_type} format",
-        "report_type": report_type,
-        "file_path": f"/exports/{report_type}_{datetime.now().strftime('%Y%m%d')}.{format_type}"
-    }
+    collection, columns = REPORT_EXPORTS[report_type]
+    query = {}
+    if report_type == "payout_reconciliation":
+        reconciliation = await db.reconciliations.find_one({"status": "completed"}, {"_id": 0, "id": 1}, sort=[("created_at", -1)])
+        if not reconciliation:
+            raise HTTPException(status_code=404, detail="No completed reconciliation")
+        query["reconciliation_id"] = reconciliation['id']
+    rows = db[collection].find(query, {"_id": 0}).sort([("created_at", -1), ("id", -1)]).batch_size(1000)
+    return await deliver_export(f"{report_type}-{datetime.now(timezone.utc):%Y%m%d}", format_type, export_data.get('spool', True),
+                                "report", report_type, current_user.id, columns, rows)
+
+# ============= AUDIT ENDPOINTS =============
+
+@api_router.get("/audit/logs")
+async def query_audit_logs(
+    response: Response,
+    start: datetime,
+    end: Optional[datetime] = None,
+    resource_type: Optional[str] = None,
+    resource_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    action_type: Optional[str] = None,
+    include_archived: bool = False,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    current_user: User = Depends(require_role(["admin", "finance"]))
+):
+    end = end or datetime.now(timezone.utc)
+    start, end = [d if d.tzinfo else d.replace(tzinfo=timezone.utc) for d in (start, end)]
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    filters = {k: v for k, v in {"resource_type": resource_type, "resource_id": resource_id, "user_id": user_id, "action_type": action_type}.items() if v}
+    try:
+        events, next_cursor = await audit_partitions.query(filters, start, end, max(1, min(limit, 1000)), cursor, include_archived)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return events
+
+@api_router.get("/audit/sink")
+async def get_audit_sink_stats(current_user: User = Depends(require_role(["admin"]))):
+    return audit_sink.stats()
+
+# ============= REALTIME ENDPOINTS =============
+
+@api_router.get("/realtime/stats")
+async def get_realtime_stats(current_user: User = Depends(require_role(["admin"]))):
+    return manager.stats()
+
+@api_router.get("/realtime/dashboard")
+async def get_dashboard_push_stats(current_user: User = Depends(require_role(["admin"]))):
+    return dashboard_push.stats()
 
 # ============= GAMIFICATION ENDPOINTS =============
 
 @api_router.get("/gamification/leaderboard")
 async def get_leaderboard(period: str = "monthly", current_user: User = Depends(get_current_user)):
     # Get all reps and their earnings
-    users = await db.users.find({"role": {"$in": ["rep", "partner"]}}, {"_id": 0}).to_list(100)
+    users = await db.users.find({"role": {"$in": ["rep", "partner"]}}, {"_id": 0, "id": 1, "full_name": 1}).to_list(None)
+    totals = await earnings_totals([u['id'] for u in users], period)
     
     leaderboard = []
     for user in users:
-        calculations = await db.commission_calculations.find({"sales_rep_id": user['id']}, {"_id": 0}).to_list(1000)
-        total = sum(Decimal(c['final_amount']) for c in calculations) if calculations else Decimal("0")
+        total = totals.get(user['id'], {}).get('total_earnings', Decimal("0"))
         
         leaderboard.append({
             "user_id": user['id'],
@@ -1331,9 +1869,8 @@ async def get_leaderboard(period: str = "monthly", current_user: User = Depends(
     return leaderboard
 
 @api_router.get("/gamification/milestones")
-async def get_milestones(current_user: User = Depends(get_current_user)):
-    calculations = await db.commission_calculations.find({"sales_rep_id": current_user.id}, {"_id": 0}).to_list(1000)
-    total_earnings = sum(Decimal(c['final_amount']) for c in calculations) if calculations else Decimal("0")
+async def get_milestones(period: str = "all", current_user: User = Depends(get_current_user)):
+    total_earnings = await get_rep_earnings(current_user.id, period)
     
     milestones = [
         {"name": "First Commission", "threshold": "100", "achieved": total_earnings >= Decimal("100")},
@@ -1351,37 +1888,115 @@ async def get_milestones(current_user: User = Depends(get_current_user)):
 async def create_eligibility_rule(rule_data: EligibilityRuleCreate, current_user: User = Depends(require_role(["admin", "finance"]))):
     rule = EligibilityRule(**rule_data.model_dump())
     doc = rule.model_dump()
-    doc['effective_start'] = doc['effective_start'].isoformat()
-    if doc['effective_end']:
-        doc['effective_end'] = doc['effective_end'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
-    if doc.get('commission_rate_override'):
-        doc['commission_rate_override'] = str(doc['commission_rate_override'])
     
     await db.eligibility_rules.insert_one(doc)
+    eligibility_index.upsert(rule.model_dump())
     await create_audit_log(current_user.id, "eligibility_rule_created", "eligibility_rule", rule.id, None, doc)
     return rule
 
 @api_router.get("/eligibility-rules")
 async def list_eligibility_rules(current_user: User = Depends(require_role(["admin", "finance"]))):
     rules = await db.eligibility_rules.find({}, {"_id": 0}).to_list(100)
-    for r in rules:
-        r['effective_start'] = datetime.fromisoformat(r['effective_start'])
-        if r.get('effective_end') and isinstance(r['effective_end'], str):
-            r['effective_end'] = datetime.fromisoformat(r['effective_end'])
-        if isinstance(r['created_at'], str):
-            r['created_at'] = datetime.fromisoformat(r['created_at'])
-        if r.get('commission_rate_override'):
-            r['commission_rate_override'] = Decimal(r['commission_rate_override'])
     return rules
 
+@api_router.put("/eligibility-rules/{rule_id}")
+async def update_eligibility_rule(rule_id: str, rule_data: EligibilityRuleCreate, current_user: User = Depends(require_role(["admin", "finance"]))):
+    old_rule = await db.eligibility_rules.find_one({"id": rule_id}, {"_id": 0})
+    if not old_rule:
+        raise HTTPException(status_code=404, detail="Eligibility rule not found")
+    
+    update_data = rule_data.model_dump()
+    await db.eligibility_rules.update_one({"id": rule_id}, {"$set": update_data})
+    rule = {**old_rule, **update_data}
+    eligibility_index.upsert(rule)
+    await create_audit_log(current_user.id, "eligibility_rule_updated", "eligibility_rule", rule_id, old_rule, rule)
+    return rule
+
+@api_router.delete("/eligibility-rules/{rule_id}")
+async def delete_eligibility_rule(rule_id: str, current_user: User = Depends(require_role(["admin", "finance"]))):
+    old_rule = await db.eligibility_rules.find_one_and_delete({"id": rule_id}, {"_id": 0})
+    if not old_rule:
+        raise HTTPException(status_code=404, detail="Eligibility rule not found")
+    eligibility_index.remove(rule_id)
+    await create_audit_log(current_user.id, "eligibility_rule_deleted", "eligibility_rule", rule_id, old_rule, None)
+    return {"message": "Eligibility rule deleted"}
+
+@api_router.post("/fx-rates")
+async def create_fx_rate(rate_data: FXRateCreate, current_user: User = Depends(require_role(["admin", "finance"]))):
+    return (await save_fx_rates([rate_data], current_user.id))[0]
+
+@api_router.post("/fx-rates/batch")
+async def create_fx_rate_batch(rates_data: List[FXRateCreate], current_user: User = Depends(require_role(["admin", "finance"]))):
+    rates = await save_fx_rates(rates_data, current_user.id)
+    return {"saved": len(rates)}
+
+async def save_fx_rates(rates_data: List[FXRateCreate], user_id: str) -> List[dict]:
+    """Upsert rates on (pair, effective_date), so a re-sent rate corrects the earlier one."""
+    if any(r.from_currency == r.to_currency for r in rates_data):
+        raise HTTPException(status_code=400, detail="A rate needs two different currencies")
+    rates = [FXRate(**r.model_dump()).model_dump() for r in rates_data]
+    if not rates:
+        return []
+    await db.fx_rates.bulk_write([
+        UpdateOne(
+            {"from_currency": r['from_currency'], "to_currency": r['to_currency'], "effective_date": r['effective_date']},
+            {"$set": {"rate": r['rate']}, "$setOnInsert": {"id": r['id'], "created_at": r['created_at']}},
+            upsert=True
+        ) for r in rates
+    ], ordered=False)
+    for rate in rates:
+        fx_rates.upsert(rate)
+    await create_audit_log(user_id, "fx_rates_saved", "fx_rate", rates[0]['id'], None, {"count": len(rates)})
+    # Other workers re-queue them again once their own caches pick the rates up
+    await requeue_pending_fx()
+    return rates
+
+async def requeue_pending_fx():
+    """Queue the transactions held for a missing rate, so they are calculated once one arrives."""
+    pending = await db.transactions.find({"status": "pending_fx"}, {"_id": 0, "id": 1}).to_list(None)
+    await commission_queue.enqueue([t['id'] for t in pending])
+
+@api_router.get("/fx-rates")
+async def list_fx_rates(from_currency: Optional[str] = None, to_currency: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    query = {}
+    if from_currency:
+        query["from_currency"] = from_currency.upper()
+    if to_currency:
+        query["to_currency"] = to_currency.upper()
+    return await db.fx_rates.find(query, {"_id": 0}).sort("effective_date", -1).to_list(1000)
+
+@api_router.delete("/fx-rates/{rate_id}")
+async def delete_fx_rate(rate_id: str, current_user: User = Depends(require_role(["admin", "finance"]))):
+    old_rate = await db.fx_rates.find_one_and_delete({"id": rate_id}, {"_id": 0})
+    if not old_rate:
+        raise HTTPException(status_code=404, detail="FX rate not found")
+    fx_rates.remove(old_rate)
+    await create_audit_log(current_user.id, "fx_rate_deleted", "fx_rate", rate_id, old_rate, None)
+    return {"message": "FX rate deleted"}
+
+@api_router.get("/fx-rates/convert")
+async def convert_currency(amount: Decimal, from_currency: str, to_currency: str, date: Optional[datetime] = None, current_user: User = Depends(get_current_user)):
+    when = date or datetime.now(timezone.utc)
+    try:
+        converted, rate = fx_rates.convert(amount, from_currency.upper(), to_currency.upper(), when)
+    except FXRateMissing as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"amount": converted, "currency": to_currency.upper(), "rate": rate, "date": when}
+
+@api_router.get("/fx-rates/cache")
+async def get_fx_cache_stats(current_user: User = Depends(require_role(["admin", "finance"]))):
+    return fx_rates.stats()
+
+@api_router.get("/eligibility-rules/index")
+async def get_eligibility_index_stats(current_user: User = Depends(require_role(["admin", "finance"]))):
+    return eligibility_index.stats()
+
 # ============= DATA SOURCE MAPPING ENDPOINTS =============
 
 @api_router.post("/data-sources")
 async def create_data_source(source_data: DataSourceMappingCreate, current_user: User = Depends(require_role(["admin"]))):
     source = DataSourceMapping(**source_data.model_dump())
     doc = source.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     
     await db.data_source_mappings.insert_one(doc)
     await create_audit_log(current_user.id, "data_source_created", "data_source", source.id, None, doc)
@@ -1390,11 +2005,6 @@ async def create_data_source(source_data: DataSourceMappingCreate, current_user:
 @api_router.get("/data-sources")
 async def list_data_sources(current_user: User = Depends(require_role(["admin"]))):
     sources = await db.data_source_mappings.find({}, {"_id": 0}).to_list(100)
-    for s in sources:
-        if isinstance(s['created_at'], str):
-            s['created_at'] = datetime.fromisoformat(s['created_at'])
-        if s.get('last_sync') and isinstance(s['last_sync'], str):
-            s['last_sync'] = datetime.fromisoformat(s['last_sync'])
     return sources
 
 # ============= CUSTOM ROLE ENDPOINTS =============
@@ -1403,8 +2013,6 @@ async def list_data_sources(current_user: User = Depends(require_role(["admin"])
 async def create_custom_role(role_data: CustomRoleCreate, current_user: User = Depends(require_role(["admin"]))):
     role = CustomRole(**role_data.model_dump(), created_by=current_user.id)
     doc = role.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
     
     await db.custom_roles.insert_one(doc)
     await create_audit_log(current_user.id, "custom_role_created", "custom_role", role.id, None, doc)
@@ -1413,11 +2021,6 @@ async def create_custom_role(role_data: CustomRoleCreate, current_user: User = D
 @api_router.get("/roles/custom")
 async def list_custom_roles(current_user: User = Depends(require_role(["admin"]))):
     roles = await db.custom_roles.find({}, {"_id": 0}).to_list(100)
-    for r in roles:
-        if isinstance(r['created_at'], str):
-            r['created_at'] = datetime.fromisoformat(r['created_at'])
-        if isinstance(r['updated_at'], str):
-            r['updated_at'] = datetime.fromisoformat(r['updated_at'])
     return roles
 
 @api_router.get("/roles/custom/{role_id}")
@@ -1425,10 +2028,6 @@ async def get_custom_role(role_id: str, current_user: User = Depends(require_rol
     role = await db.custom_roles.find_one({"id": role_id}, {"_id": 0})
     if not role:
         raise HTTPException(status_code=404, detail="Role not found")
-    if isinstance(role['created_at'], str):
-        role['created_at'] = datetime.fromisoformat(role['created_at'])
-    if isinstance(role['updated_at'], str):
-        role['updated_at'] = datetime.fromisoformat(role['updated_at'])
     return role
 
 @api_router.patch("/roles/custom/{role_id}")
@@ -1437,7 +2036,7 @@ async def update_custom_role(role_id: str, update_data: dict, current_user: User
     if not role:
         raise HTTPException(status_code=404, detail="Role not found")
     
-    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
+    update_data['updated_at'] = datetime.now(timezone.utc)
     await db.custom_roles.update_one({"id": role_id}, {"$set": update_data})
     await create_audit_log(current_user.id, "custom_role_updated", "custom_role", role_id, role, update_data)
     return {"message": "Custom role updated successfully"}
@@ -1456,8 +2055,6 @@ async def delete_custom_role(role_id: str, current_user: User = Depends(require_
 async def create_custom_group(group_data: CustomGroupCreate, current_user: User = Depends(require_role(["admin"]))):
     group = CustomGroup(**group_data.model_dump(), created_by=current_user.id)
     doc = group.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
     
     await db.custom_groups.insert_one(doc)
     await create_audit_log(current_user.id, "custom_group_created", "custom_group", group.id, None, doc)
@@ -1466,11 +2063,6 @@ async def create_custom_group(group_data: CustomGroupCreate, current_user: User
 @api_router.get("/groups/custom")
 async def list_custom_groups(current_user: User = Depends(require_role(["admin"]))):
     groups = await db.custom_groups.find({}, {"_id": 0}).to_list(100)
-    for g in groups:
-        if isinstance(g['created_at'], str):
-            g['created_at'] = datetime.fromisoformat(g['created_at'])
-        if isinstance(g['updated_at'], str):
-            g['updated_at'] = datetime.fromisoformat(g['updated_at'])
     return groups
 
 @api_router.get("/groups/custom/{group_id}")
@@ -1478,10 +2070,6 @@ async def get_custom_group(group_id: str, current_user: User = Depends(require_r
     group = await db.custom_groups.find_one({"id": group_id}, {"_id": 0})
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
-    if isinstance(group['created_at'], str):
-        group['created_at'] = datetime.fromisoformat(group['created_at'])
-    if isinstance(group['updated_at'], str):
-        group['updated_at'] = datetime.fromisoformat(group['updated_at'])
     return group
 
 @api_router.patch("/groups/custom/{group_id}")
@@ -1490,7 +2078,7 @@ async def update_custom_group(group_id: str, update_data: dict, current_user: Us
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
     
-    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
+    update_data['updated_at'] = datetime.now(timezone.utc)
     await db.custom_groups.update_one({"id": group_id}, {"$set": update_data})
     await create_audit_log(current_user.id, "custom_group_updated", "custom_group", group_id, group, update_data)
     return {"message": "Custom group updated successfully"}
@@ -1639,17 +2227,63 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def start_background_workers():
+    await ensure_indexes(db)
+    await audit_sink.start()
+    await manager.start()
+    await eligibility_index.start(db.eligibility_rules)
+    await spiff_index.start(db.spiffs)
+    await fx_rates.start(db.fx_rates)
+    attainment_reconciler.start(db)
+    await commission_queue.start()
+    user_cache.start(db.users)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await commission_queue.stop()
+    await manager.stop()
+    await eligibility_index.stop()
+    await spiff_index.stop()
+    await fx_rates.stop()
+    await attainment_reconciler.stop()
+    await user_cache.stop()
+    password_pool.shutdown()
+    await audit_sink.stop()
     client.close()
 
 # WebSocket endpoint
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    await manager.connect(websocket, user_id)
+    connection = await manager.connect(websocket, user_id)
     try:
         while True:
             data = await websocket.receive_text()
-            await websocket.send_text(f"Message received: {data}")
+            try:
+                command = json.loads(data)
+            except ValueError:
+                command = None
+            if isinstance(command, dict) and command.get('action') in ["subscribe", "unsubscribe"]:
+                topic = str(command.get('topic', ''))
+                # Scoped topics (user:<id>, dashboard:<id>) are only open to their own user; dashboard marks are internal
+                if not topic or topic == DASHBOARD_DIRTY_TOPIC or (":" in topic and topic.split(":", 1)[1] != user_id):
+                    manager.offer(connection, json.dumps({"type": "error", "detail": "Invalid topic"}))
+                    continue
+                # The dashboard is one feed: personal deltas plus the shared spiff section
+                dashboard = topic in [DASHBOARD_TOPIC, dashboard_topic(user_id)]
+                topics = [DASHBOARD_TOPIC, dashboard_topic(user_id)] if dashboard else [topic]
+                for name in topics:
+                    if command['action'] == "subscribe":
+                        manager.subscribe(connection, name)
+                    else:
+                        manager.unsubscribe(connection, name)
+                manager.offer(connection, json.dumps({"type": f"{command['action']}d", "topic": topic}))
+                if dashboard and command['action'] == "subscribe":
+                    snapshot = await dashboard_push.snapshot(user_id)
+                    manager.offer(connection, json.dumps({"type": "dashboard_snapshot", "data": snapshot}, default=json_default))
+                continue
+            manager.offer(connection, f"Message received: {data}")
     except WebSocketDisconnect:
-        manager.disconnect(websocket, user_id)
+        pass
+    finally:
+        manager.disconnect(connection)
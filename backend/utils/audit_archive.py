@@ -0,0 +1,266 @@
+"""Monthly audit log partitions and their compressed archive.
+
+Audit events are stored in one collection per calendar month
+(`audit_logs_YYYY_MM`, zstd block compression, created with the audit
+indexes on first write). Queries take a time range and only touch the months
+it overlaps, so "all changes to plan X last year" reads twelve small indexed
+partitions instead of the whole history.
+
+Months older than the live window can be rolled over to gzip-compressed
+Extended JSON files (`audit-YYYY-MM.jsonl.gz`) and dropped from MongoDB. The
+query API still reads those files for the months a request asks for.
+
+    python -m utils.audit_archive migrate            # split legacy audit_logs into partitions
+                                                     # (after `python -m utils.codec --collection audit_logs`)
+    python -m utils.audit_archive archive --keep 24  # archive months older than 24
+"""
+import argparse
+import asyncio
+import gzip
+import logging
+import os
+import re
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+from bson import json_util
+from bson.codec_options import CodecOptions
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import BulkWriteError, CollectionInvalid, OperationFailure
+
+from utils.codec import CODEC_OPTIONS
+from utils.pagination import decode_cursor, encode_cursor, keyset_filter
+
+logger = logging.getLogger(__name__)
+
+LEGACY_COLLECTION = "audit_logs"
+PARTITION_PREFIX = "audit_logs_"
+PARTITION_PATTERN = re.compile(r"^audit_logs_(\d{4})_(\d{2})$")
+ARCHIVE_PATTERN = re.compile(r"^audit-(\d{4})-(\d{2})\.jsonl\.gz$")
+
+DUPLICATE_KEY = 11000
+
+PARTITION_INDEXES = [
+    IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    IndexModel([("resource_type", ASCENDING), ("resource_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)], name="resource_timestamp"),
+    IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)], name="user_timestamp"),
+    IndexModel([("timestamp", DESCENDING), ("id", DESCENDING)], name="timestamp"),
+]
+
+# Archives keep Decimal128 and dates as Extended JSON type wrappers
+_RAW_OPTIONS = CodecOptions(tz_aware=True, tzinfo=timezone.utc)
+_JSON_OPTIONS = json_util.JSONOptions(json_mode=json_util.JSONMode.CANONICAL, tz_aware=True, tzinfo=timezone.utc)
+
+
+def partition_name(timestamp: datetime) -> str:
+    return f"{PARTITION_PREFIX}{timestamp.year:04d}_{timestamp.month:02d}"
+
+
+def archive_name(year: int, month: int) -> str:
+    return f"audit-{year:04d}-{month:02d}.jsonl.gz"
+
+
+def months_between(start: datetime, end: datetime) -> List[tuple]:
+    """(year, month) pairs covering [start, end], newest first."""
+    months = []
+    year, month = end.year, end.month
+    while (year, month) >= (start.year, start.month):
+        months.append((year, month))
+        year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+    return months
+
+
+class AuditPartitions:
+    def __init__(self, db, archive_dir: Path):
+        self.db = db
+        self.archive_dir = Path(archive_dir)
+        self._ready: Set[str] = set()
+        self._lock = asyncio.Lock()
+
+    async def collection_for(self, doc: Dict[str, Any]):
+        """Return the partition for an event, creating it with its indexes the first time."""
+        name = partition_name(doc['timestamp'])
+        if name not in self._ready:
+            async with self._lock:
+                if name not in self._ready:
+                    await self._create(name)
+                    self._ready.add(name)
+        return self.db[name]
+
+    async def _create(self, name: str):
+        try:
+            await self.db.create_collection(name, storageEngine={"wiredTiger": {"configString": "block_compressor=zstd"}})
+        except CollectionInvalid:
+            pass
+        except OperationFailure as e:
+            # Not WiredTiger (or no zstd): fall back to the server default
+            logger.warning("Creating %s with zstd compression failed, using defaults: %s", name, e)
+        await self.db[name].create_indexes(PARTITION_INDEXES)
+
+    async def live_partitions(self) -> Dict[tuple, str]:
+        names = await self.db.list_collection_names(filter={"name": {"$regex": f"^{PARTITION_PREFIX}"}})
+        partitions = {}
+        for name in names:
+            match = PARTITION_PATTERN.match(name)
+            if match:
+                partitions[(int(match.group(1)), int(match.group(2)))] = name
+        return partitions
+
+    def archived_months(self) -> Set[tuple]:
+        if not self.archive_dir.exists():
+            return set()
+        months = set()
+        for path in self.archive_dir.iterdir():
+            match = ARCHIVE_PATTERN.match(path.name)
+            if match:
+                months.add((int(match.group(1)), int(match.group(2))))
+        return months
+
+    async def query(self, filters: Dict[str, Any], start: datetime, end: datetime, limit: int = 100,
+                    cursor: Optional[str] = None, include_archived: bool = False) -> tuple:
+        """Return (events newest first, next cursor), reading only the months in [start, end)."""
+        newest = end
+        if cursor:
+            # Partitions newer than the cursor position were already read
+            newest = min(end, decode_cursor(cursor)[0])
+        live = await self.live_partitions()
+        archived = self.archived_months() if include_archived else set()
+        match = {**filters, "timestamp": {"$gte": start, "$lt": end}}
+
+        events: List[Dict[str, Any]] = []
+        for year, month in months_between(start, newest):
+            wanted = limit + 1 - len(events)
+            if wanted <= 0:
+                break
+            if (year, month) in live:
+                partition = self.db[live[(year, month)]]
+                found = partition.find(keyset_filter(match, cursor, "timestamp"), {"_id": 0})
+                events.extend(await found.sort([("timestamp", -1), ("id", -1)]).limit(wanted).to_list(wanted))
+            elif (year, month) in archived:
+                events.extend(await asyncio.to_thread(self._scan_archive, year, month, filters, start, end, cursor, wanted))
+
+        if len(events) <= limit:
+            return events, None
+        events = events[:limit]
+        return events, encode_cursor(events[-1], "timestamp")
+
+    def _scan_archive(self, year: int, month: int, filters: Dict[str, Any], start: datetime, end: datetime,
+                      cursor: Optional[str], limit: int) -> List[Dict[str, Any]]:
+        after = decode_cursor(cursor) if cursor else None
+        matches = []
+        with gzip.open(self.archive_dir / archive_name(year, month), "rt", encoding="utf-8") as handle:
+            for line in handle:
+                event = json_util.loads(line, json_options=_JSON_OPTIONS)
+                if any(event.get(field) != value for field, value in filters.items()):
+                    continue
+                if not start <= event['timestamp'] < end:
+                    continue
+                if after and (event['timestamp'], event['id']) >= (after[0], after[1]):
+                    continue
+                event.pop('_id', None)
+                matches.append(_decode_decimals(event))
+        # Archives are written in timestamp order; return newest first like the partitions
+        matches.sort(key=lambda e: (e['timestamp'], e['id']), reverse=True)
+        return matches[:limit]
+
+    async def archive(self, keep_months: int, now: Optional[datetime] = None) -> List[str]:
+        """Move every partition older than the newest `keep_months` months to a compressed file."""
+        now = now or datetime.now(timezone.utc)
+        first_kept = now.year * 12 + now.month - 1 - (max(keep_months, 1) - 1)
+        oldest_kept = (first_kept // 12, first_kept % 12 + 1)
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        archived = []
+        for (year, month), name in sorted((await self.live_partitions()).items()):
+            if (year, month) >= oldest_kept:
+                continue
+            path = self.archive_dir / archive_name(year, month)
+            partial = path.with_suffix(".partial")
+            raw = self.db.get_collection(name, codec_options=_RAW_OPTIONS)
+            written = 0
+            with gzip.open(partial, "wt", encoding="utf-8") as handle:
+                async for event in raw.find({}, {"_id": 0}).sort([("timestamp", 1), ("id", 1)]).batch_size(1000):
+                    handle.write(json_util.dumps(event, json_options=_JSON_OPTIONS) + "\n")
+                    written += 1
+            if written != await raw.count_documents({}):
+                partial.unlink()
+                raise RuntimeError(f"{name} changed while it was being archived")
+            os.replace(partial, path)
+            await raw.drop()
+            self._ready.discard(name)
+            archived.append(name)
+            logger.info("Archived %d audit events from %s to %s", written, name, path.name)
+        return archived
+
+    async def migrate_legacy(self, batch_size: int = 1000) -> int:
+        """Copy events from the unpartitioned audit_logs collection into monthly partitions.
+
+        Events are partitioned by their BSON timestamp, so string-encoded legacy
+        events have to be converted by the codec migration first.
+        """
+        legacy = self.db[LEGACY_COLLECTION]
+        if await legacy.find_one({"timestamp": {"$type": "string"}}, {"_id": 1}):
+            raise RuntimeError(
+                f"{LEGACY_COLLECTION} still holds string timestamps; "
+                f"run `python -m utils.codec --collection {LEGACY_COLLECTION}` first"
+            )
+        moved = 0
+        batch: List[Dict[str, Any]] = []
+        async for event in legacy.find({}, {"_id": 0}).batch_size(batch_size):
+            batch.append(event)
+            if len(batch) >= batch_size:
+                moved += await self._insert(batch)
+                batch = []
+        if batch:
+            moved += await self._insert(batch)
+        return moved
+
+    async def _insert(self, events: List[Dict[str, Any]]) -> int:
+        by_partition: Dict[str, List[Dict[str, Any]]] = {}
+        for event in events:
+            collection = await self.collection_for(event)
+            by_partition.setdefault(collection.name, []).append(event)
+        for name, group in by_partition.items():
+            try:
+                await self.db[name].insert_many(group, ordered=False)
+            except BulkWriteError as e:
+                # Re-running the migration re-inserts ids that are already there
+                if any(error.get('code') != DUPLICATE_KEY for error in e.details.get('writeErrors', [])):
+                    raise
+        return len(events)
+
+
+def _decode_decimals(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {k: _decode_decimals(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode_decimals(v) for v in value]
+    if hasattr(value, "to_decimal"):
+        return value.to_decimal()
+    return value
+
+
+async def _main(command: str, keep: int):
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent.parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client.get_database(os.environ['DB_NAME'], codec_options=CODEC_OPTIONS)
+    partitions = AuditPartitions(db, Path(os.environ.get('AUDIT_ARCHIVE_DIR', Path(__file__).parent.parent / 'audit_archive')))
+    try:
+        if command == "migrate":
+            print(f"{await partitions.migrate_legacy()} events copied into monthly partitions")
+        else:
+            for name in await partitions.archive(keep):
+                print(f"archived {name}")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage monthly audit log partitions")
+    parser.add_argument("command", choices=["migrate", "archive"])
+    parser.add_argument("--keep", type=int, default=24, help="months to keep in MongoDB when archiving")
+    args = parser.parse_args()
+    asyncio.run(_main(args.command, args.keep))
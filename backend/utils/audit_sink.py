@@ -0,0 +1,245 @@
+"""Write-behind audit log sink.
+
+Endpoints hand audit events to the sink, which appends them to a local spill
+segment and buffers them in memory. A background task writes the buffer with
+one insert_many per target collection (resolved per event by
+`collection_for`, i.e. its monthly audit partition) once it reaches
+`batch_size` events or every `flush_interval` seconds. A segment is deleted only after its events are
+stored, so events still in memory when the process dies are replayed from
+disk on the next start. Each live segment holds an exclusive lock, so workers
+that share a spill directory never replay each other's open segments.
+
+Spill file I/O runs on a single dedicated thread, off the event loop. One
+thread keeps appends, fsyncs and segment rotation in submission order.
+An emitted event survives a process crash; it survives a machine crash once
+its segment is sealed, which fsyncs it, at the next flush.
+
+With `store_diffs` enabled, an event that has both a before and an after
+state stores only the top-level fields that changed. The after state is
+often just the update that was applied, so only its fields are compared.
+"""
+import asyncio
+import fcntl
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import bson
+from bson.errors import InvalidBSON
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from utils.codec import CODEC_OPTIONS
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+def diff_states(before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, Any]:
+    """Return {field: {"from": old, "to": new}} for each top-level field that changed.
+
+    `after` may be a partial update; fields it leaves out are unchanged, not removed.
+    """
+    changes = {}
+    for field in after.keys():
+        if field == "_id":
+            continue
+        if before.get(field) != after.get(field):
+            changes[field] = {"from": before.get(field), "to": after.get(field)}
+    return changes
+
+
+class _Segment:
+    def __init__(self, path: Path):
+        self.path = path
+        self.file = open(path, "ab")
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.file.close()
+            raise
+        self.events: List[bytes] = []
+
+    def append(self, data: bytes):
+        self.file.write(data)
+        self.file.flush()
+        self.events.append(data)
+
+    def seal(self):
+        os.fsync(self.file.fileno())
+
+    def remove(self):
+        self.path.unlink(missing_ok=True)
+        self.file.close()
+
+
+class AuditSink:
+    def __init__(self, collection_for: Callable[[Dict[str, Any]], Awaitable[Any]], spill_dir: Path, batch_size: int = 500,
+                 flush_interval: float = 1.0, store_diffs: bool = False):
+        self.collection_for = collection_for
+        self.spill_dir = Path(spill_dir)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.store_diffs = store_diffs
+
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="audit-spill")
+        self._current: Optional[_Segment] = None
+        self._sealed: List[_Segment] = []
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.emitted_total = 0
+        self.flushed_total = 0
+        self.failed_flushes = 0
+        self.recovered_total = 0
+        self.last_flush_seconds = 0.0
+
+    async def start(self):
+        if self._task:
+            return
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        self._stopping = False
+        await self._spill(self._recover)
+        if self._current is None:
+            self._current = await self._spill(self._open_segment)
+        self._task = asyncio.create_task(self._run())
+        if self._sealed:
+            self._wakeup.set()
+
+    async def stop(self):
+        """Flush everything buffered; whatever cannot be written stays on disk for the next start."""
+        self._stopping = True
+        self._wakeup.set()
+        if self._task:
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        if self._current and not self._current.events:
+            await self._spill(self._current.remove)
+        self._current = None
+
+    async def _spill(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._io, fn, *args)
+
+    async def emit(self, doc: Dict[str, Any]):
+        """Record an audit event; it is written to the spill segment when this returns."""
+        if self.store_diffs and doc.get('state_before') is not None and doc.get('state_after') is not None:
+            doc = {**doc, "state_diff": diff_states(doc['state_before'], doc['state_after']), "state_before": None, "state_after": None}
+        data = bson.encode(doc, codec_options=CODEC_OPTIONS)
+        if self._current is None:
+            # Not started (scripts, tests): park events until start() opens a segment
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            self._current = self._open_segment()
+        segment = self._current
+        await self._spill(segment.append, data)
+        self.emitted_total += 1
+        if len(segment.events) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._lock:
+            if self._current and self._current.events:
+                fresh = await self._spill(self._open_segment) if not self._stopping else None
+                segment, self._current = self._current, fresh
+                # Queued behind every append already submitted to the old segment
+                await self._spill(segment.seal)
+                self._sealed.append(segment)
+            while self._sealed:
+                segment = self._sealed[0]
+                if not await self._write(segment.events):
+                    return
+                self.flushed_total += len(segment.events)
+                await self._spill(segment.remove)
+                self._sealed.pop(0)
+
+    async def _write(self, events: List[bytes]) -> bool:
+        started = time.monotonic()
+        docs = bson.decode_all(b"".join(events), codec_options=CODEC_OPTIONS)
+        try:
+            groups: Dict[str, tuple] = {}
+            for doc in docs:
+                collection = await self.collection_for(doc)
+                groups.setdefault(collection.name, (collection, []))[1].append(doc)
+            for collection, group in groups.values():
+                await collection.insert_many(group, ordered=False)
+        except BulkWriteError as e:
+            # Replayed segments may already be partly stored; duplicates are expected there
+            if any(error.get('code') != DUPLICATE_KEY for error in e.details.get('writeErrors', [])):
+                logger.exception("Audit flush of %d events failed", len(docs))
+                self.failed_flushes += 1
+                return False
+        except PyMongoError:
+            logger.exception("Audit flush of %d events failed, keeping them spilled", len(docs))
+            self.failed_flushes += 1
+            return False
+        self.last_flush_seconds = time.monotonic() - started
+        return True
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Audit flush loop failed")
+
+    def _open_segment(self) -> _Segment:
+        return _Segment(self.spill_dir / f"audit-{time.time_ns()}-{os.getpid()}.bson")
+
+    def _recover(self):
+        for path in sorted(self.spill_dir.glob("audit-*.bson")):
+            try:
+                segment = _Segment(path)
+            except BlockingIOError:
+                # Still owned by a live worker
+                continue
+            segment.events = self._read_events(path)
+            if segment.events:
+                self._sealed.append(segment)
+                self.recovered_total += len(segment.events)
+            else:
+                segment.remove()
+        if self.recovered_total:
+            logger.warning("Replaying %d spilled audit events", self.recovered_total)
+
+    @staticmethod
+    def _read_events(path: Path) -> List[bytes]:
+        events = []
+        with open(path, "rb") as handle:
+            data = handle.read()
+        offset = 0
+        while offset + 4 <= len(data):
+            size = int.from_bytes(data[offset:offset + 4], "little")
+            chunk = data[offset:offset + size]
+            if size < 5 or len(chunk) < size:
+                logger.warning("Ignoring truncated audit event at the end of %s", path.name)
+                break
+            try:
+                bson.decode(chunk, codec_options=CODEC_OPTIONS)
+            except InvalidBSON:
+                logger.warning("Ignoring corrupt audit event at the end of %s", path.name)
+                break
+            events.append(chunk)
+            offset += size
+        return events
+
+    def stats(self) -> Dict[str, Any]:
+        buffered = len(self._current.events) if self._current else 0
+        return {
+            "buffered": buffered + sum(len(s.events) for s in self._sealed),
+            "pending_segments": len(self._sealed),
+            "emitted_total": self.emitted_total,
+            "flushed_total": self.flushed_total,
+            "recovered_total": self.recovered_total,
+            "failed_flushes": self.failed_flushes,
+            "last_flush_seconds": round(self.last_flush_seconds, 3),
+            "store_diffs": self.store_diffs
+        }
@@ -0,0 +1,91 @@
+"""Following a collection's writes from other workers.
+
+The in-memory indexes (eligibility rules, spiffs, FX rates) and the user
+cache are kept in step with writes made by other workers by following their
+collection's change stream. A change whose document still exists is handed
+to `on_document` whole. Deletes only carry the ObjectId, so they call
+`on_reset` instead, which reloads everything (or, for a cache, drops it).
+
+Where change streams are unavailable (standalone mongod) the follower resets
+every `refresh_seconds` instead, or stops when that is None and the owner
+relies on expiry. After any other stream error it resets, since anything
+could have changed while the stream was down, and reconnects.
+"""
+import asyncio
+import inspect
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+RETRY_SECONDS = 5
+
+
+async def _call(fn: Callable, *args):
+    result = fn(*args)
+    if inspect.isawaitable(result):
+        await result
+
+
+class ChangeFollower:
+    def __init__(self, name: str, on_document: Callable[[Dict[str, Any]], Any], on_reset: Callable[[], Any],
+                 refresh_seconds: Optional[float] = None, pipeline: Optional[List[Dict[str, Any]]] = None):
+        self.name = name
+        self.on_document = on_document
+        self.on_reset = on_reset
+        self.refresh_seconds = refresh_seconds
+        self.pipeline = pipeline or []
+        self._task: Optional[asyncio.Task] = None
+        self.watching = False
+
+    def start(self, collection):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(collection))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.watching = False
+
+    async def _run(self, collection):
+        while True:
+            try:
+                async with collection.watch(self.pipeline, full_document="updateLookup") as stream:
+                    self.watching = True
+                    async for change in stream:
+                        document = change.get('fullDocument')
+                        if document and document.get('id'):
+                            document.pop('_id', None)
+                            await _call(self.on_document, document)
+                        else:
+                            await _call(self.on_reset)
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                self.watching = False
+                if self.refresh_seconds is None:
+                    logger.warning("%s change stream unavailable: %s", self.name, e)
+                    return
+                logger.warning("%s change stream unavailable, reloading every %ss: %s", self.name, self.refresh_seconds, e)
+                await self._poll()
+                return
+            except PyMongoError:
+                self.watching = False
+                logger.exception("%s change stream failed, restarting", self.name)
+                await asyncio.sleep(RETRY_SECONDS)
+                try:
+                    await _call(self.on_reset)
+                except PyMongoError:
+                    logger.exception("Reloading %s failed", self.name)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await _call(self.on_reset)
+            except PyMongoError:
+                logger.exception("Reloading %s failed", self.name)
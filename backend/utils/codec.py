@@ -0,0 +1,219 @@
+"""BSON codec layer for money and timestamps.
+
+Decimal values are stored as Decimal128 and datetimes as native BSON dates, so
+MongoDB can sum and range-compare them directly. The database handle is opened
+with CODEC_OPTIONS, which encodes Decimal on write and decodes Decimal128 and
+timezone-aware UTC datetimes on read.
+
+Documents written before this layer existed hold these values as strings,
+including inside arrays and subdocuments (workflow steps, partner review
+history, ticket comments). They are converted in place by a streaming
+migration, which must run before anything that reads those fields as BSON
+types (such as `python -m utils.audit_archive migrate`):
+
+    python -m utils.codec [--collection NAME] [--batch-size N]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import typing
+from datetime import datetime, timezone
+from decimal import Decimal
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson.codec_options import CodecOptions, TypeCodec, TypeRegistry
+from bson.decimal128 import Decimal128
+from pydantic import BaseModel
+from pymongo import UpdateOne
+
+from models import (
+    User, Product, Transaction, CommissionCalculation, CommissionPlan, CreditAssignment, Spiff,
+    Partner, ApprovalWorkflow, Payout, Territory, Quota, Forecast, Ticket, NFM, EligibilityRule,
+    DataSourceMapping, AuditLog, CustomRole, CustomGroup,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class DecimalCodec(TypeCodec):
+    python_type = Decimal
+    bson_type = Decimal128
+
+    def transform_python(self, value: Decimal) -> Decimal128:
+        return Decimal128(value)
+
+    def transform_bson(self, value: Decimal128) -> Decimal:
+        return value.to_decimal()
+
+
+TYPE_REGISTRY = TypeRegistry([DecimalCodec()])
+CODEC_OPTIONS = CodecOptions(type_registry=TYPE_REGISTRY, tz_aware=True, tzinfo=timezone.utc)
+
+COLLECTION_MODELS = {
+    "users": User,
+    "products": Product,
+    "transactions": Transaction,
+    "commission_calculations": CommissionCalculation,
+    "commission_plans": CommissionPlan,
+    "credit_assignments": CreditAssignment,
+    "spiffs": Spiff,
+    "partners": Partner,
+    "approval_workflows": ApprovalWorkflow,
+    "payouts": Payout,
+    "territories": Territory,
+    "quotas": Quota,
+    "forecasts": Forecast,
+    "tickets": Ticket,
+    "nfms": NFM,
+    "eligibility_rules": EligibilityRule,
+    "data_source_mappings": DataSourceMapping,
+    "audit_logs": AuditLog,
+    "custom_roles": CustomRole,
+    "custom_groups": CustomGroup,
+}
+
+# Fields written by endpoints that are not declared on the models. Dotted
+# paths reach into subdocuments and through arrays, as in MongoDB queries.
+EXTRA_FIELDS: Dict[str, Tuple[List[str], List[str]]] = {
+    "partners": ([], ["rejected_at", "deactivated_at", "review_history.date"]),
+    "approval_workflows": ([], ["steps.timestamp"]),
+    "tickets": ([], ["comments.timestamp"]),
+    "commission_queue": ([], ["enqueued_at", "lease_expires_at", "available_at"]),
+}
+
+
+def _unwrap(annotation):
+    if typing.get_origin(annotation) is typing.Union:
+        args = [a for a in typing.get_args(annotation) if a is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return annotation
+
+
+def _submodel(annotation):
+    """The model stored under a field annotated as a model or a list of models, if any."""
+    if typing.get_origin(annotation) in (list, List):
+        annotation = _unwrap(typing.get_args(annotation)[0])
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return annotation
+    return None
+
+
+def typed_fields(model, prefix: str = "") -> Tuple[List[str], List[str]]:
+    """Return the dotted paths of the Decimal and datetime fields of a Pydantic model, nested models included."""
+    decimals, datetimes = [], []
+    for name, info in model.model_fields.items():
+        annotation = _unwrap(info.annotation)
+        if annotation is Decimal:
+            decimals.append(prefix + name)
+        elif annotation is datetime:
+            datetimes.append(prefix + name)
+        elif _submodel(annotation) is not None:
+            nested = typed_fields(_submodel(annotation), f"{prefix}{name}.")
+            decimals += nested[0]
+            datetimes += nested[1]
+    return decimals, datetimes
+
+
+def field_registry() -> Dict[str, Tuple[List[str], List[str]]]:
+    """Map each collection to the fields the codec stores as Decimal128 and BSON dates."""
+    registry = {name: typed_fields(model) for name, model in COLLECTION_MODELS.items()}
+    for name, (decimals, datetimes) in EXTRA_FIELDS.items():
+        known = registry.setdefault(name, ([], []))
+        registry[name] = (known[0] + decimals, known[1] + datetimes)
+    return registry
+
+
+def parse_legacy_decimal(value: Any) -> Optional[Decimal]:
+    return Decimal(value) if isinstance(value, str) and value != "" else None
+
+
+def parse_legacy_datetime(value: Any) -> Optional[datetime]:
+    if not isinstance(value, str) or value == "":
+        return None
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _convert(value: Any, path: List[str], parse) -> Tuple[Any, bool]:
+    """Parse the legacy strings found at `path` under `value`, descending through arrays."""
+    if isinstance(value, list):
+        converted = [_convert(item, path, parse) for item in value]
+        if not any(changed for _, changed in converted):
+            return value, False
+        return [item for item, _ in converted], True
+    if not path:
+        parsed = parse(value)
+        return (parsed, True) if parsed is not None else (value, False)
+    if not isinstance(value, dict) or path[0] not in value:
+        return value, False
+    child, changed = _convert(value[path[0]], path[1:], parse)
+    return ({**value, path[0]: child}, True) if changed else (value, False)
+
+
+async def migrate_collection(db, name: str, batch_size: int = 1000) -> int:
+    """Convert string-encoded Decimal and datetime fields of one collection in place."""
+    decimals, datetimes = field_registry().get(name, ([], []))
+    paths = [(path, parse_legacy_decimal) for path in decimals] + [(path, parse_legacy_datetime) for path in datetimes]
+    if not paths:
+        return 0
+
+    collection = db[name]
+    query = {"$or": [{path: {"$type": "string"}} for path, _ in paths]}
+    # Nested values are rewritten by replacing the top-level field that holds them
+    projection = {path.split(".", 1)[0]: 1 for path, _ in paths}
+    converted = 0
+    operations = []
+    async for doc in collection.find(query, projection).batch_size(batch_size):
+        update = {}
+        for path, parse in paths:
+            field, *rest = path.split(".")
+            value, changed = _convert(update.get(field, doc.get(field)), rest, parse)
+            if changed:
+                update[field] = value
+        if update:
+            operations.append(UpdateOne({"_id": doc['_id']}, {"$set": update}))
+        if len(operations) >= batch_size:
+            await collection.bulk_write(operations, ordered=False)
+            converted += len(operations)
+            operations = []
+    if operations:
+        await collection.bulk_write(operations, ordered=False)
+        converted += len(operations)
+    return converted
+
+
+async def migrate_all(db, batch_size: int = 1000) -> Dict[str, int]:
+    results = {}
+    for name in field_registry():
+        results[name] = await migrate_collection(db, name, batch_size)
+        logger.info("Migrated %d documents in %s", results[name], name)
+    return results
+
+
+async def _main(collection: Optional[str], batch_size: int):
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent.parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client.get_database(os.environ['DB_NAME'], codec_options=CODEC_OPTIONS)
+    try:
+        if collection:
+            results = {collection: await migrate_collection(db, collection, batch_size)}
+        else:
+            results = await migrate_all(db, batch_size)
+        for name, count in results.items():
+            print(f"{name}: {count} documents converted")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert string-encoded money and timestamps to BSON types")
+    parser.add_argument("--collection", help="only migrate this collection")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(_main(args.collection, args.batch_size))
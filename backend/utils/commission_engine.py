@@ -0,0 +1,330 @@
+"""Compiled commission plan engine.
+
+A plan's rules are compiled once per plan version into a flat program of steps
+and then evaluated over whole batches of transactions. All arithmetic is done
+on integers scaled by 10^4 with round-half-even, so results are identical to
+quantizing the equivalent Decimal(19, 4) expression.
+"""
+import ast
+import heapq
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+SCALE = 10_000
+PERCENT = 100
+RULE_TYPES = ("flat", "percentage", "tiered", "formula", "multiplier")
+
+# Plans saved without any rules keep the historical flat 5% behaviour.
+DEFAULT_RULES = [{"id": "default", "rule_type": "percentage", "action": {"commission_rate": "5"}, "priority": 0}]
+
+FORMULA_NAMES = ("amount", "quantity", "unit_price", "commission")
+FORMULA_FUNCTIONS = {"min": np.minimum, "max": np.maximum}
+
+_INT64_MAX = int(np.iinfo(np.int64).max)
+_PROGRAM_CACHE: Dict[str, Tuple[str, "CompiledPlan"]] = {}
+
+
+class PlanCompilationError(ValueError):
+    """Raised when plan rules cannot be compiled into a program."""
+
+
+def to_fixed(value: Any) -> int:
+    """Convert a monetary value to an integer scaled by 10^4."""
+    return int(Decimal(str(value)).quantize(Decimal('0.0001')).scaleb(4))
+
+
+def from_fixed(value: Any) -> Decimal:
+    """Convert an integer scaled by 10^4 back to a Decimal(19, 4)."""
+    return Decimal(int(value)).scaleb(-4)
+
+
+def _peak(values) -> int:
+    values = np.asarray(values)
+    if values.size == 0:
+        return 0
+    return int(np.max(np.abs(values)))
+
+
+def _round_div(num, den):
+    """Divide elementwise with round-half-even; a zero denominator yields zero."""
+    num = np.asarray(num)
+    den = np.asarray(den)
+    if num.dtype == object or den.dtype == object:
+        num, den = num.astype(object), den.astype(object)
+    sign = np.where(den < 0, -1, 1)
+    num, den = num * sign, np.abs(den)
+    safe_den = np.where(den == 0, 1, den)
+    q, r = np.floor_divide(num, safe_den), np.remainder(num, safe_den)
+    twice = 2 * r
+    bump = (twice > safe_den) | ((twice == safe_den) & (q % 2 == 1))
+    return np.where(den == 0, 0, q + bump.astype(np.int64))
+
+
+def _mul_div(a, b, den):
+    """Return round_half_even(a * b / den) without overflowing int64."""
+    a = np.asarray(a)
+    b = np.asarray(b)
+    if _peak(a) * _peak(b) > _INT64_MAX:
+        a, b = a.astype(object), b.astype(object)
+    return _normalize(_round_div(a * b, den))
+
+
+def _normalize(values):
+    """Return int64 arrays where possible, falling back to exact Python ints."""
+    values = np.asarray(values)
+    if values.dtype == object and _peak(values) <= _INT64_MAX:
+        return values.astype(np.int64)
+    return values
+
+
+def _optional_fixed(value: Any) -> Optional[int]:
+    if value is None or value == "":
+        return None
+    return to_fixed(value)
+
+
+def order_rules(rules: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Order rules by `depends_on` first and `priority` (lower first) second."""
+    by_id = {}
+    for index, rule in enumerate(rules):
+        rule_id = rule.get('id') or f"rule-{index}"
+        if rule_id in by_id:
+            raise PlanCompilationError(f"Duplicate rule id '{rule_id}'")
+        by_id[rule_id] = (index, rule)
+
+    dependents: Dict[str, List[str]] = {rule_id: [] for rule_id in by_id}
+    pending = {}
+    for rule_id, (_, rule) in by_id.items():
+        depends_on = rule.get('depends_on') or []
+        for dependency in depends_on:
+            if dependency not in by_id:
+                raise PlanCompilationError(f"Rule '{rule_id}' depends on unknown rule '{dependency}'")
+            dependents[dependency].append(rule_id)
+        pending[rule_id] = len(depends_on)
+
+    def sort_key(rule_id):
+        index, rule = by_id[rule_id]
+        return (int(rule.get('priority') or 0), index, rule_id)
+
+    ready = [sort_key(rule_id) for rule_id, count in pending.items() if count == 0]
+    heapq.heapify(ready)
+    ordered = []
+    while ready:
+        _, _, rule_id = heapq.heappop(ready)
+        ordered.append(by_id[rule_id][1])
+        for dependent in dependents[rule_id]:
+            pending[dependent] -= 1
+            if pending[dependent] == 0:
+                heapq.heappush(ready, sort_key(dependent))
+
+    if len(ordered) != len(by_id):
+        raise PlanCompilationError("Circular dependency detected")
+    return ordered
+
+
+def _compile_formula(source: str):
+    """Parse a formula into a restricted expression tree."""
+    try:
+        tree = ast.parse(source, mode="eval")
+    except SyntaxError as exc:
+        raise PlanCompilationError(f"Invalid formula '{source}': {exc.msg}")
+
+    def build(node):
+        if isinstance(node, ast.Expression):
+            return build(node.body)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            return ("const", to_fixed(node.value))
+        if isinstance(node, ast.Name) and node.id in FORMULA_NAMES:
+            return ("name", node.id)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            return ("neg" if isinstance(node.op, ast.USub) else "pos", build(node.operand))
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub, ast.Mult, ast.Div)):
+            return (type(node.op).__name__.lower(), build(node.left), build(node.right))
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+                and node.func.id in FORMULA_FUNCTIONS and len(node.args) == 2 and not node.keywords):
+            return ("call", node.func.id, build(node.args[0]), build(node.args[1]))
+        raise PlanCompilationError(f"Unsupported expression in formula '{source}'")
+
+    return build(tree)
+
+
+def _eval_formula(node, registers: Dict[str, Any]):
+    kind = node[0]
+    if kind == "const":
+        return np.int64(node[1])
+    if kind == "name":
+        return registers[node[1]]
+    if kind == "neg":
+        return -_eval_formula(node[1], registers)
+    if kind == "pos":
+        return _eval_formula(node[1], registers)
+    if kind == "call":
+        return FORMULA_FUNCTIONS[node[1]](_eval_formula(node[2], registers), _eval_formula(node[3], registers))
+    left = _eval_formula(node[1], registers)
+    right = _eval_formula(node[2], registers)
+    if kind == "add":
+        return left + right
+    if kind == "sub":
+        return left - right
+    if kind == "mult":
+        return _mul_div(left, right, SCALE)
+    return _mul_div(left, SCALE, right)
+
+
+@dataclass
+class Step:
+    """A single compiled rule."""
+    rule_id: str
+    rule_type: str
+    product_ids: Optional[frozenset] = None
+    min_amount: Optional[int] = None
+    max_amount: Optional[int] = None
+    rate: Optional[int] = None
+    bonus: int = 0
+    multiplier: Optional[int] = None
+    tiers: List[Tuple[int, Optional[int], int]] = field(default_factory=list)
+    formula: Optional[tuple] = None
+
+
+def _compile_rule(rule: Dict[str, Any]) -> Step:
+    rule_id = rule.get('id') or "rule"
+    rule_type = (rule.get('rule_type') or rule.get('type') or "").lower()
+    if rule_type not in RULE_TYPES:
+        raise PlanCompilationError(f"Rule '{rule_id}' has unknown type '{rule_type}'")
+
+    condition = rule.get('condition') or {}
+    action = rule.get('action') or {}
+    product_ids = condition.get('product_ids') or None
+    step = Step(
+        rule_id=rule_id,
+        rule_type=rule_type,
+        product_ids=frozenset(product_ids) if product_ids else None,
+        min_amount=_optional_fixed(condition.get('min_amount')),
+        max_amount=_optional_fixed(condition.get('max_amount')),
+        bonus=_optional_fixed(action.get('bonus_amount')) or 0,
+    )
+
+    if rule_type == "flat":
+        amount = action.get('amount', action.get('bonus_amount'))
+        if _optional_fixed(amount) is None:
+            raise PlanCompilationError(f"Flat rule '{rule_id}' requires an amount")
+        step.bonus = to_fixed(amount)
+    elif rule_type == "percentage":
+        step.rate = _optional_fixed(action.get('commission_rate'))
+        if step.rate is None:
+            raise PlanCompilationError(f"Percentage rule '{rule_id}' requires a commission_rate")
+    elif rule_type == "tiered":
+        tiers = action.get('tiers') or []
+        if tiers:
+            for tier in sorted(tiers, key=lambda t: Decimal(str(t.get('min') or 0))):
+                if _optional_fixed(tier.get('rate')) is None:
+                    raise PlanCompilationError(f"Tier in rule '{rule_id}' requires a rate")
+                step.tiers.append((to_fixed(tier.get('min') or 0), _optional_fixed(tier.get('max')), to_fixed(tier['rate'])))
+        else:
+            # Single band tiers as produced by the plan designer: min/max on the condition
+            step.rate = _optional_fixed(action.get('commission_rate'))
+            if step.rate is None:
+                raise PlanCompilationError(f"Tiered rule '{rule_id}' requires tiers or a commission_rate")
+    elif rule_type == "multiplier":
+        step.multiplier = _optional_fixed(action.get('multiplier', action.get('commission_rate')))
+        if step.multiplier is None:
+            raise PlanCompilationError(f"Multiplier rule '{rule_id}' requires a multiplier")
+    elif rule_type == "formula":
+        if not action.get('formula'):
+            raise PlanCompilationError(f"Formula rule '{rule_id}' requires a formula")
+        step.formula = _compile_formula(str(action['formula']))
+    return step
+
+
+class CompiledPlan:
+    """Evaluation program for one version of a commission plan."""
+
+    def __init__(self, plan_id: str, version: str, steps: List[Step]):
+        self.plan_id = plan_id
+        self.version = version
+        self.steps = steps
+
+    def _mask(self, step: Step, amounts, product_ids) -> np.ndarray:
+        mask = np.ones(len(amounts), dtype=bool)
+        if step.product_ids is not None:
+            mask &= np.fromiter((pid in step.product_ids for pid in product_ids), dtype=bool, count=len(product_ids))
+        if step.min_amount is not None:
+            mask &= amounts >= step.min_amount
+        if step.max_amount is not None:
+            mask &= amounts <= step.max_amount
+        return mask
+
+    def evaluate(self, amounts: Sequence[Any], product_ids: Sequence[str], quantities: Sequence[int], unit_prices: Sequence[Any]) -> List[Decimal]:
+        """Evaluate the program over a batch and return one commission per row."""
+        count = len(amounts)
+        if count == 0:
+            return []
+        registers = {
+            "amount": _normalize(np.array([to_fixed(a) for a in amounts], dtype=object)),
+            "quantity": _normalize(np.array([int(q) * SCALE for q in quantities], dtype=object)),
+            "unit_price": _normalize(np.array([to_fixed(p) for p in unit_prices], dtype=object)),
+        }
+        amount = registers["amount"]
+        commission = np.zeros(count, dtype=np.int64)
+
+        for step in self.steps:
+            mask = self._mask(step, amount, product_ids)
+            if not mask.any():
+                continue
+            if step.rule_type == "flat":
+                delta = np.int64(step.bonus)
+                commission = _normalize(np.where(mask, commission + delta, commission))
+                continue
+            if step.rule_type == "percentage" or (step.rule_type == "tiered" and not step.tiers):
+                result = commission + _mul_div(amount, step.rate, SCALE * PERCENT)
+            elif step.rule_type == "tiered":
+                result = commission
+                for low, high, rate in step.tiers:
+                    portion = np.maximum(amount - low, 0)
+                    if high is not None:
+                        portion = np.minimum(portion, high - low)
+                    result = result + _mul_div(portion, rate, SCALE * PERCENT)
+            elif step.rule_type == "multiplier":
+                result = _mul_div(commission, step.multiplier, SCALE)
+            else:
+                result = _eval_formula(step.formula, dict(registers, commission=commission))
+                result = np.broadcast_to(result, (count,))
+            if step.bonus:
+                result = result + step.bonus
+            commission = _normalize(np.where(mask, result, commission))
+
+        return [from_fixed(value) for value in commission.tolist()]
+
+    def evaluate_transactions(self, transactions: List[Dict[str, Any]]) -> List[Decimal]:
+        """Evaluate the program over transaction documents."""
+        return self.evaluate(
+            [t['total_amount'] for t in transactions],
+            [t.get('product_id') for t in transactions],
+            [t.get('quantity') or 0 for t in transactions],
+            [t.get('unit_price') or 0 for t in transactions],
+        )
+
+
+def compile_plan(plan: Dict[str, Any]) -> CompiledPlan:
+    """Compile a plan document's rules into an evaluation program."""
+    rules = plan.get('rules') or []
+    if isinstance(rules, dict):
+        rules = rules.get('rules') or []
+    if not rules:
+        rules = DEFAULT_RULES
+    steps = [_compile_rule(rule) for rule in order_rules(rules)]
+    return CompiledPlan(plan.get('id', ''), str(plan.get('updated_at', '')), steps)
+
+
+def get_compiled_plan(plan: Dict[str, Any]) -> CompiledPlan:
+    """Return the cached program for this plan version, compiling it if needed."""
+    version = str(plan.get('updated_at', ''))
+    cached = _PROGRAM_CACHE.get(plan['id'])
+    if cached and cached[0] == version:
+        return cached[1]
+    program = compile_plan(plan)
+    _PROGRAM_CACHE[plan['id']] = (version, program)
+    return program
@@ -0,0 +1,209 @@
+"""Durable commission calculation queue.
+
+Transaction ids are persisted in a Mongo collection and drained by a pool of
+asyncio workers that claim micro-batches under a lease, so work survives a
+restart and a crashed worker's batch is picked up again once its lease expires.
+A failing batch is bisected, so only the items that fail on their own are
+retried and eventually dead-lettered. Retries back off exponentially: each
+bisection step waits longer before trying its halves, and an item that fails
+on its own is not claimable again until `retry_base_seconds * 2**(attempts-1)`
+(capped at `retry_max_seconds`) has passed, so a database outage is not
+hammered by every worker at once. Delivery is at-least-once; the handler must
+tolerate seeing a transaction again.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CommissionQueue:
+    def __init__(
+        self,
+        collection,
+        handler: Callable[[List[str]], Awaitable[None]],
+        workers: int = 4,
+        batch_size: int = 200,
+        max_pending: int = 100_000,
+        poll_interval: float = 0.5,
+        lease_seconds: int = 120,
+        max_attempts: int = 5,
+        enqueue_timeout: float = 5.0,
+        retry_base_seconds: float = 1.0,
+        retry_max_seconds: float = 300.0,
+    ):
+        self.collection = collection
+        self.handler = handler
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.enqueue_timeout = enqueue_timeout
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._stopping = False
+        self._pending_estimate = 0
+        self.processed_total = 0
+        self.failed_total = 0
+        self.retried_total = 0
+        self.batches_total = 0
+        self.last_batch_seconds = 0.0
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._stopping = False
+        self._pending_estimate = await self.collection.count_documents({"status": "pending"})
+        self._tasks = [asyncio.create_task(self._worker(n)) for n in range(self.workers)]
+        logger.info("Commission queue started with %d workers", self.workers)
+
+    async def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def enqueue(self, transaction_ids: List[str]):
+        """Persist transaction ids for calculation, waiting while the queue is above its high-water mark."""
+        if not transaction_ids:
+            return
+        if self._pending_estimate >= self.max_pending:
+            self._drained.clear()
+            try:
+                await asyncio.wait_for(self._drained.wait(), timeout=self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Commission queue above %d pending items, enqueueing anyway", self.max_pending)
+
+        now = datetime.now(timezone.utc)
+        await self.collection.insert_many([
+            {"transaction_id": transaction_id, "status": "pending", "attempts": 0, "enqueued_at": now}
+            for transaction_id in transaction_ids
+        ], ordered=False)
+        self._pending_estimate += len(transaction_ids)
+        self._wakeup.set()
+
+    async def _claim(self) -> List[dict]:
+        now = datetime.now(timezone.utc)
+        claimable = {"$or": [
+            {"status": "pending", "available_at": {"$not": {"$gt": now}}},
+            {"status": "processing", "lease_expires_at": {"$lt": now}}
+        ]}
+        candidates = await self.collection.find(claimable, {"_id": 1}).sort("enqueued_at", 1).limit(self.batch_size).to_list(self.batch_size)
+        if not candidates:
+            return []
+
+        lease = str(uuid.uuid4())
+        await self.collection.update_many(
+            {"_id": {"$in": [c['_id'] for c in candidates]}, **claimable},
+            {
+                "$set": {
+                    "status": "processing",
+                    "lease": lease,
+                    "lease_expires_at": now + timedelta(seconds=self.lease_seconds)
+                },
+                "$inc": {"attempts": 1}
+            }
+        )
+        return await self.collection.find({"lease": lease}).to_list(self.batch_size)
+
+    async def _worker(self, number: int):
+        while not self._stopping:
+            try:
+                items = await self._claim()
+            except Exception:
+                logger.exception("Commission queue worker %d failed to claim work", number)
+                items = []
+
+            if not items:
+                self._pending_estimate = 0
+                self._drained.set()
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._process(items)
+
+    def _backoff(self, attempts: int) -> float:
+        return min(self.retry_base_seconds * 2 ** max(attempts - 1, 0), self.retry_max_seconds)
+
+    async def _process(self, items: List[dict], depth: int = 0):
+        ids = [item['_id'] for item in items]
+        started = time.monotonic()
+        try:
+            await self.handler([item['transaction_id'] for item in items])
+        except Exception as e:
+            if len(items) > 1:
+                delay = self._backoff(depth + 1)
+                logger.warning("Commission batch of %d transactions failed, bisecting in %.1fs: %s", len(items), delay, e)
+                # Keep the lease for as long as the pause, so the batch is not claimed twice meanwhile
+                await self.collection.update_many(
+                    {"_id": {"$in": ids}},
+                    {"$set": {"lease_expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds + delay)}}
+                )
+                await asyncio.sleep(delay)
+                middle = len(items) // 2
+                await self._process(items[:middle], depth + 1)
+                await self._process(items[middle:], depth + 1)
+                return
+            logger.exception("Commission calculation for transaction %s failed", items[0]['transaction_id'])
+            item = items[0]
+            attempts = item.get('attempts', 0)
+            if attempts < self.max_attempts:
+                await self.collection.update_one({"_id": item['_id']}, {
+                    "$set": {
+                        "status": "pending",
+                        "error": str(e),
+                        "available_at": datetime.now(timezone.utc) + timedelta(seconds=self._backoff(attempts))
+                    },
+                    "$unset": {"lease": ""}
+                })
+                self.retried_total += 1
+            else:
+                await self.collection.update_one({"_id": item['_id']}, {"$set": {"status": "failed", "error": str(e)}, "$unset": {"lease": ""}})
+                self.failed_total += 1
+            return
+
+        await self.collection.delete_many({"_id": {"$in": ids}})
+        self.processed_total += len(ids)
+        self.batches_total += 1
+        self.last_batch_seconds = time.monotonic() - started
+        self._pending_estimate = max(0, self._pending_estimate - len(ids))
+        if self._pending_estimate < self.max_pending:
+            self._drained.set()
+
+    async def stats(self) -> dict:
+        """Report queue depth, lag of the oldest pending item and worker counters."""
+        pending = await self.collection.count_documents({"status": "pending"})
+        processing = await self.collection.count_documents({"status": "processing"})
+        failed = await self.collection.count_documents({"status": "failed"})
+        oldest: Optional[dict] = await self.collection.find_one({"status": "pending"}, sort=[("enqueued_at", 1)])
+        lag_seconds = 0.0
+        if oldest:
+            lag_seconds = (datetime.now(timezone.utc) - oldest['enqueued_at']).total_seconds()
+        return {
+            "pending": pending,
+            "processing": processing,
+            "failed": failed,
+            "lag_seconds": round(lag_seconds, 3),
+            "workers": len(self._tasks),
+            "processed_total": self.processed_total,
+            "failed_total": self.failed_total,
+            "retried_total": self.retried_total,
+            "batches_total": self.batches_total,
+            "last_batch_seconds": round(self.last_batch_seconds, 3)
+        }
@@ -0,0 +1,150 @@
+"""Split credit for team-sold transactions.
+
+A credit assignment divides a transaction's commission between several
+parties by percentage, producing one calculation per party. allocate()
+splits an amount exactly. Each share is rounded down to 4 places. The
+leftover 0.0001 units go to the largest remainders, with ties going to the
+earlier party, so the shares always add up to the original amount.
+
+Spiff awards record the same per-party shares in their `credits`, and a
+re-split recomputes them for the new parties.
+
+A re-split first marks the old calculations superseded, guarded on their
+status, so one approved in the meantime aborts it. It then inserts the new
+calculations and deletes only the superseded ones. A re-split interrupted
+part way is finished (or undone, if the new calculations never landed) by
+the next re-split of that transaction. The affected reps' rollups are
+recomputed afterwards.
+"""
+import uuid
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from utils.commission_engine import from_fixed, to_fixed
+from utils.rollups import rebuild
+
+# Money fields divided between the parties; final_amount is rebuilt from them
+SPLIT_FIELDS = ("base_amount", "commission_amount", "adjustments", "holdback_amount")
+
+# Calculations a re-split is replacing, between taking them over and deleting them
+SUPERSEDED = "superseded"
+
+
+class SplitConflict(ValueError):
+    """Raised when a transaction's calculations can no longer be re-split."""
+
+
+def party(entry: Dict[str, Any]) -> Optional[str]:
+    return entry.get('user_id') or entry.get('sales_rep_id')
+
+
+def allocate(amount: Any, percents: List[Decimal]) -> List[Decimal]:
+    """Split `amount` by `percents` (summing to 100) into shares that sum to it exactly."""
+    units = to_fixed(amount)
+    sign, units = (-1, -units) if units < 0 else (1, units)
+    scaled = [to_fixed(p) for p in percents]
+    total = sum(scaled)
+    shares = [units * p // total for p in scaled]
+    remainders = [units * p % total for p in scaled]
+    leftover = units - sum(shares)
+    for i in sorted(range(len(shares)), key=lambda i: -remainders[i])[:leftover]:
+        shares[i] += 1
+    return [from_fixed(sign * s) for s in shares]
+
+
+def party_credits(amount: Any, calculations: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Each credited party's share of a spiff award, split like the calculations themselves."""
+    shares = allocate(amount, [Decimal(str(c.get('credit_percent', 100))) for c in calculations])
+    return [
+        {"calculation_id": c['id'], "sales_rep_id": c['sales_rep_id'], "amount": share}
+        for c, share in zip(calculations, shares)
+    ]
+
+
+def split_calculation(calculation: Dict[str, Any], assignment: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """One calculation per credited party, carrying its share of every money field."""
+    entries = [e for e in assignment['assignments'] if party(e)]
+    percents = [Decimal(str(e.get('credit_percent', 0))) for e in entries]
+    shares = {f: allocate(calculation.get(f) or 0, percents) for f in SPLIT_FIELDS}
+    docs = []
+    for i, (entry, percent) in enumerate(zip(entries, percents)):
+        doc = {**calculation, **{f: shares[f][i] for f in SPLIT_FIELDS}}
+        doc.update(
+            id=str(uuid.uuid4()),
+            sales_rep_id=party(entry),
+            final_amount=doc['commission_amount'] + doc['adjustments'],
+            credit_percent=percent,
+            credit_assignment_id=assignment['id']
+        )
+        docs.append(doc)
+    return docs
+
+
+async def load_assignments(collection, transaction_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Latest credit assignment per transaction, fetched with a single $in query."""
+    assignments = await collection.find(
+        {"transaction_id": {"$in": list(transaction_ids)}}, {"_id": 0}
+    ).sort("created_at", 1).to_list(None)
+    return {a['transaction_id']: a for a in assignments}
+
+
+async def _recover(db, transaction_id: str):
+    """Finish or undo a re-split of the transaction that was interrupted after superseding its calculations."""
+    superseded = await db.commission_calculations.find(
+        {"transaction_id": transaction_id, "status": SUPERSEDED}, {"_id": 0, "id": 1, "superseded_by": 1}
+    ).to_list(None)
+    for assignment_id in {c['superseded_by'] for c in superseded}:
+        replaced = await db.commission_calculations.find_one(
+            {"transaction_id": transaction_id, "credit_assignment_id": assignment_id, "status": {"$ne": SUPERSEDED}}, {"_id": 1}
+        )
+        if replaced:
+            await db.commission_calculations.delete_many({"transaction_id": transaction_id, "status": SUPERSEDED, "superseded_by": assignment_id})
+        else:
+            await db.commission_calculations.update_many(
+                {"transaction_id": transaction_id, "status": SUPERSEDED, "superseded_by": assignment_id},
+                {"$set": {"status": "calculated"}, "$unset": {"superseded_by": ""}}
+            )
+
+
+async def resplit(db, assignment: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Replace a calculated transaction's calculations with split ones; returns (removed, created)."""
+    transaction_id = assignment['transaction_id']
+    await _recover(db, transaction_id)
+    calculations = await db.commission_calculations.find({"transaction_id": transaction_id}, {"_id": 0}).to_list(None)
+    if not calculations:
+        # Not calculated yet; the split is applied when it is
+        return [], []
+    if any(c['status'] != "calculated" for c in calculations):
+        raise SplitConflict("Commissions for this transaction are already approved or paid")
+
+    # Only calculations still unapproved and unclaimed are taken over; anything else aborts the split
+    ids = [c['id'] for c in calculations]
+    taken = await db.commission_calculations.update_many(
+        {"id": {"$in": ids}, "status": "calculated", "payout_run_id": None, "payout_id": None},
+        {"$set": {"status": SUPERSEDED, "superseded_by": assignment['id']}}
+    )
+    if taken.modified_count != len(ids):
+        await db.commission_calculations.update_many(
+            {"id": {"$in": ids}, "status": SUPERSEDED, "superseded_by": assignment['id']},
+            {"$set": {"status": "calculated"}, "$unset": {"superseded_by": ""}}
+        )
+        raise SplitConflict("Commissions for this transaction are already approved or paid")
+
+    combined = dict(calculations[0])
+    for field in SPLIT_FIELDS + ("final_amount",):
+        combined[field] = sum((Decimal(c.get(field) or 0) for c in calculations), Decimal("0"))
+    docs = split_calculation(combined, assignment)
+
+    await db.commission_calculations.insert_many(docs)
+    await db.commission_calculations.delete_many({"id": {"$in": ids}, "status": SUPERSEDED})
+    awards = await db.spiff_awards.find({"transaction_id": transaction_id}, {"_id": 0, "id": 1, "amount": 1}).to_list(None)
+    if awards:
+        await db.spiff_awards.bulk_write([
+            UpdateOne({"id": a['id']}, {"$set": {"credits": party_credits(a['amount'], docs)}}) for a in awards
+        ], ordered=False)
+    # Recomputed rather than incremented, so repeating this after a crash converges
+    for rep_id in sorted({c['sales_rep_id'] for c in calculations + docs}):
+        await rebuild(db, repair=True, sales_rep_id=rep_id)
+    return calculations, docs
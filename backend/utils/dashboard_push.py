@@ -0,0 +1,144 @@
+"""Push-based dashboard updates.
+
+Instead of clients re-polling the whole dashboard, the endpoints that change
+a section (earnings, quota, spiffs, approvals, tickets) mark it dirty for the
+affected users. Marks are coalesced for `window` seconds. Then each dirty
+section is recomputed once, compared with the cached snapshot, and only the
+fields that actually changed are published as a `dashboard_delta` on the
+user's `dashboard:<id>` topic. Sections that are the same for everyone
+(spiffs) are computed once and published on the shared `dashboard` topic.
+
+The coalesced marks themselves are what crosses workers: a flush emits them
+on the `dashboard_dirty` control topic, and every worker recomputes only the
+sections whose topic has a socket on that worker. Nobody watching a user's
+dashboard means no queries for it, and each worker diffs against the
+snapshots it sent its own sockets.
+"""
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+SECTIONS = ("earnings", "quota", "spiffs", "approvals", "tickets")
+GLOBAL_SECTIONS = ("spiffs",)
+SHARED_TOPIC = "dashboard"
+DIRTY_TOPIC = "dashboard_dirty"
+ALL_USERS = None
+
+
+def dashboard_topic(user_id: str) -> str:
+    return f"{SHARED_TOPIC}:{user_id}"
+
+
+class DashboardPush:
+    def __init__(
+        self,
+        compute: Callable[[str, Optional[str]], Awaitable[Dict[str, Any]]],
+        emit: Callable[[str, Any], Awaitable[None]],
+        deliver: Callable[[str, Any], Any],
+        subscribed: Callable[[str], bool],
+        window: float = 1.0,
+        max_snapshots: int = 10_000,
+    ):
+        self.compute = compute
+        self.emit = emit
+        self.deliver = deliver
+        self.subscribed = subscribed
+        self.window = window
+        self.max_snapshots = max_snapshots
+        self._snapshots: "OrderedDict[Optional[str], Dict[str, Any]]" = OrderedDict()
+        self._dirty: Dict[Optional[str], Set[str]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self.marks_total = 0
+        self.flushes_total = 0
+        self.skipped_total = 0
+        self.deltas_total = 0
+
+    async def snapshot(self, user_id: str) -> Dict[str, Any]:
+        """Compute every section for a user, cache it and return it (sent when a client subscribes)."""
+        personal: Dict[str, Any] = {}
+        shared: Dict[str, Any] = {}
+        for section in SECTIONS:
+            target = shared if section in GLOBAL_SECTIONS else personal
+            target.update(await self.compute(section, user_id))
+        self._remember(user_id, personal)
+        self._remember(ALL_USERS, {**self._snapshots.get(ALL_USERS, {}), **shared})
+        return {**personal, **shared}
+
+    def mark(self, user_ids: Iterable[Optional[str]], *sections: str):
+        """Record that `sections` changed for `user_ids`; global sections ignore the users."""
+        for section in sections:
+            targets = [ALL_USERS] if section in GLOBAL_SECTIONS else [u for u in user_ids if u]
+            for user_id in targets:
+                self._dirty.setdefault(user_id, set()).add(section)
+                self.marks_total += 1
+        if self._dirty and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Send the coalesced marks to every worker (this one included)."""
+        dirty, self._dirty = self._dirty, {}
+        self.flushes_total += 1
+        if dirty:
+            await self.emit(DIRTY_TOPIC, {"dirty": [[user_id, sorted(sections)] for user_id, sections in dirty.items()]})
+
+    def receive(self, text: str):
+        """Control-topic listener: push the marked sections to this worker's subscribers."""
+        try:
+            dirty = json.loads(text)["dirty"]
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Ignoring malformed dashboard marks: %r", text)
+            return
+        asyncio.create_task(self._push(dirty))
+
+    async def _push(self, dirty):
+        for user_id, sections in dirty:
+            topic = SHARED_TOPIC if user_id is ALL_USERS else dashboard_topic(user_id)
+            if not self.subscribed(topic):
+                # Nobody here is watching; drop the stale snapshot so a later subscribe starts fresh
+                self._snapshots.pop(user_id, None)
+                self.skipped_total += 1
+                continue
+            try:
+                await self._publish_delta(user_id, set(sections), topic)
+            except Exception:
+                logger.exception("Dashboard update for %s failed", user_id or "all users")
+
+    async def _publish_delta(self, user_id: Optional[str], sections: Set[str], topic: str):
+        values: Dict[str, Any] = {}
+        for section in sections:
+            values.update(await self.compute(section, user_id))
+        previous = self._snapshots.get(user_id, {})
+        delta = {k: v for k, v in values.items() if previous.get(k, object()) != v}
+        if not delta:
+            return
+        self._remember(user_id, {**previous, **delta})
+        self.deltas_total += 1
+        self.deliver(topic, {"type": "dashboard_delta", "data": delta})
+
+    def _remember(self, user_id: Optional[str], values: Dict[str, Any]):
+        self._snapshots[user_id] = values
+        self._snapshots.move_to_end(user_id)
+        while len(self._snapshots) > self.max_snapshots:
+            self._snapshots.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window_seconds": self.window,
+            "snapshots": len(self._snapshots),
+            "dirty": sum(len(s) for s in self._dirty.values()),
+            "marks_total": self.marks_total,
+            "flushes_total": self.flushes_total,
+            "skipped_total": self.skipped_total,
+            "deltas_total": self.deltas_total
+        }
@@ -0,0 +1,178 @@
+"""In-memory eligibility matrix consulted during commission calculation.
+
+Rules are keyed by (product_type, sales_channel, customer_segment). For each
+key, the effective ranges of its rules are flattened into sorted segments
+that do not overlap. Looking up a transaction is then a dict probe plus a
+bisect on its date. Where ranges overlap, the rule that started last wins.
+A rule may use "*" for any dimension, and the most specific matching key is
+used.
+
+The index is loaded at startup and then updated one key at a time. Writes in
+this process update it directly. Writes made by other workers arrive through
+a change stream on eligibility_rules. Where change streams are unavailable
+(standalone mongod), the index is reloaded every `refresh_seconds` instead.
+"""
+from bisect import bisect_right
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_EVEN
+from itertools import product
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from utils.change_feed import ChangeFollower
+from utils.periods import as_utc, with_utc
+
+WILDCARD = "*"
+DIMENSIONS = ("product_type", "sales_channel", "customer_segment")
+FOUR_PLACES = Decimal("0.0001")
+
+Key = Tuple[str, str, str]
+
+# Probe order: exact key first, then keys with more and more wildcards
+_PATTERNS = sorted(product((False, True), repeat=len(DIMENSIONS)), key=lambda p: (sum(p), p))
+
+
+def _normalized(rule: Dict[str, Any]) -> Dict[str, Any]:
+    return with_utc(rule, "effective_start", "effective_end")
+
+
+def rule_key(rule: Dict[str, Any]) -> Key:
+    return tuple(str(rule.get(d) or WILDCARD) for d in DIMENSIONS)
+
+
+class _Timeline:
+    """Non-overlapping segments of one key's rules; winners[i] applies from boundaries[i]."""
+
+    def __init__(self, rules: Iterable[Dict[str, Any]]):
+        rules = list(rules)
+        points = sorted({r['effective_start'] for r in rules} | {r['effective_end'] for r in rules if r.get('effective_end')})
+        self.boundaries: List[datetime] = []
+        self.winners: List[Optional[Dict[str, Any]]] = []
+        for point in points:
+            active = [r for r in rules if r['effective_start'] <= point and (not r.get('effective_end') or point < r['effective_end'])]
+            winner = max(active, key=lambda r: (r['effective_start'], r.get('created_at') or r['effective_start']), default=None)
+            if self.winners and self.winners[-1] is winner:
+                continue
+            self.boundaries.append(point)
+            self.winners.append(winner)
+
+    def find(self, when: datetime) -> Optional[Dict[str, Any]]:
+        i = bisect_right(self.boundaries, when) - 1
+        return self.winners[i] if i >= 0 else None
+
+
+class EligibilityIndex:
+    def __init__(self, refresh_seconds: float = 60.0):
+        self.refresh_seconds = refresh_seconds
+        self._rules: Dict[str, Dict[str, Any]] = {}
+        self._by_key: Dict[Key, Dict[str, Dict[str, Any]]] = {}
+        self._timelines: Dict[Key, _Timeline] = {}
+        self._follower: Optional[ChangeFollower] = None
+        self.lookups = 0
+        self.matches = 0
+        self.rebuilds = 0
+
+    def __len__(self) -> int:
+        return len(self._rules)
+
+    def load(self, rules: Iterable[Dict[str, Any]]):
+        """Replace the whole index."""
+        self._rules, self._by_key, self._timelines = {}, {}, {}
+        for rule in map(_normalized, rules):
+            self._rules[rule['id']] = rule
+            self._by_key.setdefault(rule_key(rule), {})[rule['id']] = rule
+        for key in self._by_key:
+            self._rebuild(key)
+
+    def upsert(self, rule: Dict[str, Any]):
+        """Add or replace one rule, rebuilding only the keys it moved between."""
+        rule = _normalized(rule)
+        previous = self._rules.get(rule['id'])
+        if previous is not None and rule_key(previous) != rule_key(rule):
+            self.remove(rule['id'])
+        self._rules[rule['id']] = rule
+        self._by_key.setdefault(rule_key(rule), {})[rule['id']] = rule
+        self._rebuild(rule_key(rule))
+
+    def remove(self, rule_id: str):
+        rule = self._rules.pop(rule_id, None)
+        if rule is None:
+            return
+        key = rule_key(rule)
+        self._by_key.get(key, {}).pop(rule_id, None)
+        self._rebuild(key)
+
+    def _rebuild(self, key: Key):
+        rules = self._by_key.get(key)
+        if rules:
+            self._timelines[key] = _Timeline(rules.values())
+        else:
+            self._by_key.pop(key, None)
+            self._timelines.pop(key, None)
+        self.rebuilds += 1
+
+    def lookup(self, product_type: Optional[str], sales_channel: Optional[str], customer_segment: Optional[str],
+               when: datetime) -> Optional[Dict[str, Any]]:
+        """Return the rule in effect for a transaction, or None when no rule covers it."""
+        self.lookups += 1
+        when = as_utc(when)
+        values = (product_type, sales_channel, customer_segment)
+        for pattern in _PATTERNS:
+            if any(not wild and value is None for wild, value in zip(pattern, values)):
+                continue
+            key = tuple(WILDCARD if wild else str(value) for wild, value in zip(pattern, values))
+            timeline = self._timelines.get(key)
+            if timeline is None:
+                continue
+            rule = timeline.find(when)
+            if rule is not None:
+                self.matches += 1
+                return rule
+        return None
+
+    def apply(self, transactions: List[Dict[str, Any]], commissions: List[Decimal],
+              product_types: Dict[str, str]) -> Tuple[List[Decimal], List[Optional[str]]]:
+        """Adjust plan commissions by the matching rules; returns (commissions, rule id per row)."""
+        adjusted, applied = [], []
+        for transaction, commission in zip(transactions, commissions):
+            rule = self.lookup(
+                product_types.get(transaction.get('product_id')),
+                transaction.get('sales_channel'),
+                transaction.get('customer_segment'),
+                transaction['transaction_date']
+            )
+            if rule is not None:
+                if not rule.get('eligible', True):
+                    commission = Decimal("0").quantize(FOUR_PLACES)
+                elif rule.get('commission_rate_override') is not None:
+                    amount = Decimal(str(transaction['total_amount']))
+                    rate = Decimal(str(rule['commission_rate_override']))
+                    commission = (amount * rate / 100).quantize(FOUR_PLACES, rounding=ROUND_HALF_EVEN)
+            adjusted.append(commission)
+            applied.append(rule['id'] if rule is not None else None)
+        return adjusted, applied
+
+    async def start(self, collection):
+        """Load every rule and keep following changes made by other workers."""
+        await self._reload(collection)
+        if self._follower is None:
+            self._follower = ChangeFollower("Eligibility", self.upsert, lambda: self._reload(collection), self.refresh_seconds)
+            self._follower.start(collection)
+
+    async def stop(self):
+        if self._follower is not None:
+            await self._follower.stop()
+            self._follower = None
+
+    async def _reload(self, collection):
+        self.load(await collection.find({}, {"_id": 0}).to_list(None))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rules": len(self._rules),
+            "keys": len(self._timelines),
+            "segments": sum(len(t.boundaries) for t in self._timelines.values()),
+            "lookups": self.lookups,
+            "matches": self.matches,
+            "rebuilds": self.rebuilds,
+            "change_stream": self._follower is not None and self._follower.watching
+        }
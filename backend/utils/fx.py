@@ -0,0 +1,181 @@
+"""FX rates with effective dates, cached in memory for bulk conversion.
+
+Rates live in `fx_rates`, one document per (from_currency, to_currency,
+effective_date), meaning "one unit of from_currency buys `rate` units of
+to_currency from that date on". The cache keeps each pair as two parallel
+lists sorted by date, so finding the rate for a date is one bisect. When a
+pair has no direct rate, the cache tries the inverse of the reverse pair and
+then a cross rate through the base currency.
+
+Commissions, rollups and payout totals are all kept in the base currency.
+normalize() converts a calculation batch into it in memory, and payouts
+record the rate used to convert their net amount into the payee's currency.
+Like the spiff and eligibility indexes, the cache follows `fx_rates` through
+a change stream, falling back to a periodic reload where change streams are
+unavailable. Whenever that brings in rates the cache did not have, it calls
+`on_change`. The API uses this to re-queue transactions parked for a missing
+rate, so each worker retries them only once it can actually convert them.
+"""
+import logging
+from bisect import bisect_right
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_EVEN
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from utils.change_feed import ChangeFollower
+from utils.periods import as_utc
+
+logger = logging.getLogger(__name__)
+
+FOUR_PLACES = Decimal("0.0001")
+ONE = Decimal("1")
+
+
+class FXRateMissing(LookupError):
+    """Raised when no rate for a currency pair is in effect on a date."""
+
+
+class _Series:
+    def __init__(self, rates: Dict[datetime, Decimal]):
+        self.dates = sorted(rates)
+        self.rates = [rates[d] for d in self.dates]
+
+    def at(self, when: datetime) -> Optional[Decimal]:
+        i = bisect_right(self.dates, when) - 1
+        return self.rates[i] if i >= 0 else None
+
+
+class FXRateCache:
+    def __init__(self, base_currency: str = "USD", refresh_seconds: float = 300.0,
+                 on_change: Optional[Callable[[], Awaitable[None]]] = None):
+        self.base_currency = base_currency
+        self.refresh_seconds = refresh_seconds
+        self.on_change = on_change
+        self._rates: Dict[Tuple[str, str], Dict[datetime, Decimal]] = {}
+        self._series: Dict[Tuple[str, str], _Series] = {}
+        self._follower: Optional[ChangeFollower] = None
+        self.conversions = 0
+
+    def __len__(self) -> int:
+        return sum(len(rates) for rates in self._rates.values())
+
+    @staticmethod
+    def _pair(rate: Dict[str, Any]) -> Tuple[str, str]:
+        return rate['from_currency'], rate['to_currency']
+
+    def load(self, rates: Iterable[Dict[str, Any]]) -> bool:
+        """Replace the whole table; returns whether it differs from the previous one."""
+        previous = self._rates
+        self._rates, self._series = {}, {}
+        for rate in rates:
+            self._rates.setdefault(self._pair(rate), {})[as_utc(rate['effective_date'])] = Decimal(str(rate['rate']))
+        for pair in self._rates:
+            self._series[pair] = _Series(self._rates[pair])
+        return self._rates != previous
+
+    def upsert(self, rate: Dict[str, Any]):
+        pair = self._pair(rate)
+        self._rates.setdefault(pair, {})[as_utc(rate['effective_date'])] = Decimal(str(rate['rate']))
+        self._series[pair] = _Series(self._rates[pair])
+
+    def remove(self, rate: Dict[str, Any]):
+        pair = self._pair(rate)
+        rates = self._rates.get(pair, {})
+        rates.pop(as_utc(rate['effective_date']), None)
+        if rates:
+            self._series[pair] = _Series(rates)
+        else:
+            self._rates.pop(pair, None)
+            self._series.pop(pair, None)
+
+    def _direct(self, from_currency: str, to_currency: str, when: datetime) -> Optional[Decimal]:
+        series = self._series.get((from_currency, to_currency))
+        if series is not None:
+            rate = series.at(when)
+            if rate is not None:
+                return rate
+        series = self._series.get((to_currency, from_currency))
+        rate = series.at(when) if series is not None else None
+        return ONE / rate if rate else None
+
+    def rate(self, from_currency: str, to_currency: str, when: datetime) -> Decimal:
+        """Rate from `from_currency` to `to_currency` in effect at `when`; raises FXRateMissing."""
+        if from_currency == to_currency:
+            return ONE
+        when = as_utc(when)
+        rate = self._direct(from_currency, to_currency, when)
+        if rate is None and self.base_currency not in (from_currency, to_currency):
+            via_base = self._direct(from_currency, self.base_currency, when)
+            from_base = self._direct(self.base_currency, to_currency, when)
+            if via_base is not None and from_base is not None:
+                rate = via_base * from_base
+        if rate is None:
+            raise FXRateMissing(f"No {from_currency}/{to_currency} rate in effect on {when:%Y-%m-%d}")
+        return rate
+
+    def convert(self, amount: Any, from_currency: str, to_currency: str, when: datetime) -> Tuple[Decimal, Decimal]:
+        """(converted amount, rate used)."""
+        rate = self.rate(from_currency, to_currency, when)
+        self.conversions += 1
+        return (Decimal(str(amount)) * rate).quantize(FOUR_PLACES, rounding=ROUND_HALF_EVEN), rate
+
+    def normalize(self, transactions: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """Copies of the transactions with amounts in the base currency, and those lacking a rate.
+
+        Converted copies carry base_amount and fx_rate; base-currency transactions pass through unchanged.
+        """
+        converted, missing = [], []
+        for transaction in transactions:
+            currency = transaction.get('currency') or self.base_currency
+            if currency == self.base_currency:
+                converted.append(transaction)
+                continue
+            try:
+                total, rate = self.convert(transaction['total_amount'], currency, self.base_currency, transaction['transaction_date'])
+            except FXRateMissing:
+                missing.append(transaction)
+                continue
+            converted.append({
+                **transaction,
+                "unit_price": (Decimal(str(transaction['unit_price'])) * rate).quantize(FOUR_PLACES, rounding=ROUND_HALF_EVEN),
+                "total_amount": total,
+                "base_amount": total,
+                "fx_rate": rate
+            })
+        return converted, missing
+
+    async def start(self, collection):
+        """Load the rate table and keep following changes made by other workers."""
+        await self._reload(collection)
+        if self._follower is None:
+            self._follower = ChangeFollower("FX rate", self._apply, lambda: self._reload(collection), self.refresh_seconds)
+            self._follower.start(collection)
+
+    async def stop(self):
+        if self._follower is not None:
+            await self._follower.stop()
+            self._follower = None
+
+    async def _reload(self, collection):
+        if self.load(await collection.find({}, {"_id": 0}).to_list(None)):
+            await self._changed()
+
+    async def _apply(self, rate: Dict[str, Any]):
+        self.upsert(rate)
+        await self._changed()
+
+    async def _changed(self):
+        if self.on_change is not None:
+            try:
+                await self.on_change()
+            except Exception:
+                logger.exception("FX rate change callback failed")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "base_currency": self.base_currency,
+            "pairs": len(self._series),
+            "rates": len(self),
+            "conversions": self.conversions,
+            "change_stream": self._follower is not None and self._follower.watching
+        }
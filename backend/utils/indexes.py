@@ -0,0 +1,260 @@
+"""Index registry for every collection the API queries.
+
+Indexes are declared next to the query shapes they serve and applied at
+startup. Run as a script to apply them by hand or to print an explain()
+report that flags registered queries still resolved by a collection scan:
+
+    python -m utils.indexes [--report]
+"""
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+# Every resource collection is addressed by its application-level `id`
+ID_COLLECTIONS = [
+    "users", "products", "transactions", "commission_calculations", "commission_plans",
+    "credit_assignments", "spiffs", "spiff_awards", "partners", "approval_workflows", "payouts", "payout_runs", "exports",
+    "reconciliations", "reconciliation_findings", "fx_rates",
+    "territories", "quotas", "forecasts", "tickets", "nfms", "eligibility_rules",
+    "data_source_mappings", "custom_roles", "custom_groups", "audit_logs",
+]
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("google_id", ASCENDING)], name="google_id", sparse=True),
+        IndexModel([("role", ASCENDING)], name="role"),
+    ],
+    "products": [
+        IndexModel([("sku", ASCENDING)], name="sku_unique", unique=True),
+    ],
+    "import_jobs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "transactions": [
+        IndexModel([("sales_rep_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="rep_created_id"),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_id"),
+        IndexModel([("batch_id", ASCENDING)], name="batch", sparse=True),
+        IndexModel([("transaction_date", ASCENDING), ("product_id", ASCENDING)], name="date_product"),
+        IndexModel([("status", ASCENDING)], name="pending_fx", partialFilterExpression={"status": "pending_fx"}),
+    ],
+    "commission_calculations": [
+        IndexModel([("sales_rep_id", ASCENDING), ("calculation_date", ASCENDING), ("status", ASCENDING)], name="rep_date_status"),
+        IndexModel([("transaction_id", ASCENDING)], name="transaction"),
+        IndexModel([("status", ASCENDING), ("calculation_date", ASCENDING)], name="status_date"),
+        IndexModel([("payout_run_id", ASCENDING), ("status", ASCENDING)], name="payout_run_status"),
+        # Only manual payouts stamp payout_id, so most calculations stay out of this index
+        IndexModel([("payout_id", ASCENDING)], name="payout", sparse=True),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_id"),
+    ],
+    "earnings_rollups": [
+        IndexModel([("sales_rep_id", ASCENDING), ("plan_id", ASCENDING), ("period_type", ASCENDING), ("period_key", ASCENDING)],
+                   name="rep_plan_period_unique", unique=True),
+        IndexModel([("plan_id", ASCENDING), ("period_type", ASCENDING), ("period_key", ASCENDING)], name="plan_period"),
+    ],
+    "commission_plans": [
+        IndexModel([("plan_type", ASCENDING), ("status", ASCENDING)], name="type_status"),
+    ],
+    "commission_queue": [
+        IndexModel([("status", ASCENDING), ("enqueued_at", ASCENDING)], name="status_enqueued"),
+        IndexModel([("lease", ASCENDING)], name="lease", sparse=True),
+    ],
+    "approval_workflows": [
+        IndexModel([("steps.approver_id", ASCENDING), ("steps.status", ASCENDING)], name="step_approver_status"),
+        IndexModel([("initiated_by", ASCENDING)], name="initiated_by"),
+    ],
+    "quotas": [
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING)], name="user_status"),
+    ],
+    "spiffs": [
+        IndexModel([("status", ASCENDING), ("start_date", ASCENDING), ("end_date", ASCENDING)], name="status_window"),
+    ],
+    "spiff_awards": [
+        IndexModel([("spiff_id", ASCENDING), ("transaction_id", ASCENDING)], name="spiff_transaction_unique", unique=True),
+        IndexModel([("credits.sales_rep_id", ASCENDING), ("awarded_at", DESCENDING)], name="credit_rep_awarded"),
+    ],
+    "credit_assignments": [
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_id"),
+        IndexModel([("transaction_id", ASCENDING), ("created_at", ASCENDING)], name="transaction_created"),
+    ],
+    "partners": [
+        IndexModel([("user_id", ASCENDING)], name="user"),
+        IndexModel([("status", ASCENDING)], name="status"),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_id"),
+    ],
+    "payouts": [
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="user_created_id"),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_id"),
+        IndexModel([("payout_run_id", ASCENDING), ("user_id", ASCENDING)], name="run_user_unique", unique=True,
+                   partialFilterExpression={"payout_run_id": {"$type": "string"}}),
+    ],
+    "payout_runs": [
+        IndexModel([("period_start", ASCENDING), ("period_end", ASCENDING)], name="period_unique", unique=True),
+    ],
+    "reconciliations": [
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING)], name="status_created"),
+    ],
+    "reconciliation_findings": [
+        IndexModel([("reconciliation_id", ASCENDING), ("kind", ASCENDING), ("key", ASCENDING)], name="reconciliation_kind_key_unique", unique=True),
+        IndexModel([("reconciliation_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="reconciliation_created_id"),
+    ],
+    "fx_rates": [
+        IndexModel([("from_currency", ASCENDING), ("to_currency", ASCENDING), ("effective_date", ASCENDING)], name="pair_date_unique", unique=True),
+    ],
+    "tickets": [
+        IndexModel([("submitted_by", ASCENDING), ("status", ASCENDING)], name="submitter_status"),
+    ],
+    "nfms": [
+        IndexModel([("user_id", ASCENDING)], name="user"),
+    ],
+    # Legacy unpartitioned events; new events go to monthly partitions (utils.audit_archive)
+    "audit_logs": [
+        IndexModel([("resource_type", ASCENDING), ("resource_id", ASCENDING), ("timestamp", ASCENDING)], name="resource_timestamp"),
+        IndexModel([("user_id", ASCENDING), ("timestamp", ASCENDING)], name="user_timestamp"),
+    ],
+}
+
+for _collection in ID_COLLECTIONS:
+    INDEXES.setdefault(_collection, []).insert(0, IndexModel([("id", ASCENDING)], name="id_unique", unique=True))
+
+_SAMPLE_DATE = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+# Representative filter/sort shapes of the endpoints, used by the explain report
+QUERIES: List[Dict[str, Any]] = [
+    {"name": "login", "collection": "users", "filter": {"email": "user@example.com"}},
+    {"name": "current_user", "collection": "users", "filter": {"id": "user-id"}},
+    {"name": "list_transactions", "collection": "transactions", "filter": {"sales_rep_id": "user-id"}, "sort": [("created_at", DESCENDING), ("id", DESCENDING)]},
+    {"name": "commission_report", "collection": "commission_calculations", "filter": {}, "sort": [("created_at", DESCENDING), ("id", DESCENDING)]},
+    {"name": "my_earnings", "collection": "commission_calculations", "filter": {"sales_rep_id": "user-id"}},
+    {"name": "payout_calculations", "collection": "commission_calculations", "filter": {
+        "sales_rep_id": "user-id", "calculation_date": {"$gte": _SAMPLE_DATE, "$lte": _SAMPLE_DATE}, "status": "approved"}},
+    {"name": "dashboard_rollup", "collection": "earnings_rollups", "filter": {
+        "sales_rep_id": "user-id", "plan_id": "*", "period_type": "month", "period_key": "2025-01"}},
+    {"name": "active_plan", "collection": "commission_plans", "filter": {"plan_type": "individual", "status": "active"}},
+    {"name": "queue_claim", "collection": "commission_queue", "filter": {"status": "pending"}, "sort": [("enqueued_at", ASCENDING)]},
+    {"name": "my_approvals", "collection": "approval_workflows", "filter": {
+        "steps": {"$elemMatch": {"approver_id": "user-id", "status": "pending"}}}},
+    {"name": "my_quota", "collection": "quotas", "filter": {"user_id": "user-id", "status": "active"}},
+    {"name": "active_spiffs", "collection": "spiffs", "filter": {
+        "status": "active", "start_date": {"$lte": _SAMPLE_DATE}, "end_date": {"$gte": _SAMPLE_DATE}}},
+    {"name": "spiff_replay", "collection": "transactions", "filter": {
+        "transaction_date": {"$gte": _SAMPLE_DATE, "$lt": _SAMPLE_DATE}, "product_id": {"$in": ["product-id"]}, "status": "processed"}},
+    {"name": "manual_payout_lines", "collection": "commission_calculations", "filter": {"payout_id": "payout-id"}},
+    {"name": "payout_run_claim", "collection": "commission_calculations", "filter": {
+        "calculation_date": {"$gte": _SAMPLE_DATE, "$lte": _SAMPLE_DATE}, "status": "approved", "payout_run_id": None, "payout_id": None}},
+    {"name": "payout_run_settle", "collection": "commission_calculations", "filter": {"payout_run_id": "run-id", "status": "approved"}},
+    {"name": "reconcile_payouts", "collection": "payouts", "filter": {
+        "user_id": {"$in": ["user-id"]}, "payout_period_start": {"$lte": _SAMPLE_DATE}, "payout_period_end": {"$gte": _SAMPLE_DATE}}},
+    {"name": "reconcile_calculations", "collection": "commission_calculations", "filter": {
+        "sales_rep_id": {"$in": ["user-id"]}, "calculation_date": {"$gte": _SAMPLE_DATE, "$lte": _SAMPLE_DATE}}},
+    {"name": "reconciliation_findings", "collection": "reconciliation_findings", "filter": {"reconciliation_id": "reconciliation-id"},
+     "sort": [("created_at", DESCENDING), ("id", DESCENDING)]},
+    {"name": "my_partner", "collection": "partners", "filter": {"user_id": "user-id"}},
+    {"name": "my_payouts", "collection": "payouts", "filter": {"user_id": "user-id"}, "sort": [("created_at", DESCENDING), ("id", DESCENDING)]},
+    {"name": "quota_attainment", "collection": "quotas", "filter": {
+        "user_id": "user-id", "status": "active", "period_start": {"$lte": _SAMPLE_DATE}, "period_end": {"$gte": _SAMPLE_DATE}}},
+    {"name": "open_tickets", "collection": "tickets", "filter": {"submitted_by": "user-id", "status": {"$in": ["new", "assigned"]}}},
+    {"name": "my_nfms", "collection": "nfms", "filter": {"user_id": "user-id"}},
+]
+
+
+async def duplicates(collection, keys: List[str], limit: int = 20) -> List[Dict[str, Any]]:
+    """Key values held by more than one document, with their ids; what blocks a unique index build."""
+    return await collection.aggregate([
+        {"$group": {"_id": {key: f"${key}" for key in keys}, "count": {"$sum": 1}, "ids": {"$push": "$id"}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$sort": {"count": -1}},
+        {"$limit": limit}
+    ], allowDiskUse=True).to_list(limit)
+
+
+async def ensure_indexes(db) -> Dict[str, List[str]]:
+    """Create all registered indexes; failures are logged per index rather than raised.
+
+    A unique index that existing data violates is reported with the duplicated values, which have to be
+    merged or removed by hand before the index can be built.
+    """
+    created = {}
+    for collection, models in INDEXES.items():
+        for model in models:
+            try:
+                names = await db[collection].create_indexes([model])
+            except OperationFailure as e:
+                name = model.document['name']
+                if e.code == DUPLICATE_KEY and model.document.get('unique'):
+                    found = await duplicates(db[collection], list(model.document['key']))
+                    logger.error("Unique index %s on %s not built, existing documents share a key: %s",
+                                 name, collection, "; ".join(f"{d['_id']} x{d['count']} (ids {d['ids'][:5]})" for d in found))
+                else:
+                    logger.error("Could not create index %s on %s: %s", name, collection, e)
+                continue
+            created.setdefault(collection, []).extend(names)
+    return created
+
+
+def _plan_stages(plan: Dict[str, Any]) -> List[str]:
+    if 'queryPlan' in plan:
+        # Slot-based execution engine wraps the classic plan tree
+        return _plan_stages(plan['queryPlan'])
+    stages = [plan.get('stage', '')]
+    if 'inputStage' in plan:
+        stages.extend(_plan_stages(plan['inputStage']))
+    for child in plan.get('inputStages', []):
+        stages.extend(_plan_stages(child))
+    return stages
+
+
+async def explain_report(db) -> List[Dict[str, Any]]:
+    """Explain every registered query and flag the ones that use a collection scan."""
+    report = []
+    for query in QUERIES:
+        cursor = db[query['collection']].find(query['filter'])
+        if query.get('sort'):
+            cursor = cursor.sort(query['sort'])
+        explanation = await cursor.explain()
+        winning_plan = explanation.get('queryPlanner', {}).get('winningPlan', {})
+        stages = _plan_stages(winning_plan)
+        report.append({
+            "query": query['name'],
+            "collection": query['collection'],
+            "stages": stages,
+            "collection_scan": "COLLSCAN" in stages
+        })
+    return report
+
+
+async def _main(show_report: bool):
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent.parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        created = await ensure_indexes(db)
+        for collection, names in created.items():
+            print(f"{collection}: {', '.join(names)}")
+        if show_report:
+            for row in await explain_report(db):
+                flag = "COLLSCAN" if row['collection_scan'] else "ok"
+                print(f"{flag:8} {row['query']:22} {row['collection']:26} {' <- '.join(row['stages'])}")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply registered MongoDB indexes")
+    parser.add_argument("--report", action="store_true", help="explain registered queries and flag collection scans")
+    args = parser.parse_args()
+    asyncio.run(_main(args.report))
@@ -0,0 +1,137 @@
+"""Non-financial metric (NFM) multipliers and gates for commission calculation.
+
+An NFM is met when actual_value reaches threshold_requirement percent of
+target_value, or 100% when no threshold is set. Each NFM applies within its
+measurement_period, which is a period key such as "2025-03", "2025-Q1",
+"2025" or "all":
+
+- A met NFM with a multiplier_effect scales the rep's commissions by it.
+- An unmet NFM that has a threshold_requirement makes the rep ineligible,
+  which is a multiplier of zero.
+
+Each user's effective multiplier and eligibility per period are computed
+once from all of that user's NFMs, and the profile is cached. Entries are
+invalidated when an NFM changes and expire after a TTL, so writes made by
+other workers are picked up too. A calculation batch therefore costs at most
+one $in query, for the reps that are not cached yet.
+"""
+import time
+from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_EVEN
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from utils.periods import period_keys
+
+FOUR_PLACES = Decimal("0.0001")
+ONE = Decimal("1")
+
+
+def attainment(nfm: Dict[str, Any]) -> Decimal:
+    target = Decimal(str(nfm.get('target_value') or 0))
+    if target == 0:
+        return Decimal("100")
+    return Decimal(str(nfm.get('actual_value') or 0)) * 100 / target
+
+
+def is_met(nfm: Dict[str, Any]) -> bool:
+    threshold = nfm.get('threshold_requirement')
+    return attainment(nfm) >= Decimal(str(threshold if threshold is not None else 100))
+
+
+def build_profile(nfms: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """Fold a user's NFMs into {multiplier, eligible, met, total} per measurement period."""
+    periods: Dict[str, Dict[str, Any]] = {}
+    for nfm in nfms:
+        period = periods.setdefault(str(nfm['measurement_period']), {"multiplier": ONE, "eligible": True, "met": 0, "total": 0})
+        period['total'] += 1
+        if is_met(nfm):
+            period['met'] += 1
+            if nfm.get('multiplier_effect') is not None:
+                period['multiplier'] *= Decimal(str(nfm['multiplier_effect']))
+        elif nfm.get('threshold_requirement') is not None:
+            period['eligible'] = False
+    met = sum(p['met'] for p in periods.values())
+    total = sum(p['total'] for p in periods.values())
+    return {
+        "periods": periods,
+        "met": met,
+        "total": total,
+        "compliance": (Decimal(met) * 100 / total).quantize(Decimal("0.01")) if total else None
+    }
+
+
+def effective_multiplier(profile: Dict[str, Any], when: datetime) -> Optional[Decimal]:
+    """Combined multiplier of every period `when` falls into; None when no NFM applies."""
+    multiplier = None
+    for key in period_keys(when).values():
+        period = profile['periods'].get(key)
+        if period is None:
+            continue
+        multiplier = (multiplier or ONE) * (period['multiplier'] if period['eligible'] else 0)
+    return multiplier
+
+
+def apply(profiles: Dict[str, Dict[str, Any]], transactions: List[Dict[str, Any]],
+          commissions: List[Decimal]) -> Tuple[List[Decimal], List[Optional[Decimal]]]:
+    """Scale each commission by its rep's NFM multiplier; returns (commissions, multiplier per row)."""
+    adjusted, multipliers = [], []
+    for transaction, commission in zip(transactions, commissions):
+        profile = profiles.get(transaction['sales_rep_id'])
+        multiplier = effective_multiplier(profile, transaction['transaction_date']) if profile else None
+        if multiplier is not None:
+            commission = (Decimal(commission) * multiplier).quantize(FOUR_PLACES, rounding=ROUND_HALF_EVEN)
+        adjusted.append(commission)
+        multipliers.append(multiplier)
+    return adjusted, multipliers
+
+
+class NFMCache:
+    def __init__(self, maxsize: int = 10_000, ttl_seconds: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def get_many(self, collection, user_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Profiles for `user_ids`, loading every uncached one with a single query."""
+        now = time.monotonic()
+        profiles, missing = {}, []
+        for user_id in set(user_ids):
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                profiles[user_id] = entry[1]
+                self.hits += 1
+            else:
+                missing.append(user_id)
+        if missing:
+            self.misses += len(missing)
+            grouped: Dict[str, List[Dict[str, Any]]] = {user_id: [] for user_id in missing}
+            async for nfm in collection.find({"user_id": {"$in": missing}}, {"_id": 0}):
+                grouped[nfm['user_id']].append(nfm)
+            for user_id, nfms in grouped.items():
+                profiles[user_id] = build_profile(nfms)
+                self._entries[user_id] = (now + self.ttl_seconds, profiles[user_id])
+                self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return profiles
+
+    def invalidate(self, user_id: Optional[str]):
+        if user_id and self._entries.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations
+        }
@@ -0,0 +1,87 @@
+"""Keyset pagination and NDJSON streaming for list endpoints.
+
+Pages are ordered by (created_at, id) descending and continued from an opaque
+cursor that encodes the last document returned, so each page is an index
+range scan no matter how deep the client has paged. With streaming enabled
+the whole result set is written as newline-delimited JSON straight from the
+Motor cursor instead of being buffered in memory.
+"""
+import base64
+import json
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from fastapi.responses import StreamingResponse
+
+SORT_FIELD = "created_at"
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 1000
+
+
+def encode_cursor(doc: Dict[str, Any], field: str = SORT_FIELD) -> str:
+    value = doc.get(field)
+    payload = {"v": value.isoformat() if isinstance(value, datetime) else value, "id": doc['id']}
+    if isinstance(value, datetime):
+        payload["t"] = "date"
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Any, str]:
+    """Return the (sort value, id) a cursor points at; raises ValueError on malformed input."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        value = payload["v"]
+        if payload.get("t") == "date":
+            value = datetime.fromisoformat(value)
+        return value, str(payload["id"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def keyset_filter(query: Dict[str, Any], cursor: Optional[str], field: str = SORT_FIELD) -> Dict[str, Any]:
+    """Restrict `query` to the documents that sort after `cursor` in descending order."""
+    if not cursor:
+        return query
+    value, last_id = decode_cursor(cursor)
+    after = {"$or": [
+        {field: {"$lt": value}},
+        {field: value, "id": {"$lt": last_id}}
+    ]}
+    return {"$and": [query, after]} if query else after
+
+
+async def paginate(collection, query: Dict[str, Any], limit: int = 100, cursor: Optional[str] = None,
+                   projection: Optional[Dict[str, Any]] = None, field: str = SORT_FIELD) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Fetch one page and the cursor of the next one (None on the last page)."""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    find = collection.find(keyset_filter(query, cursor, field), projection or {"_id": 0})
+    docs = await find.sort([(field, -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
+    if len(docs) <= limit:
+        return docs, None
+    docs = docs[:limit]
+    return docs, encode_cursor(docs[-1], field)
+
+
+def json_default(value: Any) -> Any:
+    if isinstance(value, Decimal):
+        # Money is emitted as a string so no precision is lost in transit
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+async def _ndjson_lines(cursor) -> AsyncIterator[bytes]:
+    async for doc in cursor:
+        yield (json.dumps(doc, default=json_default, separators=(",", ":")) + "\n").encode()
+
+
+def ndjson_response(collection, query: Dict[str, Any], cursor: Optional[str] = None,
+                    projection: Optional[Dict[str, Any]] = None, field: str = SORT_FIELD) -> StreamingResponse:
+    """Stream every matching document as NDJSON, optionally resuming after `cursor`."""
+    find = collection.find(keyset_filter(query, cursor, field), projection or {"_id": 0})
+    find = find.sort([(field, -1), ("id", -1)]).batch_size(STREAM_BATCH_SIZE)
+    return StreamingResponse(_ndjson_lines(find), media_type="application/x-ndjson")
@@ -0,0 +1,179 @@
+"""Period-close payout runs.
+
+A run pays every payee for one period in a single pass:
+
+1. claim     - every approved calculation in the period that no run or
+               manual payout has taken yet is stamped with the run id. This
+               fixes the run's input set, so calculations approved mid-run
+               cannot slip in or out, and claimed calculations can no longer
+               change status.
+2. payouts   - the claimed calculations are summed per payee in one $group.
+               Per-payee adjustments and deductions are applied, net amounts
+               are converted into each payee's payout currency, and every
+               Payout is written in one bulk_write of upserts keyed by
+               (payout_run_id, user_id).
+3. settle    - the claimed calculations are marked paid with their payout
+               id, batch by batch, and their rollup buckets move to paid.
+
+The run document in `payout_runs` is the manifest. It records the phase
+reached, the totals and a lease, and only one run can exist per period. Each
+phase is idempotent, so POSTing the same period again returns the finished
+run, or resumes an unfinished one whose worker died once its lease expires.
+"""
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, ROUND_HALF_EVEN
+from typing import Any, Dict, List, Optional
+
+from pymongo import UpdateMany, UpdateOne
+
+from models import Payout
+from utils.fx import FOUR_PLACES, FXRateCache
+from utils.rollups import apply_status_change
+
+logger = logging.getLogger(__name__)
+
+PHASES = ("claim", "payouts", "settle", "completed")
+SETTLE_BATCH_SIZE = 1000
+LEASE_SECONDS = 300
+
+
+def new_run(period_start: datetime, period_end: datetime, adjustments: Dict[str, Decimal],
+            deductions: Dict[str, Decimal], created_by: str, currencies: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    now = datetime.now(timezone.utc)
+    return {
+        "id": str(uuid.uuid4()),
+        "period_start": period_start,
+        "period_end": period_end,
+        "status": "queued",
+        "phase": "claim",
+        "adjustments": {k: Decimal(str(v)) for k, v in adjustments.items()},
+        "deductions": {k: Decimal(str(v)) for k, v in deductions.items()},
+        "currencies": dict(currencies or {}),
+        "payees": 0,
+        "calculation_count": 0,
+        "total_commission": Decimal("0"),
+        "total_net_payout": Decimal("0"),
+        "settled": 0,
+        "lease": None,
+        "error": None,
+        "created_by": created_by,
+        "created_at": now,
+        "updated_at": now
+    }
+
+
+async def acquire(collection, run_id: str, lease_seconds: int = LEASE_SECONDS) -> Optional[Dict[str, Any]]:
+    """Take the run's lease unless another worker holds a live one or it is already finished."""
+    now = datetime.now(timezone.utc)
+    fields = {"status": "running", "lease": now + timedelta(seconds=lease_seconds), "updated_at": now}
+    run = await collection.find_one_and_update(
+        {"id": run_id, "status": {"$ne": "completed"}, "$or": [{"lease": None}, {"lease": {"$lt": now}}]},
+        {"$set": fields},
+        projection={"_id": 0}
+    )
+    return {**run, **fields} if run else None
+
+
+async def _advance(collection, run: Dict[str, Any], phase: str, lease_seconds: int, **fields):
+    now = datetime.now(timezone.utc)
+    fields.update(phase=phase, lease=now + timedelta(seconds=lease_seconds), updated_at=now)
+    await collection.update_one({"id": run['id']}, {"$set": fields})
+    run.update(fields)
+
+
+async def execute(db, run: Dict[str, Any], lease_seconds: int = LEASE_SECONDS,
+                  batch_size: int = SETTLE_BATCH_SIZE, fx: Optional[FXRateCache] = None) -> Dict[str, Any]:
+    """Carry a leased run from its recorded phase to completion."""
+    runs = db.payout_runs
+    try:
+        if run['phase'] == "claim":
+            await db.commission_calculations.update_many({
+                "calculation_date": {"$gte": run['period_start'], "$lte": run['period_end']},
+                "status": "approved",
+                "payout_run_id": None,
+                # Claimed by a manual payout
+                "payout_id": None
+            }, {"$set": {"payout_run_id": run['id']}})
+            await _advance(runs, run, "payouts", lease_seconds)
+
+        if run['phase'] == "payouts":
+            totals = await _write_payouts(db, run, fx)
+            await _advance(runs, run, "settle", lease_seconds, **totals)
+
+        if run['phase'] == "settle":
+            await _settle(db, run, lease_seconds, batch_size)
+            await _advance(runs, run, "completed", lease_seconds, status="completed", lease=None,
+                           finished_at=datetime.now(timezone.utc))
+    except Exception as e:
+        logger.exception("Payout run %s failed in phase %s", run['id'], run['phase'])
+        # Dropping the lease lets the next request resume from this phase
+        await runs.update_one({"id": run['id']}, {"$set": {"status": "failed", "error": str(e), "lease": None}})
+        run.update(status="failed", error=str(e))
+    return run
+
+
+async def _write_payouts(db, run: Dict[str, Any], fx: Optional[FXRateCache]) -> Dict[str, Any]:
+    groups = await db.commission_calculations.aggregate([
+        {"$match": {"payout_run_id": run['id']}},
+        {"$group": {"_id": "$sales_rep_id", "total_commission": {"$sum": "$final_amount"}, "calculation_count": {"$sum": 1}}}
+    ], allowDiskUse=True).to_list(None)
+    by_payee = {g['_id']: g for g in groups}
+    payees = set(by_payee) | set(run['adjustments']) | set(run['deductions'])
+
+    # Every rate comes from the in-memory table; a missing one fails the run before anything is written
+    currencies = run.get('currencies') or {}
+    rates = {user_id: fx.rate(fx.base_currency, currency, run['period_end'])
+             for user_id, currency in currencies.items() if user_id in payees and fx is not None}
+
+    operations = []
+    totals = {"payees": len(payees), "calculation_count": 0, "total_commission": Decimal("0"), "total_net_payout": Decimal("0")}
+    for user_id in sorted(payees):
+        group = by_payee.get(user_id, {})
+        total_commission = Decimal(group.get('total_commission') or 0)
+        adjustments = run['adjustments'].get(user_id, Decimal("0"))
+        deductions = run['deductions'].get(user_id, Decimal("0"))
+        payout = Payout(
+            user_id=user_id,
+            payout_period_start=run['period_start'],
+            payout_period_end=run['period_end'],
+            payout_run_id=run['id'],
+            calculation_count=group.get('calculation_count', 0),
+            total_commission=total_commission,
+            adjustments=adjustments,
+            deductions=deductions,
+            net_payout=total_commission + adjustments - deductions
+        )
+        if user_id in rates:
+            payout.currency = currencies[user_id]
+            payout.fx_rate = rates[user_id]
+            payout.payout_amount = (payout.net_payout * rates[user_id]).quantize(FOUR_PLACES, rounding=ROUND_HALF_EVEN)
+        # A resumed run keeps the payouts (and ids) written the first time
+        operations.append(UpdateOne({"payout_run_id": run['id'], "user_id": user_id}, {"$setOnInsert": payout.model_dump()}, upsert=True))
+        totals['calculation_count'] += payout.calculation_count
+        totals['total_commission'] += payout.total_commission
+        totals['total_net_payout'] += payout.net_payout
+    if operations:
+        await db.payouts.bulk_write(operations, ordered=False)
+    return totals
+
+
+async def _settle(db, run: Dict[str, Any], lease_seconds: int, batch_size: int):
+    payout_ids = {p['user_id']: p['id'] async for p in db.payouts.find({"payout_run_id": run['id']}, {"_id": 0, "id": 1, "user_id": 1})}
+    projection = {"_id": 0, "id": 1, "sales_rep_id": 1, "plan_id": 1, "calculation_date": 1, "status": 1, "final_amount": 1}
+    while True:
+        batch = await db.commission_calculations.find(
+            {"payout_run_id": run['id'], "status": "approved"}, projection
+        ).limit(batch_size).to_list(batch_size)
+        if not batch:
+            return
+        by_payee: Dict[str, List[str]] = {}
+        for calculation in batch:
+            by_payee.setdefault(calculation['sales_rep_id'], []).append(calculation['id'])
+        await db.commission_calculations.bulk_write([
+            UpdateMany({"id": {"$in": ids}, "status": "approved"}, {"$set": {"status": "paid", "payout_id": payout_ids.get(user_id)}})
+            for user_id, ids in by_payee.items()
+        ], ordered=False)
+        await apply_status_change(db.earnings_rollups, batch, "paid")
+        await _advance(db.payout_runs, run, "settle", lease_seconds, settled=run.get('settled', 0) + len(batch))
@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+
+PERIODS = ("daily", "weekly", "monthly", "quarterly", "yearly", "all")
+
+
+def as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """UTC-aware copy of a datetime; naive values (as parsed from offset-less input) are taken as UTC."""
+    if value is None:
+        return None
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+
+def with_utc(doc: Dict[str, Any], *fields: str) -> Dict[str, Any]:
+    """Copy of `doc` with the given date fields made UTC-aware.
+
+    Documents built from API input carry naive dates, while those read back from Mongo are aware; the in-memory
+    indexes compare both, so they hold every date in this one form.
+    """
+    return {**doc, **{field: as_utc(doc.get(field)) for field in fields}}
+
+
+def period_bounds(period: str, now: Optional[datetime] = None) -> Tuple[Optional[datetime], Optional[datetime]]:
+    """Return the [start, end) range of the current period, or (None, None) for 'all'."""
+    if period not in PERIODS:
+        raise ValueError(f"Unknown period '{period}', expected one of: {', '.join(PERIODS)}")
+    if period == "all":
+        return None, None
+
+    now = now or datetime.now(timezone.utc)
+    day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "daily":
+        return day, day + timedelta(days=1)
+    if period == "weekly":
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=7)
+    if period == "monthly":
+        start = day.replace(day=1)
+        return start, _add_months(start, 1)
+    if period == "quarterly":
+        start = day.replace(month=3 * ((day.month - 1) // 3) + 1, day=1)
+        return start, _add_months(start, 3)
+    start = day.replace(month=1, day=1)
+    return start, start.replace(year=start.year + 1)
+
+
+def _add_months(value: datetime, months: int) -> datetime:
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+
+def date_range_filter(field: str, start: Optional[datetime], end: Optional[datetime]) -> dict:
+    """Build a Mongo range filter on `field` for a [start, end) window."""
+    bounds = {}
+    if start:
+        bounds["$gte"] = start
+    if end:
+        bounds["$lt"] = end
+    return {field: bounds} if bounds else {}
+
+
+def period_keys(value: datetime) -> dict:
+    """Return the rollup bucket keys for each granularity a timestamp falls into."""
+    return {
+        "day": value.strftime("%Y-%m-%d"),
+        "month": value.strftime("%Y-%m"),
+        "quarter": f"{value.year}-Q{(value.month - 1) // 3 + 1}",
+        "year": str(value.year),
+        "all": "all",
+    }
@@ -0,0 +1,164 @@
+"""Streaming product catalog import.
+
+An uploaded CSV is spooled to disk and parsed incrementally in chunks. Each
+chunk is validated and written with one bulk_write of upserts keyed by `sku`,
+so a refresh updates existing products in place instead of duplicating them.
+Progress and a capped list of rejected rows are kept on the job document in
+`import_jobs`, which clients poll while the import runs in the background.
+"""
+import asyncio
+import csv
+import logging
+import os
+import tempfile
+import uuid
+from datetime import datetime, timezone
+from decimal import InvalidOperation
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from pydantic import ValidationError
+from pymongo import UpdateOne
+
+from models import ProductCreate
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_COLUMNS = ("sku", "name", "category", "commission_rate_code", "gross_margin_percent", "base_commission_rate")
+CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+SPOOL_CHUNK_BYTES = 1024 * 1024
+
+
+def new_job(filename: str, created_by: str) -> Dict[str, Any]:
+    now = datetime.now(timezone.utc)
+    return {
+        "id": str(uuid.uuid4()),
+        "type": "product_import",
+        "filename": filename,
+        "status": "queued",
+        "rows_processed": 0,
+        "products_created": 0,
+        "products_updated": 0,
+        "rejected": 0,
+        "errors": [],
+        "created_by": created_by,
+        "created_at": now,
+        "updated_at": now
+    }
+
+
+def _error_message(e: Exception) -> str:
+    if isinstance(e, ValidationError):
+        return "; ".join(f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors())
+    return str(e)
+
+
+def validate_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the product fields of a CSV row; raises ValueError/ValidationError for rejected rows."""
+    product = ProductCreate(**{column: (row.get(column) or "").strip() for column in REQUIRED_COLUMNS})
+    if not product.sku:
+        raise ValueError("sku is required")
+    # Same rules as the single-product endpoint
+    if not product.commission_rate_code or product.gross_margin_percent <= 0:
+        raise ValueError("commission_rate_code is required and gross_margin_percent must be positive")
+    return product.model_dump()
+
+
+def _read_chunk(rows: Iterator[Tuple[int, Dict[str, Any]]], size: int) -> List[Tuple[int, Dict[str, Any]]]:
+    chunk = []
+    for line, row in rows:
+        chunk.append((line, row))
+        if len(chunk) >= size:
+            break
+    return chunk
+
+
+def _numbered_rows(reader: csv.DictReader) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    for row in reader:
+        yield reader.line_num, row
+
+
+def _operations(chunk: List[Tuple[int, Dict[str, Any]]], now: datetime) -> Tuple[List[UpdateOne], List[Dict[str, Any]]]:
+    products: Dict[str, Dict[str, Any]] = {}
+    errors = []
+    for line, row in chunk:
+        try:
+            product = validate_row(row)
+        except (ValueError, InvalidOperation, ValidationError) as e:
+            errors.append({"line": line, "sku": (row.get('sku') or "").strip() or None, "error": _error_message(e)})
+            continue
+        # A SKU repeated within the file: the last row wins
+        products[product['sku']] = product
+
+    operations = [
+        UpdateOne(
+            {"sku": sku},
+            {
+                "$set": {**product, "updated_at": now},
+                "$setOnInsert": {"id": str(uuid.uuid4()), "eligible": True, "created_at": now}
+            },
+            upsert=True
+        )
+        for sku, product in products.items()
+    ]
+    return operations, errors
+
+
+async def spool_upload(upload) -> str:
+    """Copy an UploadFile to a temporary file in fixed-size chunks and return its path."""
+    handle = tempfile.NamedTemporaryFile(prefix="product-import-", suffix=".csv", delete=False)
+    try:
+        while True:
+            data = await upload.read(SPOOL_CHUNK_BYTES)
+            if not data:
+                break
+            await asyncio.to_thread(handle.write, data)
+    finally:
+        handle.close()
+    return handle.name
+
+
+async def run_import(db, job_id: str, path: str, chunk_size: int = CHUNK_SIZE) -> Optional[Dict[str, Any]]:
+    """Import the spooled CSV at `path`, updating job progress per chunk, and remove the file."""
+    jobs = db.import_jobs
+    try:
+        await jobs.update_one({"id": job_id}, {"$set": {"status": "running", "updated_at": datetime.now(timezone.utc)}})
+        with open(path, newline="", encoding="utf-8-sig") as handle:
+            reader = csv.DictReader(handle)
+            missing = [column for column in REQUIRED_COLUMNS if column not in (reader.fieldnames or [])]
+            if missing:
+                raise ValueError(f"Missing columns: {', '.join(missing)}")
+
+            rows = _numbered_rows(reader)
+            reported = 0
+            while True:
+                chunk = await asyncio.to_thread(_read_chunk, rows, chunk_size)
+                if not chunk:
+                    break
+                now = datetime.now(timezone.utc)
+                operations, errors = _operations(chunk, now)
+                created = updated = 0
+                if operations:
+                    result = await db.products.bulk_write(operations, ordered=False)
+                    created, updated = result.upserted_count, result.matched_count
+
+                update: Dict[str, Any] = {
+                    "$inc": {"rows_processed": len(chunk), "products_created": created, "products_updated": updated, "rejected": len(errors)},
+                    "$set": {"updated_at": now}
+                }
+                room = MAX_REPORTED_ERRORS - reported
+                if errors and room > 0:
+                    update["$push"] = {"errors": {"$each": errors[:room]}}
+                    reported += min(len(errors), room)
+                await jobs.update_one({"id": job_id}, update)
+
+        await jobs.update_one({"id": job_id}, {"$set": {"status": "completed", "completed_at": datetime.now(timezone.utc)}})
+    except Exception as e:
+        logger.exception("Product import %s failed", job_id)
+        await jobs.update_one({"id": job_id}, {"$set": {"status": "failed", "failure": str(e), "completed_at": datetime.now(timezone.utc)}})
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    return await jobs.find_one({"id": job_id}, {"_id": 0})
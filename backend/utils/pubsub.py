@@ -0,0 +1,187 @@
+"""Pub/sub backends for cross-worker WebSocket fan-out.
+
+The connection manager publishes every message through a backend instead of
+delivering it locally. The backend hands it to the `deliver` callback of
+every worker, and each worker pushes it to its own sockets.
+
+- MemoryPubSub delivers in-process only: a single worker, and tests.
+- MongoPubSub appends to a capped collection that every worker follows
+  with a tailable cursor, so any number of API workers and pods share
+  the same events.
+
+A tailable cursor keeps its own position in the collection's natural
+order, so while it lives nothing is skipped. Only a cursor that died has
+to be reopened, and that needs a place to restart from. Each publisher
+numbers its events, and the follower remembers the last number seen from
+each one. A reopened cursor starts `skew_seconds` before the last event
+received, which absorbs clock differences between publishers, and drops
+anything it has already seen. A gap in a publisher's numbers is counted as
+missed events; it means the capped collection wrapped past them.
+"""
+import abc
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Union
+
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+Deliver = Callable[[str, str], Union[int, Awaitable[int], None]]
+
+
+class PubSub(abc.ABC):
+    @abc.abstractmethod
+    async def start(self, deliver: Deliver):
+        ...
+
+    @abc.abstractmethod
+    async def publish(self, topic: str, text: str):
+        ...
+
+    async def stop(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": type(self).__name__}
+
+
+class MemoryPubSub(PubSub):
+    def __init__(self):
+        self._deliver: Optional[Deliver] = None
+        self.published_total = 0
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+
+    async def publish(self, topic: str, text: str):
+        self.published_total += 1
+        if self._deliver is not None:
+            result = self._deliver(topic, text)
+            if asyncio.iscoroutine(result):
+                await result
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "published_total": self.published_total}
+
+
+class MongoPubSub(PubSub):
+    def __init__(self, db, collection_name: str = "realtime_events", size_bytes: int = 64 * 1024 * 1024,
+                 retry_seconds: float = 1.0, skew_seconds: float = 5.0):
+        self.db = db
+        self.collection_name = collection_name
+        self.size_bytes = size_bytes
+        self.retry_seconds = retry_seconds
+        self.skew_seconds = skew_seconds
+        self.origin = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._deliver: Optional[Deliver] = None
+        self._task: Optional[asyncio.Task] = None
+        self._sequence = 0
+        self._seen: Dict[str, int] = {}
+        self.published_total = 0
+        self.received_total = 0
+        self.missed_total = 0
+        self.restarts_total = 0
+
+    @property
+    def collection(self):
+        return self.db[self.collection_name]
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+        await self._ensure_collection()
+        # Only events published from now on are delivered: mark what is already there as seen
+        since = datetime.now(timezone.utc) - timedelta(seconds=self.skew_seconds)
+        async for event in self.collection.find({"published_at": {"$gte": since}, "origin": {"$exists": True}}, {"origin": 1, "sequence": 1}):
+            self._saw(event)
+        self._task = asyncio.create_task(self._follow(since))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def publish(self, topic: str, text: str):
+        self._sequence += 1
+        await self.collection.insert_one({
+            "topic": topic,
+            "message": text,
+            "origin": self.origin,
+            "sequence": self._sequence,
+            "published_at": datetime.now(timezone.utc)
+        })
+        self.published_total += 1
+
+    async def _ensure_collection(self):
+        try:
+            await self.db.create_collection(self.collection_name, capped=True, size=self.size_bytes)
+            # A tailable cursor on an empty capped collection dies immediately
+            await self.collection.insert_one({"topic": None, "published_at": datetime.now(timezone.utc)})
+        except CollectionInvalid:
+            pass
+
+    def _saw(self, event: Dict[str, Any]) -> bool:
+        """Record a publisher's event; False when it was seen before."""
+        origin, sequence = event.get('origin'), event.get('sequence')
+        if origin is None or sequence is None:
+            return True
+        last = self._seen.get(origin, 0)
+        if sequence <= last:
+            return False
+        if last and sequence > last + 1:
+            self.missed_total += sequence - last - 1
+        self._seen[origin] = sequence
+        return True
+
+    async def _follow(self, since: datetime):
+        while True:
+            try:
+                cursor = self.collection.find({"published_at": {"$gte": since}}, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    async for event in cursor:
+                        if not self._saw(event):
+                            continue
+                        since = max(since, event['published_at'] - timedelta(seconds=self.skew_seconds))
+                        if event.get('topic'):
+                            self.received_total += 1
+                            await self._dispatch(event['topic'], event['message'])
+                    await asyncio.sleep(self.retry_seconds / 10)
+            except asyncio.CancelledError:
+                raise
+            except PyMongoError:
+                logger.exception("Pub/sub tail of %s failed, restarting", self.collection_name)
+            self.restarts_total += 1
+            await asyncio.sleep(self.retry_seconds)
+
+    async def _dispatch(self, topic: str, text: str):
+        try:
+            result = self._deliver(topic, text)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception:
+            logger.exception("Delivering pub/sub event on %s failed", topic)
+
+    def stats(self) -> dict:
+        return {
+            "backend": "mongo",
+            "collection": self.collection_name,
+            "origin": self.origin,
+            "published_total": self.published_total,
+            "received_total": self.received_total,
+            "missed_total": self.missed_total,
+            "restarts_total": self.restarts_total,
+            "following": self._task is not None and not self._task.done()
+        }
+
+
+def create_pubsub(backend: str, db) -> PubSub:
+    if backend == "memory":
+        return MemoryPubSub()
+    if backend == "mongo":
+        return MongoPubSub(db, size_bytes=int(os.environ.get('PUBSUB_CAPPED_SIZE_MB', '64')) * 1024 * 1024)
+    raise ValueError(f"Unknown pub/sub backend '{backend}', expected memory or mongo")
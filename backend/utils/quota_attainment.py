@@ -0,0 +1,192 @@
+"""Quota attainment kept current from commission calculations.
+
+A quota is credited with every calculation for its user whose transaction
+date falls in the quota period. What one calculation is worth depends on
+quota_type:
+
+- "units"   the transaction quantity times the party's credit share.
+- "deals"   the credit share itself, so a half-credited deal counts 0.5.
+- anything else ("revenue")  the calculation's base_amount, which is the
+            party's share of the sale in the base currency.
+
+apply() moves attainment as calculations are stored. There is one
+update_many per (rep, transaction date), and every active quota covering
+that date is adjusted atomically. The update is a pipeline: it adds to
+current_attainment as $inc would, and in the same write recomputes
+attainment_percent from the new value, so the two fields never disagree.
+
+reconcile() recomputes every active quota (or the given ones) with one
+aggregation over the calculations. It starts from the calculations of quota
+holders, joins each to its transaction for the date and to the quotas that
+cover that date, and groups the result per quota. An increment that races a
+reconcile is corrected on the next pass. AttainmentReconciler runs the
+reconcile periodically.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+HUNDRED = Decimal("100")
+TWO_PLACES = Decimal("0.01")
+
+
+def credit(calculation: Dict[str, Any], transaction: Dict[str, Any]) -> Dict[str, Decimal]:
+    """What one calculation adds to a quota, per quota type."""
+    share = Decimal(str(calculation.get('credit_percent', 100))) / HUNDRED
+    return {
+        "units": Decimal(str(transaction.get('quantity') or 0)) * share,
+        "deals": share,
+        "revenue": Decimal(str(calculation.get('base_amount') or 0))
+    }
+
+
+def percent(attainment: Decimal, quota_amount: Any) -> Decimal:
+    quota_amount = Decimal(str(quota_amount or 0))
+    return (attainment * HUNDRED / quota_amount).quantize(TWO_PLACES) if quota_amount > 0 else Decimal("0")
+
+
+def _by_type(values: Dict[str, Any]) -> Dict[str, Any]:
+    # Pick the value matching the quota's type; unknown types are revenue quotas
+    return {"$switch": {"branches": [
+        {"case": {"$eq": ["$quota_type", "units"]}, "then": values['units']},
+        {"case": {"$eq": ["$quota_type", "deals"]}, "then": values['deals']},
+    ], "default": values['revenue']}}
+
+
+_PERCENT = {"$cond": [
+    {"$gt": ["$quota_amount", 0]},
+    {"$round": [{"$divide": [{"$multiply": ["$current_attainment", 100]}, "$quota_amount"]}, 2]},
+    0
+]}
+
+
+async def apply(collection, calculations: Iterable[Dict[str, Any]], transactions: Dict[str, Dict[str, Any]],
+                sign: int = 1) -> List[str]:
+    """Credit (or with sign=-1, retract) calculations on the quotas covering their dates; returns the reps touched."""
+    increments: Dict[Tuple[str, datetime], Dict[str, Decimal]] = defaultdict(lambda: defaultdict(Decimal))
+    for calculation in calculations:
+        transaction = transactions.get(calculation['transaction_id'])
+        if transaction is None:
+            continue
+        totals = increments[(calculation['sales_rep_id'], transaction['transaction_date'])]
+        for quota_type, amount in credit(calculation, transaction).items():
+            totals[quota_type] += sign * amount
+    if not increments:
+        return []
+
+    now = datetime.now(timezone.utc)
+    await collection.bulk_write([
+        UpdateMany(
+            {"user_id": rep_id, "status": "active", "period_start": {"$lte": when}, "period_end": {"$gte": when}},
+            [
+                {"$set": {"current_attainment": {"$add": [{"$ifNull": ["$current_attainment", 0]}, _by_type(totals)]}, "updated_at": now}},
+                {"$set": {"attainment_percent": _PERCENT}}
+            ]
+        )
+        for (rep_id, when), totals in increments.items()
+    ], ordered=False)
+    return sorted({rep_id for rep_id, _ in increments})
+
+
+async def reconcile(db, quota_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Recompute attainment for active quotas (all, or `quota_ids`) and correct any drift."""
+    match: Dict[str, Any] = {"status": "active"}
+    if quota_ids is not None:
+        match["id"] = {"$in": quota_ids}
+    quotas = await db.quotas.find(match, {"_id": 0, "id": 1, "user_id": 1, "period_start": 1, "quota_amount": 1,
+                                          "current_attainment": 1, "attainment_percent": 1}).to_list(None)
+    report = {"quotas": len(quotas), "corrected": 0, "user_ids": []}
+    if not quotas:
+        return report
+
+    share = {"$divide": [{"$ifNull": ["$credit_percent", 100]}, 100]}
+    groups = await db.commission_calculations.aggregate([
+        # A transaction is calculated on or after its date, so nothing older than the earliest quota can count
+        {"$match": {
+            "sales_rep_id": {"$in": sorted({q['user_id'] for q in quotas})},
+            "calculation_date": {"$gte": min(q['period_start'] for q in quotas)}
+        }},
+        {"$lookup": {"from": "transactions", "localField": "transaction_id", "foreignField": "id", "as": "transaction"}},
+        {"$unwind": "$transaction"},
+        {"$lookup": {
+            "from": "quotas",
+            "let": {"rep_id": "$sales_rep_id", "when": "$transaction.transaction_date"},
+            "pipeline": [
+                {"$match": {"$expr": {"$and": [
+                    {"$eq": ["$user_id", "$$rep_id"]},
+                    {"$eq": ["$status", "active"]},
+                    {"$lte": ["$period_start", "$$when"]},
+                    {"$gte": ["$period_end", "$$when"]}
+                ]}}},
+                {"$project": {"_id": 0, "id": 1, "quota_type": 1}}
+            ],
+            "as": "quota"
+        }},
+        {"$unwind": "$quota"},
+        {"$match": {"quota.id": {"$in": [q['id'] for q in quotas]}}},
+        {"$group": {"_id": "$quota.id", "attainment": {"$sum": {"$switch": {"branches": [
+            {"case": {"$eq": ["$quota.quota_type", "units"]}, "then": {"$multiply": [{"$ifNull": ["$transaction.quantity", 0]}, share]}},
+            {"case": {"$eq": ["$quota.quota_type", "deals"]}, "then": share},
+        ], "default": {"$ifNull": ["$base_amount", 0]}}}}}}
+    ], allowDiskUse=True).to_list(None)
+    attainment = {g['_id']: Decimal(str(g['attainment'])) for g in groups}
+
+    now = datetime.now(timezone.utc)
+    operations, corrected = [], set()
+    for quota in quotas:
+        value = attainment.get(quota['id'], Decimal("0"))
+        fields = {"current_attainment": value, "attainment_percent": percent(value, quota['quota_amount'])}
+        if Decimal(str(quota.get('current_attainment') or 0)) != value or Decimal(str(quota.get('attainment_percent') or 0)) != fields['attainment_percent']:
+            report['corrected'] += 1
+            corrected.add(quota['user_id'])
+        operations.append(UpdateOne({"id": quota['id']}, {"$set": {**fields, "attainment_reconciled_at": now}}))
+    await db.quotas.bulk_write(operations, ordered=False)
+    report['user_ids'] = sorted(corrected)
+    return report
+
+
+class AttainmentReconciler:
+    """Runs reconcile() every `interval_seconds`; an interval of 0 disables it."""
+
+    def __init__(self, interval_seconds: float = 3600.0, on_corrected=None):
+        self.interval_seconds = interval_seconds
+        self.on_corrected = on_corrected
+        self._task: Optional[asyncio.Task] = None
+        self.last_report: Optional[Dict[str, Any]] = None
+        self.last_run: Optional[datetime] = None
+
+    def start(self, db):
+        if self.interval_seconds > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run(db))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self, db):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                await self.run_once(db)
+            except PyMongoError:
+                logger.exception("Quota attainment reconcile failed")
+
+    async def run_once(self, db, quota_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+        report = await reconcile(db, quota_ids)
+        if quota_ids is None:
+            self.last_report, self.last_run = report, datetime.now(timezone.utc)
+        if report['corrected']:
+            logger.info("Quota reconcile corrected %d of %d quotas", report['corrected'], report['quotas'])
+            if self.on_corrected is not None:
+                self.on_corrected(report['user_ids'])
+        return report
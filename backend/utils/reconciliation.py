@@ -0,0 +1,238 @@
+"""Pre-release payout reconciliation.
+
+A reconciliation checks every payout that overlaps a period against the
+calculations it pays, and every calculation against its transaction. It
+records three kinds of finding:
+
+- total_mismatch      a payout whose total_commission or calculation_count
+                      differs from the calculations it covers.
+- orphan_calculation  a calculation whose transaction or payout no longer
+                      exists, or an approved/paid calculation that no
+                      payout covers.
+- double_paid         a rep's transaction that is covered more than once,
+                      either by duplicate calculations or by overlapping
+                      payouts.
+
+A run-based payout covers the calculations its run claimed, and a manual
+payout the calculations stamped with its id. Manual payouts made before
+payouts claimed their calculations cover the rep's unclaimed approved/paid
+calculations within their period.
+
+The work is done in chunks of payees. Each chunk fetches that chunk's
+payouts and calculations with one query each, checks which transactions
+and payouts exist with one $in query each, and diffs the id sets in memory.
+The reconciliation document records the last payee done and holds a lease,
+as payout runs do. Findings are upserted on (reconciliation, kind, key), so
+a run that died mid-chunk resumes from its checkpoint without counting
+anything twice.
+"""
+import logging
+import uuid
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Any, Dict, List
+
+from pymongo import UpdateOne
+
+from utils.payout_runs import LEASE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+KINDS = ("total_mismatch", "orphan_calculation", "double_paid")
+CHUNK_SIZE = 200
+PAYABLE_STATUSES = ("approved", "paid")
+
+_PAYOUT_PROJECTION = {"_id": 0, "id": 1, "user_id": 1, "payout_run_id": 1, "payout_period_start": 1,
+                      "payout_period_end": 1, "total_commission": 1, "calculation_count": 1}
+_CALCULATION_PROJECTION = {"_id": 0, "id": 1, "transaction_id": 1, "sales_rep_id": 1, "calculation_date": 1,
+                           "status": 1, "final_amount": 1, "payout_run_id": 1, "payout_id": 1}
+
+
+def new_reconciliation(period_start: datetime, period_end: datetime, created_by: str) -> Dict[str, Any]:
+    now = datetime.now(timezone.utc)
+    return {
+        "id": str(uuid.uuid4()),
+        "period_start": period_start,
+        "period_end": period_end,
+        "status": "queued",
+        "cursor": None,
+        "payees": 0,
+        "payees_done": 0,
+        "summary": {},
+        "lease": None,
+        "error": None,
+        "created_by": created_by,
+        "created_at": now,
+        "updated_at": now
+    }
+
+
+def _finding(reconciliation_id: str, kind: str, key: str, user_id: str, amount: Decimal, **details) -> Dict[str, Any]:
+    return {
+        "id": str(uuid.uuid4()),
+        "reconciliation_id": reconciliation_id,
+        "kind": kind,
+        "key": key,
+        "user_id": user_id,
+        "amount": amount,
+        **details,
+        "created_at": datetime.now(timezone.utc)
+    }
+
+
+def _amount(doc: Dict[str, Any], field: str) -> Decimal:
+    return Decimal(doc.get(field) or 0)
+
+
+def covered_by(payout: Dict[str, Any], calculations: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """The calculations of the payout's rep that this payout pays."""
+    if payout.get('payout_run_id'):
+        return [c for c in calculations if c.get('payout_run_id') == payout['payout_run_id']]
+    claimed = [c for c in calculations if c.get('payout_id') == payout['id']]
+    if claimed:
+        return claimed
+    return [
+        c for c in calculations
+        if not c.get('payout_run_id') and not c.get('payout_id') and c['status'] in PAYABLE_STATUSES
+        and payout['payout_period_start'] <= c['calculation_date'] <= payout['payout_period_end']
+    ]
+
+
+def diff_payee(reconciliation: Dict[str, Any], user_id: str, payouts: List[Dict[str, Any]],
+               calculations: List[Dict[str, Any]], transaction_ids: set, payout_ids: set) -> List[Dict[str, Any]]:
+    """Findings for one payee; `transaction_ids` and `payout_ids` are the ids known to exist."""
+    rid = reconciliation['id']
+    findings = []
+    coverage: Dict[str, List[str]] = {c['id']: [] for c in calculations}
+
+    for payout in payouts:
+        covered = covered_by(payout, calculations)
+        expected = sum((_amount(c, 'final_amount') for c in covered), Decimal("0"))
+        difference = _amount(payout, 'total_commission') - expected
+        # Payouts written before calculation_count existed are checked on amount only
+        count_differs = 'calculation_count' in payout and payout['calculation_count'] != len(covered)
+        if difference or count_differs:
+            findings.append(_finding(rid, "total_mismatch", payout['id'], user_id, difference,
+                                     payout_id=payout['id'], expected_total=expected, actual_total=_amount(payout, 'total_commission'),
+                                     expected_count=len(covered), actual_count=payout.get('calculation_count')))
+        for calculation in covered:
+            coverage[calculation['id']].append(payout['id'])
+
+    in_period = [c for c in calculations if reconciliation['period_start'] <= c['calculation_date'] <= reconciliation['period_end']]
+    for calculation in in_period:
+        reason = None
+        if calculation['transaction_id'] not in transaction_ids:
+            reason = "missing_transaction"
+        elif calculation.get('payout_id') and calculation['payout_id'] not in payout_ids:
+            reason = "missing_payout"
+        elif calculation['status'] in PAYABLE_STATUSES and not coverage[calculation['id']]:
+            reason = "unpaid"
+        if reason:
+            findings.append(_finding(rid, "orphan_calculation", calculation['id'], user_id, _amount(calculation, 'final_amount'),
+                                     calculation_id=calculation['id'], transaction_id=calculation['transaction_id'], reason=reason))
+
+    by_transaction: Dict[str, List[Dict[str, Any]]] = {}
+    for calculation in in_period:
+        if coverage[calculation['id']]:
+            by_transaction.setdefault(calculation['transaction_id'], []).append(calculation)
+    for transaction_id, paid in by_transaction.items():
+        times_paid = sum(len(coverage[c['id']]) for c in paid)
+        if times_paid < 2:
+            continue
+        paid_amount = sum((_amount(c, 'final_amount') * len(coverage[c['id']]) for c in paid), Decimal("0"))
+        overpaid = paid_amount - max(_amount(c, 'final_amount') for c in paid)
+        findings.append(_finding(rid, "double_paid", f"{transaction_id}:{user_id}", user_id, overpaid,
+                                 transaction_id=transaction_id, times_paid=times_paid,
+                                 calculation_ids=[c['id'] for c in paid],
+                                 payout_ids=sorted({p for c in paid for p in coverage[c['id']]})))
+    return findings
+
+
+async def _reconcile_chunk(db, reconciliation: Dict[str, Any], user_ids: List[str]) -> int:
+    start, end = reconciliation['period_start'], reconciliation['period_end']
+    payouts = await db.payouts.find({
+        "user_id": {"$in": user_ids},
+        "payout_period_start": {"$lte": end},
+        "payout_period_end": {"$gte": start}
+    }, _PAYOUT_PROJECTION).to_list(None)
+    # Payouts reaching outside the period need all of their calculations to be totalled
+    low = min([start] + [p['payout_period_start'] for p in payouts])
+    high = max([end] + [p['payout_period_end'] for p in payouts])
+    calculations = await db.commission_calculations.find({
+        "sales_rep_id": {"$in": user_ids},
+        "calculation_date": {"$gte": low, "$lte": high}
+    }, _CALCULATION_PROJECTION).to_list(None)
+
+    transaction_ids = {c['transaction_id'] for c in calculations}
+    existing_transactions = set(await db.transactions.distinct("id", {"id": {"$in": list(transaction_ids)}}))
+    payout_ids = {c['payout_id'] for c in calculations if c.get('payout_id')} - {p['id'] for p in payouts}
+    existing_payouts = {p['id'] for p in payouts} | set(await db.payouts.distinct("id", {"id": {"$in": list(payout_ids)}}))
+
+    payouts_by_user: Dict[str, List[Dict[str, Any]]] = {}
+    for payout in payouts:
+        payouts_by_user.setdefault(payout['user_id'], []).append(payout)
+    calculations_by_user: Dict[str, List[Dict[str, Any]]] = {}
+    for calculation in calculations:
+        calculations_by_user.setdefault(calculation['sales_rep_id'], []).append(calculation)
+
+    findings = []
+    for user_id in user_ids:
+        findings.extend(diff_payee(reconciliation, user_id, payouts_by_user.get(user_id, []),
+                                   calculations_by_user.get(user_id, []), existing_transactions, existing_payouts))
+    if findings:
+        await db.reconciliation_findings.bulk_write([
+            UpdateOne({"reconciliation_id": f['reconciliation_id'], "kind": f['kind'], "key": f['key']}, {"$setOnInsert": f}, upsert=True)
+            for f in findings
+        ], ordered=False)
+    return len(findings)
+
+
+async def _payees(db, reconciliation: Dict[str, Any]) -> List[str]:
+    start, end = reconciliation['period_start'], reconciliation['period_end']
+    reps = await db.commission_calculations.distinct("sales_rep_id", {"calculation_date": {"$gte": start, "$lte": end}})
+    payees = await db.payouts.distinct("user_id", {"payout_period_start": {"$lte": end}, "payout_period_end": {"$gte": start}})
+    return sorted(set(reps) | set(payees))
+
+
+async def summarize(collection, reconciliation_id: str) -> Dict[str, Any]:
+    groups = await collection.aggregate([
+        {"$match": {"reconciliation_id": reconciliation_id}},
+        {"$group": {"_id": "$kind", "count": {"$sum": 1}, "amount": {"$sum": "$amount"}}}
+    ]).to_list(None)
+    summary = {kind: {"count": 0, "amount": Decimal("0")} for kind in KINDS}
+    for group in groups:
+        summary[group['_id']] = {"count": group['count'], "amount": group['amount']}
+    return summary
+
+
+async def execute(db, reconciliation: Dict[str, Any], lease_seconds: int = LEASE_SECONDS,
+                  chunk_size: int = CHUNK_SIZE) -> Dict[str, Any]:
+    """Carry a leased reconciliation from its checkpoint to completion."""
+    collection = db.reconciliations
+    try:
+        payees = await _payees(db, reconciliation)
+        # Payees are processed in id order, so the checkpoint is simply the last one done
+        done = bisect_right(payees, reconciliation['cursor']) if reconciliation.get('cursor') else 0
+        await collection.update_one({"id": reconciliation['id']}, {"$set": {"payees": len(payees)}})
+        for i in range(done, len(payees), chunk_size):
+            chunk = payees[i:i + chunk_size]
+            await _reconcile_chunk(db, reconciliation, chunk)
+            now = datetime.now(timezone.utc)
+            fields = {"cursor": chunk[-1], "payees_done": i + len(chunk), "lease": now + timedelta(seconds=lease_seconds), "updated_at": now}
+            await collection.update_one({"id": reconciliation['id']}, {"$set": fields})
+            reconciliation.update(fields)
+
+        fields = {
+            "status": "completed",
+            "summary": await summarize(db.reconciliation_findings, reconciliation['id']),
+            "lease": None,
+            "finished_at": datetime.now(timezone.utc)
+        }
+        await collection.update_one({"id": reconciliation['id']}, {"$set": fields})
+        reconciliation.update(fields)
+    except Exception as e:
+        logger.exception("Reconciliation %s failed after payee %s", reconciliation['id'], reconciliation.get('cursor'))
+        await collection.update_one({"id": reconciliation['id']}, {"$set": {"status": "failed", "error": str(e), "lease": None}})
+        reconciliation.update(status="failed", error=str(e))
+    return reconciliation
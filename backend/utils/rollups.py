@@ -0,0 +1,229 @@
+"""Materialized per-rep earnings rollups.
+
+Every commission calculation is folded into `earnings_rollups` documents keyed
+by rep, plan and period bucket (day/month/quarter/year/all) with atomic $inc
+updates, so dashboards read totals from a single document instead of scanning
+raw calculations. Each calculation is counted twice: once under its plan and
+once under ALL_PLANS, which is the document the dashboards read.
+
+The rollups are derived data; rebuild() recomputes them from the raw
+calculations, reports drift and optionally repairs it:
+
+    python -m utils.rollups [--repair] [--rep USER_ID]
+"""
+import argparse
+import asyncio
+import os
+from collections import defaultdict
+from datetime import datetime, timezone
+from decimal import Decimal
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
+
+from utils.periods import period_keys
+
+ALL_PLANS = "*"
+GRANULARITIES = ("day", "month", "quarter", "year", "all")
+
+# API period names served from rollups; anything else falls back to aggregation
+PERIOD_GRANULARITY = {"daily": "day", "monthly": "month", "quarterly": "quarter", "yearly": "year", "all": "all"}
+
+_PERIOD_EXPRESSIONS = {
+    "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$calculation_date"}},
+    "month": {"$dateToString": {"format": "%Y-%m", "date": "$calculation_date"}},
+    "quarter": {"$concat": [
+        {"$dateToString": {"format": "%Y", "date": "$calculation_date"}},
+        "-Q",
+        {"$toString": {"$toInt": {"$ceil": {"$divide": [{"$month": "$calculation_date"}, 3]}}}}
+    ]},
+    "year": {"$dateToString": {"format": "%Y", "date": "$calculation_date"}},
+    "all": {"$literal": "all"},
+}
+
+RollupKey = Tuple[str, str, str, str]
+
+
+def _rollup_keys(calculation: Dict[str, Any]) -> Iterable[RollupKey]:
+    keys = period_keys(calculation['calculation_date'])
+    for plan_id in (calculation['plan_id'], ALL_PLANS):
+        for granularity in GRANULARITIES:
+            yield (calculation['sales_rep_id'], plan_id, granularity, keys[granularity])
+
+
+def _key_filter(key: RollupKey) -> dict:
+    return {"sales_rep_id": key[0], "plan_id": key[1], "period_type": key[2], "period_key": key[3]}
+
+
+def _increments(calculations: Iterable[Dict[str, Any]], sign: int, status: Optional[str] = None) -> Dict[RollupKey, Dict[str, Any]]:
+    increments: Dict[RollupKey, Dict[str, Any]] = defaultdict(lambda: defaultdict(Decimal))
+    for calculation in calculations:
+        amount = Decimal(calculation['final_amount']) * sign
+        bucket = status or calculation['status']
+        for key in _rollup_keys(calculation):
+            inc = increments[key]
+            if status is None:
+                inc['total_earnings'] += amount
+                inc['calculation_count'] += sign
+            inc[f"by_status.{bucket}.amount"] += amount
+            inc[f"by_status.{bucket}.count"] += sign
+    return increments
+
+
+def _to_operations(increments: Dict[RollupKey, Dict[str, Any]]) -> List[UpdateOne]:
+    now = datetime.now(timezone.utc)
+    operations = []
+    for key, inc in increments.items():
+        # Counts are exact integers; only money stays Decimal
+        inc = {field: int(value) if field.endswith("count") else value for field, value in inc.items()}
+        operations.append(UpdateOne(_key_filter(key), {"$inc": inc, "$set": {"updated_at": now}}, upsert=True))
+    return operations
+
+
+async def apply_calculations(collection, calculations: List[Dict[str, Any]]):
+    """Fold newly written calculations into their rollup buckets."""
+    operations = _to_operations(_increments(calculations, 1))
+    if operations:
+        await collection.bulk_write(operations, ordered=False)
+
+
+async def retract_calculations(collection, calculations: List[Dict[str, Any]]):
+    """Take removed calculations back out of their rollup buckets."""
+    operations = _to_operations(_increments(calculations, -1))
+    if operations:
+        await collection.bulk_write(operations, ordered=False)
+
+
+async def apply_adjustments(collection, adjustments: List[Dict[str, Any]]):
+    """Add amount changes to calculations already counted; final_amount holds the change."""
+    increments = _increments(adjustments, 1)
+    for inc in increments.values():
+        for field in [f for f in inc if f.endswith("count")]:
+            del inc[field]
+    operations = _to_operations(increments)
+    if operations:
+        await collection.bulk_write(operations, ordered=False)
+
+
+async def apply_status_change(collection, calculations: List[Dict[str, Any]], new_status: str):
+    """Move calculations from their current status bucket to `new_status`."""
+    increments = _increments(calculations, -1, None)
+    for key, inc in _increments(calculations, 1, new_status).items():
+        for field, value in inc.items():
+            increments[key][field] += value
+    # Totals are unchanged by a status move
+    for inc in increments.values():
+        inc.pop('total_earnings', None)
+        inc.pop('calculation_count', None)
+    operations = _to_operations(increments)
+    if operations:
+        await collection.bulk_write(operations, ordered=False)
+
+
+async def read_totals(collection, user_ids: List[str], granularity: str, now: Optional[datetime] = None) -> Dict[str, Dict[str, Any]]:
+    """Return {sales_rep_id: rollup} for the current bucket of `granularity` across all plans."""
+    period_key = period_keys(now or datetime.now(timezone.utc))[granularity]
+    query = {"plan_id": ALL_PLANS, "period_type": granularity, "period_key": period_key}
+    query["sales_rep_id"] = user_ids[0] if len(user_ids) == 1 else {"$in": user_ids}
+    rollups = await collection.find(query, {"_id": 0}).to_list(None)
+    return {r['sales_rep_id']: r for r in rollups}
+
+
+async def _expected_rollups(db, sales_rep_id: Optional[str]) -> Dict[RollupKey, Dict[str, Any]]:
+    match = {"sales_rep_id": sales_rep_id} if sales_rep_id else {}
+    expected: Dict[RollupKey, Dict[str, Any]] = {}
+    for granularity in GRANULARITIES:
+        pipeline = [
+            {"$match": match},
+            {"$group": {
+                "_id": {
+                    "sales_rep_id": "$sales_rep_id",
+                    "plan_id": "$plan_id",
+                    "period_key": _PERIOD_EXPRESSIONS[granularity],
+                    "status": "$status"
+                },
+                "amount": {"$sum": "$final_amount"},
+                "count": {"$sum": 1}
+            }}
+        ]
+        async for row in db.commission_calculations.aggregate(pipeline, allowDiskUse=True):
+            group = row['_id']
+            for plan_id in (group['plan_id'], ALL_PLANS):
+                key = (group['sales_rep_id'], plan_id, granularity, group['period_key'])
+                doc = expected.setdefault(key, {
+                    **_key_filter(key), "total_earnings": Decimal("0"), "calculation_count": 0, "by_status": {}
+                })
+                doc['total_earnings'] += row['amount']
+                doc['calculation_count'] += row['count']
+                status = doc['by_status'].setdefault(group['status'], {"amount": Decimal("0"), "count": 0})
+                status['amount'] += row['amount']
+                status['count'] += row['count']
+    return expected
+
+
+def _matches(actual: Dict[str, Any], expected: Dict[str, Any]) -> bool:
+    if actual.get('total_earnings') != expected['total_earnings'] or actual.get('calculation_count') != expected['calculation_count']:
+        return False
+    actual_status = {s: v for s, v in (actual.get('by_status') or {}).items() if v.get('count')}
+    return actual_status == expected['by_status']
+
+
+async def rebuild(db, repair: bool = False, sales_rep_id: Optional[str] = None, batch_size: int = 1000) -> Dict[str, int]:
+    """Verify rollups against raw calculations and optionally rewrite the ones that drifted."""
+    expected = await _expected_rollups(db, sales_rep_id)
+    report = {"checked": 0, "mismatched": 0, "missing": 0, "orphaned": 0, "repaired": 0}
+    operations = []
+
+    async def flush():
+        nonlocal operations
+        if repair and operations:
+            result = await db.earnings_rollups.bulk_write(operations, ordered=False)
+            report['repaired'] += result.modified_count + result.upserted_count + result.deleted_count
+        operations = []
+
+    query = {"sales_rep_id": sales_rep_id} if sales_rep_id else {}
+    async for actual in db.earnings_rollups.find(query):
+        key = (actual['sales_rep_id'], actual['plan_id'], actual['period_type'], actual['period_key'])
+        report['checked'] += 1
+        wanted = expected.pop(key, None)
+        if wanted is None:
+            report['orphaned'] += 1
+            operations.append(DeleteOne({"_id": actual['_id']}))
+        elif not _matches(actual, wanted):
+            report['mismatched'] += 1
+            operations.append(ReplaceOne({"_id": actual['_id']}, {**wanted, "updated_at": datetime.now(timezone.utc)}))
+        if len(operations) >= batch_size:
+            await flush()
+
+    for key, wanted in expected.items():
+        report['missing'] += 1
+        operations.append(ReplaceOne(_key_filter(key), {**wanted, "updated_at": datetime.now(timezone.utc)}, upsert=True))
+        if len(operations) >= batch_size:
+            await flush()
+    await flush()
+    return report
+
+
+async def _main(repair: bool, sales_rep_id: Optional[str]):
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from utils.codec import CODEC_OPTIONS
+
+    load_dotenv(Path(__file__).parent.parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client.get_database(os.environ['DB_NAME'], codec_options=CODEC_OPTIONS)
+    try:
+        report = await rebuild(db, repair=repair, sales_rep_id=sales_rep_id)
+        for name, count in report.items():
+            print(f"{name}: {count}")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verify earnings rollups against raw commission calculations")
+    parser.add_argument("--repair", action="store_true", help="rewrite rollups that drifted from the raw data")
+    parser.add_argument("--rep", help="only check this sales rep")
+    args = parser.parse_args()
+    asyncio.run(_main(args.repair, args.rep))
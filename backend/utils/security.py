@@ -1,12 +1,18 @@
 from passlib.context import CryptContext
 from jose import jwt, JWTError
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import os
+import time
 from cryptography.fernet import Fernet
 import base64
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+
+# Hashes made with a different cost are flagged by needs_update() and rehashed on login
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 SECRET_KEY = os.environ.get("JWT_SECRET_KEY", "your-secret-key-change-in-production-min-32-chars-required-for-security")
 ALGORITHM = "HS256"
@@ -24,6 +30,107 @@ def get_password_hash(password: str) -> str:
     """Hash a password."""
     return pwd_context.hash(password)
 
+class PasswordPoolBusy(Exception):
+    """Raised when password work cannot be queued or finished within the pool timeout."""
+
+class PasswordPool:
+    """Bounded thread pool for bcrypt so hashing never blocks the event loop.
+
+    bcrypt releases the GIL, so a few threads hash in parallel. At most
+    `workers + max_queue` calls are admitted at once and each waits at most
+    `timeout` seconds, so a login storm sheds load instead of queueing forever.
+    A call that times out still holds its slot until its thread is done, so
+    abandoned hashes count against the bound instead of piling up behind it.
+    """
+
+    def __init__(self, workers: int = 4, max_queue: int = 64, timeout: float = 5.0):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        self.completed_total = 0
+        self.rejected_total = 0
+        self.timeouts_total = 0
+        self.rehashed_total = 0
+        self.busy_seconds_total = 0.0
+
+    async def run(self, func, *args):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers + self.max_queue)
+        if self._slots.locked():
+            self.rejected_total += 1
+            raise PasswordPoolBusy("Password pool queue is full")
+        await self._slots.acquire()
+        self.in_flight += 1
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        outcome = {"timed_out": False}
+        try:
+            work = self._executor.submit(func, *args)
+        except BaseException:
+            self._release(outcome, started)
+            raise
+        # A timed-out call keeps its slot until the bcrypt thread actually finishes
+        work.add_done_callback(lambda _: self._release_threadsafe(loop, outcome, started))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(work), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            outcome["timed_out"] = True
+            self.timeouts_total += 1
+            raise PasswordPoolBusy("Password hashing timed out")
+
+    def _release_threadsafe(self, loop, outcome: dict, started: float):
+        try:
+            loop.call_soon_threadsafe(self._release, outcome, started)
+        except RuntimeError:
+            pass  # the loop is closed; nobody is left to wait for a slot
+
+    def _release(self, outcome: dict, started: float):
+        self.in_flight -= 1
+        if not outcome["timed_out"]:
+            self.completed_total += 1
+            self.busy_seconds_total += time.monotonic() - started
+        self._slots.release()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queued": max(0, self.in_flight - self.workers),
+            "saturation": round(self.in_flight / (self.workers + self.max_queue), 4),
+            "completed_total": self.completed_total,
+            "rejected_total": self.rejected_total,
+            "timeouts_total": self.timeouts_total,
+            "rehashed_total": self.rehashed_total,
+            "avg_seconds": round(self.busy_seconds_total / self.completed_total, 4) if self.completed_total else 0.0,
+            "bcrypt_rounds": BCRYPT_ROUNDS
+        }
+
+password_pool = PasswordPool(
+    workers=int(os.environ.get("PASSWORD_POOL_WORKERS", "4")),
+    max_queue=int(os.environ.get("PASSWORD_POOL_MAX_QUEUE", "64")),
+    timeout=float(os.environ.get("PASSWORD_POOL_TIMEOUT_SECONDS", "5"))
+)
+
+async def hash_password_async(password: str) -> str:
+    """Hash a password on the password pool."""
+    return await password_pool.run(pwd_context.hash, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Verify a password on the password pool; also returns a new hash when the stored one uses an outdated cost."""
+    if not hashed_password:
+        return False, None
+    valid, new_hash = await password_pool.run(pwd_context.verify_and_update, plain_password, hashed_password)
+    if new_hash:
+        password_pool.rehashed_total += 1
+    return valid, new_hash
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """Create a JWT access token."""
     to_encode = data.copy()
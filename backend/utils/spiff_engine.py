@@ -0,0 +1,282 @@
+"""Spiff matching and crediting.
+
+Active spiffs are indexed by target product, or under ALL_PRODUCTS when a
+spiff names no products. For each product, the campaign windows are flattened
+into sorted segments, and each segment lists every spiff live during it.
+Matching a transaction is then two bisects, however many campaigns overlap.
+
+Incentives are credited as adjustments on the commission calculation and
+recorded in spiff_awards. There is at most one award per (spiff,
+transaction), so re-running a replay over the same range is harmless. On a
+split transaction the award's `credits` hold each party's share.
+
+A replayed award is stored as pending before its calculations are credited.
+Each credit records the award id on its calculation, and the award is marked
+credited once all of its credits are applied. A replay that dies in between
+is finished by the next one. Calculations already claimed by a payout are
+never credited, since that payout's total would go stale.
+replay() credits a spiff retroactively to transactions that were calculated
+before it existed.
+"""
+import asyncio
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_EVEN
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo.errors import BulkWriteError
+
+from models import SpiffAward
+from utils.change_feed import ChangeFollower
+from utils.credit_splits import party_credits
+from utils.periods import as_utc, with_utc
+from utils.rollups import apply_adjustments, rebuild as rebuild_rollups
+
+ALL_PRODUCTS = "*"
+INCENTIVE_TYPES = ("fixed", "percentage")
+FOUR_PLACES = Decimal("0.0001")
+DUPLICATE_KEY = 11000
+REPLAY_BATCH_SIZE = 1000
+
+# Calculations a replay may still credit: not paid and not claimed by a payout
+UNCLAIMED = {"status": {"$ne": "paid"}, "payout_run_id": None, "payout_id": None}
+
+# Windows include their end date, as in the active-spiff queries
+_END_INCLUSIVE = timedelta(microseconds=1)
+
+
+def incentive(spiff: Dict[str, Any], transaction: Dict[str, Any]) -> Decimal:
+    amount = Decimal(str(spiff['incentive_amount']))
+    if spiff.get('incentive_type') == "percentage":
+        # Foreign-currency transactions are credited on their base-currency amount
+        sale = transaction.get('base_amount')
+        amount = Decimal(str(sale if sale is not None else transaction['total_amount'])) * amount / 100
+    return amount.quantize(FOUR_PLACES, rounding=ROUND_HALF_EVEN)
+
+
+def in_segment(spiff: Dict[str, Any], transaction: Dict[str, Any]) -> bool:
+    segments = spiff.get('target_segments') or []
+    return not segments or transaction.get('customer_segment') in segments
+
+
+def _normalized(spiff: Dict[str, Any]) -> Dict[str, Any]:
+    return with_utc(spiff, "start_date", "end_date")
+
+
+def _window_end(spiff: Dict[str, Any]) -> datetime:
+    return spiff['end_date'] + _END_INCLUSIVE
+
+
+class _Windows:
+    """live[i] holds the spiffs running from boundaries[i] until the next boundary."""
+
+    def __init__(self, spiffs: Iterable[Dict[str, Any]]):
+        spiffs = list(spiffs)
+        points = sorted({s['start_date'] for s in spiffs} | {_window_end(s) for s in spiffs})
+        self.boundaries: List[datetime] = []
+        self.live: List[Tuple[Dict[str, Any], ...]] = []
+        for point in points:
+            active = tuple(s for s in spiffs if s['start_date'] <= point < _window_end(s))
+            if self.live and [s['id'] for s in self.live[-1]] == [s['id'] for s in active]:
+                continue
+            self.boundaries.append(point)
+            self.live.append(active)
+
+    def find(self, when: datetime) -> Tuple[Dict[str, Any], ...]:
+        i = bisect_right(self.boundaries, when) - 1
+        return self.live[i] if i >= 0 else ()
+
+
+class SpiffIndex:
+    def __init__(self, refresh_seconds: float = 60.0):
+        self.refresh_seconds = refresh_seconds
+        self._spiffs: Dict[str, Dict[str, Any]] = {}
+        self._by_product: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._windows: Dict[str, _Windows] = {}
+        self._follower: Optional[ChangeFollower] = None
+        self.matched = 0
+
+    def __len__(self) -> int:
+        return len(self._spiffs)
+
+    @staticmethod
+    def _products(spiff: Dict[str, Any]) -> List[str]:
+        return list(spiff.get('target_products') or [ALL_PRODUCTS])
+
+    def load(self, spiffs: Iterable[Dict[str, Any]]):
+        """Replace the whole index; spiffs that are not active are ignored."""
+        self._spiffs, self._by_product, self._windows = {}, {}, {}
+        for spiff in spiffs:
+            if spiff.get('status') == "active":
+                self._add(spiff)
+        for product_id in self._by_product:
+            self._rebuild(product_id)
+
+    def upsert(self, spiff: Dict[str, Any]):
+        self.remove(spiff['id'])
+        if spiff.get('status') == "active":
+            self._add(spiff)
+            for product_id in self._products(spiff):
+                self._rebuild(product_id)
+
+    def remove(self, spiff_id: str):
+        spiff = self._spiffs.pop(spiff_id, None)
+        if spiff is None:
+            return
+        for product_id in self._products(spiff):
+            self._by_product.get(product_id, {}).pop(spiff_id, None)
+            self._rebuild(product_id)
+
+    def _add(self, spiff: Dict[str, Any]):
+        spiff = _normalized(spiff)
+        self._spiffs[spiff['id']] = spiff
+        for product_id in self._products(spiff):
+            self._by_product.setdefault(product_id, {})[spiff['id']] = spiff
+
+    def _rebuild(self, product_id: str):
+        spiffs = self._by_product.get(product_id)
+        if spiffs:
+            self._windows[product_id] = _Windows(spiffs.values())
+        else:
+            self._by_product.pop(product_id, None)
+            self._windows.pop(product_id, None)
+
+    def match(self, transaction: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Every active spiff a transaction qualifies for."""
+        matched = []
+        for product_id in (transaction.get('product_id'), ALL_PRODUCTS):
+            windows = self._windows.get(product_id)
+            if windows is not None:
+                matched.extend(s for s in windows.find(as_utc(transaction['transaction_date'])) if in_segment(s, transaction))
+        self.matched += len(matched)
+        return matched
+
+    def awards(self, transactions: List[Dict[str, Any]]) -> List[List[Tuple[str, Decimal]]]:
+        """(spiff id, incentive) pairs earned by each transaction."""
+        return [[(s['id'], incentive(s, t)) for s in self.match(t)] for t in transactions]
+
+    async def start(self, collection):
+        """Load the active spiffs and keep following changes made by other workers."""
+        await self._reload(collection)
+        if self._follower is None:
+            self._follower = ChangeFollower("Spiff", self.upsert, lambda: self._reload(collection), self.refresh_seconds)
+            self._follower.start(collection)
+
+    async def stop(self):
+        if self._follower is not None:
+            await self._follower.stop()
+            self._follower = None
+
+    async def _reload(self, collection):
+        self.load(await collection.find({"status": "active"}, {"_id": 0}).to_list(None))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active_spiffs": len(self._spiffs),
+            "products": len(self._windows),
+            "segments": sum(len(w.boundaries) for w in self._windows.values()),
+            "matched": self.matched,
+            "change_stream": self._follower is not None and self._follower.watching
+        }
+
+
+async def insert_awards(collection, awards: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Insert awards, skipping any (spiff, transaction) already credited; returns those inserted."""
+    if not awards:
+        return []
+    try:
+        await collection.insert_many(awards, ordered=False)
+        return awards
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        if any(error.get('code') != DUPLICATE_KEY for error in errors):
+            raise
+        duplicates = {error['index'] for error in errors}
+        return [award for i, award in enumerate(awards) if i not in duplicates]
+
+
+async def replay(db, spiff: Dict[str, Any], start: Optional[datetime] = None, end: Optional[datetime] = None,
+                 batch_size: int = REPLAY_BATCH_SIZE) -> Dict[str, Any]:
+    """Credit a spiff to already-calculated transactions in [start, end] within its window."""
+    spiff = _normalized(spiff)
+    start = max(as_utc(start) or spiff['start_date'], spiff['start_date'])
+    end = min(as_utc(end) or spiff['end_date'], spiff['end_date'])
+    query: Dict[str, Any] = {"transaction_date": {"$gte": start, "$lte": end}, "status": "processed"}
+    if spiff.get('target_products'):
+        query["product_id"] = {"$in": spiff['target_products']}
+    if spiff.get('target_segments'):
+        query["customer_segment"] = {"$in": spiff['target_segments']}
+
+    result = {"transactions": 0, "awards": 0, "skipped_claimed": 0, "amount": Decimal("0"), "sales_rep_ids": set()}
+    projection = {"_id": 0, "id": 1, "product_id": 1, "customer_segment": 1, "total_amount": 1, "base_amount": 1, "transaction_date": 1}
+    batch: List[Dict[str, Any]] = []
+    async for transaction in db.transactions.find(query, projection).batch_size(batch_size):
+        batch.append(transaction)
+        if len(batch) >= batch_size:
+            await _credit(db, spiff, batch, result)
+            batch = []
+    if batch:
+        await _credit(db, spiff, batch, result)
+    return result
+
+
+async def _credit(db, spiff: Dict[str, Any], transactions: List[Dict[str, Any]], result: Dict[str, Any]):
+    result['transactions'] += len(transactions)
+    transaction_ids = [t['id'] for t in transactions]
+    calculations = await db.commission_calculations.find(
+        {"transaction_id": {"$in": transaction_ids}},
+        {"_id": 0, "id": 1, "transaction_id": 1, "sales_rep_id": 1, "status": 1, "credit_percent": 1, "payout_run_id": 1, "payout_id": 1}
+    ).to_list(None)
+    # Split transactions have one calculation per credited party
+    by_transaction: Dict[str, List[Dict[str, Any]]] = {}
+    for calculation in calculations:
+        by_transaction.setdefault(calculation['transaction_id'], []).append(calculation)
+
+    awards = []
+    for transaction in transactions:
+        parties = by_transaction.get(transaction['id'])
+        if not parties:
+            continue
+        if any(c['status'] == "paid" or c.get('payout_run_id') or c.get('payout_id') for c in parties):
+            # Claimed by a payout already; crediting it now would make the payout's total stale
+            result['skipped_claimed'] += 1
+            continue
+        amount = incentive(spiff, transaction)
+        awards.append(SpiffAward(
+            spiff_id=spiff['id'],
+            transaction_id=transaction['id'],
+            amount=amount,
+            credits=party_credits(amount, parties),
+            status="pending",
+            retroactive=True
+        ).model_dump())
+
+    inserted = {a['id'] for a in await insert_awards(db.spiff_awards, awards)}
+    # Includes awards an interrupted run stored but never finished crediting
+    pending = await db.spiff_awards.find(
+        {"spiff_id": spiff['id'], "transaction_id": {"$in": transaction_ids}, "status": "pending"}, {"_id": 0}
+    ).to_list(None)
+    if not pending:
+        return
+
+    async def apply(award, credit):
+        # The award id on the calculation makes the $inc happen once, however often this is retried
+        return await db.commission_calculations.find_one_and_update(
+            {"id": credit['calculation_id'], "spiff_award_ids": {"$ne": award['id']}, **UNCLAIMED},
+            {"$inc": {"adjustments": credit['amount'], "final_amount": credit['amount']}, "$push": {"spiff_award_ids": award['id']}},
+            {"_id": 0, "sales_rep_id": 1, "plan_id": 1, "calculation_date": 1, "status": 1}
+        )
+
+    pairs = [(award, credit) for award in pending for credit in award['credits']]
+    updated = await asyncio.gather(*(apply(award, credit) for award, credit in pairs))
+    credits = [(calculation, credit['amount']) for (_, credit), calculation in zip(pairs, updated) if calculation is not None]
+    await apply_adjustments(db.earnings_rollups, [{**c, "final_amount": share} for c, share in credits])
+    # A resumed award's calculation may have been credited before its rollup was; recount those reps
+    resumed = {credit['sales_rep_id'] for (award, credit), calculation in zip(pairs, updated)
+               if calculation is None and award['id'] not in inserted}
+    for rep_id in sorted(resumed):
+        await rebuild_rollups(db, repair=True, sales_rep_id=rep_id)
+    await db.spiff_awards.update_many({"id": {"$in": [a['id'] for a in pending]}}, {"$set": {"status": "credited"}})
+    result['awards'] += len(pending)
+    result['amount'] += sum((share for _, share in credits), Decimal("0"))
+    result['sales_rep_ids'].update(resumed, (c['sales_rep_id'] for c, _ in credits))
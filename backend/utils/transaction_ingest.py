@@ -0,0 +1,129 @@
+"""Parsing and validation for batched transaction ingest.
+
+Request bodies are NDJSON (one TransactionCreate object per line) or CSV with
+a header row. Both are parsed incrementally from the body stream, so a batch
+of hundreds of thousands of lines is validated and written in fixed-size
+chunks without holding the whole payload in memory.
+
+CSV goes through one csv.reader, which is handed lines only once they close
+every quoted field. A quoted value may therefore span lines, and errors are
+reported against the line its record starts on.
+"""
+import csv
+import json
+from collections import deque
+from decimal import Decimal
+from typing import Any, AsyncIterator, Dict, List, Tuple
+
+from pydantic import ValidationError
+
+from models import Transaction, TransactionCreate
+
+CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+FOUR_PLACES = Decimal("0.0001")
+
+Record = Tuple[int, Any]
+
+
+class BodyEncodingError(ValueError):
+    """Raised when the request body is not UTF-8; lines before it have already been yielded."""
+
+
+def _decode(raw: bytes, number: int) -> str:
+    try:
+        return raw.decode("utf-8-sig" if number == 1 else "utf-8").rstrip("\r")
+    except UnicodeDecodeError as e:
+        raise BodyEncodingError(f"line {number} is not valid UTF-8: {e.reason}") from e
+
+
+async def _lines(body: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, str]]:
+    buffer = b""
+    number = 0
+    async for data in body:
+        buffer += data
+        *complete, buffer = buffer.split(b"\n")
+        for raw in complete:
+            number += 1
+            yield number, _decode(raw, number)
+    if buffer:
+        number += 1
+        yield number, _decode(buffer, number)
+
+
+class _Feed:
+    """Line source for a csv.reader that is only advanced once a whole record is buffered."""
+
+    def __init__(self):
+        self.lines = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+
+async def iter_records(body: AsyncIterator[bytes], fmt: str) -> AsyncIterator[Record]:
+    """Yield (line number, record) pairs; malformed lines are yielded as the exception that describes them."""
+    header = None
+    feed = _Feed()
+    reader = csv.reader(feed)
+    start, quotes = 0, 0
+    async for number, line in _lines(body):
+        if fmt == "csv":
+            if not feed.lines:
+                if not line.strip():
+                    continue
+                start, quotes = number, 0
+            feed.lines.append(line + "\n")
+            quotes += line.count('"')
+            if quotes % 2:
+                # Inside a quoted field that continues on the next line
+                continue
+            try:
+                values = next(reader)
+            except csv.Error as e:
+                yield start, ValueError(f"invalid CSV: {e}")
+                continue
+            if header is None:
+                header = [column.strip() for column in values]
+                continue
+            if len(values) != len(header):
+                yield start, ValueError(f"expected {len(header)} columns, got {len(values)}")
+                continue
+            yield start, dict(zip(header, values))
+        elif line.strip():
+            try:
+                yield number, json.loads(line)
+            except ValueError as e:
+                yield number, ValueError(f"invalid JSON: {e}")
+    if feed.lines:
+        yield start, ValueError("unterminated quoted field")
+
+
+def _error_message(e: Exception) -> str:
+    if isinstance(e, ValidationError):
+        return "; ".join(f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors())
+    return str(e)
+
+
+def build_transactions(records: List[Record]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Validate a chunk of records into Transaction documents and per-line errors."""
+    valid: List[TransactionCreate] = []
+    errors = []
+    for number, record in records:
+        if isinstance(record, Exception):
+            errors.append({"line": number, "error": str(record)})
+            continue
+        try:
+            valid.append(TransactionCreate.model_validate(record))
+        except (ValidationError, TypeError) as e:
+            errors.append({"line": number, "error": _error_message(e)})
+
+    # Same rounding as validate_financial_precision, applied to the whole chunk at once
+    totals = [(t.unit_price * t.quantity).quantize(FOUR_PLACES) for t in valid]
+    docs = [Transaction(**t.model_dump(), total_amount=total).model_dump() for t, total in zip(valid, totals)]
+    return docs, errors
@@ -0,0 +1,83 @@
+"""In-process cache of authenticated users.
+
+get_current_user runs on every authenticated request; caching the resolved
+User by id with a TTL and an LRU size bound saves a users lookup and a model
+construction per request. Writes in this process invalidate their entry
+directly. Writes made by other workers reach every process through a change
+stream on the users collection. Where change streams are unavailable
+(standalone mongod) entries simply expire after the TTL.
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from utils.change_feed import ChangeFollower
+
+
+class UserCache:
+    def __init__(self, maxsize: int = 10_000, ttl_seconds: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._follower: Optional[ChangeFollower] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    async def get(self, user_id: str, loader: Callable[[str], Awaitable[Any]]) -> Any:
+        """Return the cached user or load it; a None result is not cached."""
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            expires, user = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return user
+            del self._entries[user_id]
+
+        self.misses += 1
+        user = await loader(user_id)
+        if user is not None:
+            self._entries[user_id] = (time.monotonic() + self.ttl_seconds, user)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return user
+
+    def invalidate(self, user_id: Optional[str]):
+        if user_id and self._entries.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    def start(self, collection):
+        """Follow the users change stream so writes from other workers evict entries here."""
+        if self._follower is None:
+            # Without change streams entries simply expire after the TTL
+            self._follower = ChangeFollower("User cache", lambda user: self.invalidate(user['id']), self.clear, pipeline=[
+                {"$match": {"operationType": {"$in": ["update", "replace", "delete", "invalidate"]}}}
+            ])
+            self._follower.start(collection)
+
+    async def stop(self):
+        if self._follower is not None:
+            await self._follower.stop()
+            self._follower = None
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "change_stream": self._follower is not None and self._follower.watching
+        }
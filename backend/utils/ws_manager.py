@@ -0,0 +1,186 @@
+"""WebSocket connection manager with topics and per-connection send queues.
+
+A user may hold any number of sockets (one per tab). Each socket is
+subscribed to the `all` topic and to its user's `user:<id>` topic, and can
+subscribe to more topics itself. A published message is serialized once and
+offered to every subscriber's bounded outbound queue, which that
+connection's own writer task drains. A subscriber whose queue is full, or
+whose send does not finish within `send_timeout`, is disconnected, so one
+slow client never delays delivery to the others.
+
+send_personal_message and broadcast go through the pub/sub backend, so a
+message produced on one worker reaches sockets held by every worker;
+publish() is the local delivery step each worker runs for it. Control
+topics that no socket subscribes to are handled by listen() callbacks, which
+publish() hands the message text to on every worker.
+"""
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from fastapi import WebSocket
+
+from utils.pagination import json_default
+from utils.pubsub import MemoryPubSub, PubSub
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_TOPIC = "all"
+TRY_AGAIN_LATER = 1013
+
+
+def user_topic(user_id: str) -> str:
+    return f"user:{user_id}"
+
+
+class Connection:
+    def __init__(self, websocket: WebSocket, user_id: str, max_queue: int):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.topics: Set[str] = set()
+        self.writer: Optional[asyncio.Task] = None
+        self.closed = False
+        self.sent = 0
+
+
+class ConnectionManager:
+    def __init__(self, max_queue: int = 256, send_timeout: float = 5.0, pubsub: Optional[PubSub] = None):
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.pubsub = pubsub or MemoryPubSub()
+        self.topics: Dict[str, Set[Connection]] = defaultdict(set)
+        self.listeners: Dict[str, List[Callable[[str], None]]] = defaultdict(list)
+        self.published_total = 0
+        self.delivered_total = 0
+        self.dropped_total = 0
+
+    async def start(self):
+        await self.pubsub.start(self.publish)
+
+    async def stop(self):
+        await self.pubsub.stop()
+
+    async def connect(self, websocket: WebSocket, user_id: str) -> Connection:
+        await websocket.accept()
+        connection = Connection(websocket, user_id, self.max_queue)
+        self.subscribe(connection, BROADCAST_TOPIC)
+        self.subscribe(connection, user_topic(user_id))
+        connection.writer = asyncio.create_task(self._write(connection))
+        return connection
+
+    def disconnect(self, connection: Connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        for topic in list(connection.topics):
+            self.unsubscribe(connection, topic)
+        if connection.writer and connection.writer is not asyncio.current_task():
+            connection.writer.cancel()
+
+    def subscribe(self, connection: Connection, topic: str):
+        self.topics[topic].add(connection)
+        connection.topics.add(topic)
+
+    def unsubscribe(self, connection: Connection, topic: str):
+        subscribers = self.topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(connection)
+            if not subscribers:
+                del self.topics[topic]
+        connection.topics.discard(topic)
+
+    def listen(self, topic: str, callback: Callable[[str], None]):
+        """Call `callback` with the text of every message published to `topic` on this worker."""
+        self.listeners[topic].append(callback)
+
+    def has_subscribers(self, topic: str) -> bool:
+        return bool(self.topics.get(topic))
+
+    def publish(self, topic: str, message: Any) -> int:
+        """Queue a message for every subscriber of `topic` without waiting on any socket."""
+        listeners = self.listeners.get(topic)
+        subscribers = self.topics.get(topic)
+        if not listeners and not subscribers:
+            return 0
+        text = message if isinstance(message, str) else json.dumps(message, default=json_default)
+        for callback in listeners or ():
+            try:
+                callback(text)
+            except Exception:
+                logger.exception("Listener for %s failed", topic)
+        if not subscribers:
+            return 0
+        self.published_total += 1
+        delivered = 0
+        for connection in list(subscribers):
+            if self.offer(connection, text):
+                delivered += 1
+        return delivered
+
+    def offer(self, connection: Connection, text: str) -> bool:
+        try:
+            connection.queue.put_nowait(text)
+            return True
+        except asyncio.QueueFull:
+            self._drop(connection, "outbound queue full")
+            return False
+
+    async def emit(self, topic: str, message: Any):
+        """Publish a message to `topic` on every worker."""
+        text = message if isinstance(message, str) else json.dumps(message, default=json_default)
+        await self.pubsub.publish(topic, text)
+
+    async def send_personal_message(self, message: dict, user_id: str):
+        await self.emit(user_topic(user_id), message)
+
+    async def broadcast(self, message: dict):
+        await self.emit(BROADCAST_TOPIC, message)
+
+    async def _write(self, connection: Connection):
+        try:
+            while True:
+                text = await connection.queue.get()
+                await asyncio.wait_for(connection.websocket.send_text(text), timeout=self.send_timeout)
+                connection.sent += 1
+                self.delivered_total += 1
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            self._drop(connection, "send timed out")
+        except Exception:
+            # The socket went away; the receive loop will notice too
+            self.disconnect(connection)
+
+    def _drop(self, connection: Connection, reason: str):
+        if connection.closed:
+            return
+        self.dropped_total += 1
+        logger.warning("Dropping slow WebSocket consumer for user %s: %s", connection.user_id, reason)
+        self.disconnect(connection)
+        asyncio.create_task(self._close(connection))
+
+    @staticmethod
+    async def _close(connection: Connection):
+        try:
+            await connection.websocket.close(code=TRY_AGAIN_LATER)
+        except Exception:
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        connections = {c for subscribers in self.topics.values() for c in subscribers}
+        depths = [c.queue.qsize() for c in connections]
+        return {
+            "connections": len(connections),
+            "users": len({c.user_id for c in connections}),
+            "topics": len(self.topics),
+            "queue_depth_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "max_queue": self.max_queue,
+            "published_total": self.published_total,
+            "delivered_total": self.delivered_total,
+            "dropped_total": self.dropped_total,
+            "pubsub": self.pubsub.stats()
+        }
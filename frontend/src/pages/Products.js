@@ -59,8 +59,11 @@ export const Products = () => {
       try {
         const result = await bulkUploadProducts(file);
         toast.success(`${result.products_created} products uploaded`);
-        if (result.errors.length > 0) {
-          toast.warning(`${result.errors.length} errors occurred`);
+        if (result.products_updated > 0) {
+          toast.success(`${result.products_updated} existing products updated`);
+        }
+        if (result.rejected > 0) {
+          toast.warning(`${result.rejected} rows rejected`);
         }
         fetchProducts();
       } catch (error) {
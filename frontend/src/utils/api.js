@@ -25,7 +25,17 @@ export const bulkUploadProducts = async (file) => {
   const response = await axios.post(`${API}/products/bulk-upload`, formData, {
     headers: { ...getAuthHeaders(), 'Content-Type': 'multipart/form-data' }
   });
-  return response.data;
+  // The import runs as a background job; poll until it finishes
+  let job = response.data;
+  while (!['completed', 'failed'].includes(job.status)) {
+    await new Promise((resolve) => setTimeout(resolve, 1000));
+    const poll = await axios.get(`${API}/products/bulk-upload/${response.data.job_id}`, { headers: getAuthHeaders() });
+    job = poll.data;
+  }
+  if (job.status === 'failed') {
+    throw new Error(job.failure || 'Product import failed');
+  }
+  return job;
 };
 
 // Transactions
@@ -0,0 +1,14 @@
+from utils.audit_sink import diff_states
+
+
+def test_diff_states_reports_changed_fields():
+    before = {"_id": 1, "status": "draft", "amount": 10, "name": "a"}
+    after = {"_id": 2, "status": "active", "amount": 10, "owner": "u1"}
+    assert diff_states(before, after) == {
+        "status": {"from": "draft", "to": "active"},
+        "owner": {"from": None, "to": "u1"},
+    }
+
+
+def test_diff_states_treats_after_as_partial_update():
+    assert diff_states({"status": "draft", "name": "a"}, {"status": "draft"}) == {}
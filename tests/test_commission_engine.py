@@ -0,0 +1,76 @@
+from decimal import Decimal
+
+import pytest
+
+from utils.commission_engine import PlanCompilationError, compile_plan, from_fixed, order_rules, to_fixed
+
+
+def evaluate(rules, amounts, product_ids=None):
+    plan = compile_plan({"id": "p1", "rules": rules})
+    product_ids = product_ids or ["prod"] * len(amounts)
+    return plan.evaluate(amounts, product_ids, [1] * len(amounts), amounts)
+
+
+def test_fixed_point_round_trip():
+    assert to_fixed("12.34565") == 123456
+    assert from_fixed(123456) == Decimal("12.3456")
+
+
+def test_plan_without_rules_pays_five_percent():
+    assert evaluate([], [Decimal("100"), Decimal("0.01")]) == [Decimal("5.0000"), Decimal("0.0005")]
+
+
+def test_percentage_rounds_half_even():
+    rules = [{"id": "r", "rule_type": "percentage", "action": {"commission_rate": "10"}}]
+    # 0.00005 and 0.00015 both sit exactly between two 4-place values
+    assert evaluate(rules, [Decimal("0.0005"), Decimal("0.0015")]) == [Decimal("0.0000"), Decimal("0.0002")]
+
+
+def test_tiered_rates_apply_per_band():
+    rules = [{"id": "r", "rule_type": "tiered", "action": {"tiers": [
+        {"min": "0", "max": "1000", "rate": "5"},
+        {"min": "1000", "rate": "10"},
+    ]}}]
+    assert evaluate(rules, [Decimal("500"), Decimal("1500")]) == [Decimal("25.0000"), Decimal("100.0000")]
+
+
+def test_conditions_restrict_rules():
+    rules = [
+        {"id": "base", "rule_type": "percentage", "action": {"commission_rate": "5"}, "priority": 0},
+        {"id": "big", "rule_type": "flat", "condition": {"min_amount": "1000"}, "action": {"amount": "50"}, "priority": 1},
+        {"id": "promo", "rule_type": "multiplier", "condition": {"product_ids": ["promo"]}, "action": {"multiplier": "2"}, "priority": 2},
+    ]
+    result = evaluate(rules, [Decimal("100"), Decimal("1000"), Decimal("100")], ["prod", "prod", "promo"])
+    assert result == [Decimal("5.0000"), Decimal("100.0000"), Decimal("10.0000")]
+
+
+def test_formula_sees_earlier_commission():
+    rules = [
+        {"id": "base", "rule_type": "percentage", "action": {"commission_rate": "5"}},
+        {"id": "cap", "rule_type": "formula", "depends_on": ["base"], "action": {"formula": "min(commission, 20)"}},
+    ]
+    assert evaluate(rules, [Decimal("100"), Decimal("1000")]) == [Decimal("5.0000"), Decimal("20.0000")]
+
+
+def test_order_rules_follows_dependencies_then_priority():
+    rules = [
+        {"id": "a", "priority": 5, "depends_on": ["b"]},
+        {"id": "b", "priority": 9},
+        {"id": "c", "priority": 1},
+    ]
+    assert [r['id'] for r in order_rules(rules)] == ["c", "b", "a"]
+
+
+@pytest.mark.parametrize("rules, message", [
+    ([{"id": "a", "depends_on": ["b"]}, {"id": "b", "depends_on": ["a"]}], "Circular"),
+    ([{"id": "a", "depends_on": ["missing"]}], "unknown rule"),
+    ([{"id": "a"}, {"id": "a"}], "Duplicate"),
+])
+def test_order_rules_rejects_bad_graphs(rules, message):
+    with pytest.raises(PlanCompilationError, match=message):
+        order_rules(rules)
+
+
+def test_unknown_rule_type_is_rejected():
+    with pytest.raises(PlanCompilationError, match="unknown type"):
+        compile_plan({"id": "p1", "rules": [{"id": "r", "rule_type": "lottery"}]})
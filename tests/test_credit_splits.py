@@ -0,0 +1,48 @@
+from decimal import Decimal
+
+from utils.credit_splits import allocate, party_credits, split_calculation
+
+
+def test_allocate_shares_sum_to_amount():
+    shares = allocate(Decimal("100"), [Decimal("33.3333"), Decimal("33.3333"), Decimal("33.3334")])
+    assert sum(shares) == Decimal("100")
+    assert shares == [Decimal("33.3333"), Decimal("33.3333"), Decimal("33.3334")]
+
+
+def test_allocate_gives_leftover_units_to_largest_remainder_then_earliest_party():
+    assert allocate(Decimal("0.0001"), [Decimal("50"), Decimal("50")]) == [Decimal("0.0001"), Decimal("0")]
+    assert allocate(Decimal("0.0002"), [Decimal("30"), Decimal("30"), Decimal("40")]) == [Decimal("0.0001"), Decimal("0"), Decimal("0.0001")]
+
+
+def test_allocate_negative_amounts_mirror_positive_ones():
+    positive = allocate(Decimal("10.0001"), [Decimal("50"), Decimal("50")])
+    assert allocate(Decimal("-10.0001"), [Decimal("50"), Decimal("50")]) == [-s for s in positive]
+
+
+def test_split_calculation_divides_every_money_field():
+    calculation = {
+        "id": "c1", "sales_rep_id": "r1", "base_amount": Decimal("100"), "commission_amount": Decimal("5"),
+        "adjustments": Decimal("1"), "holdback_amount": Decimal("0"), "final_amount": Decimal("6"),
+    }
+    assignment = {"id": "a1", "assignments": [
+        {"user_id": "r1", "credit_percent": 60},
+        {"sales_rep_id": "r2", "credit_percent": 40},
+        {"credit_percent": 0},
+    ]}
+    docs = split_calculation(calculation, assignment)
+    assert [d['sales_rep_id'] for d in docs] == ["r1", "r2"]
+    assert [d['final_amount'] for d in docs] == [Decimal("3.6000"), Decimal("2.4000")]
+    assert sum(d['commission_amount'] for d in docs) == Decimal("5")
+    assert len({d['id'] for d in docs} | {"c1"}) == 3
+    assert all(d['credit_assignment_id'] == "a1" for d in docs)
+
+
+def test_party_credits_follow_calculation_percents():
+    calculations = [
+        {"id": "c1", "sales_rep_id": "r1", "credit_percent": Decimal("50")},
+        {"id": "c2", "sales_rep_id": "r2", "credit_percent": Decimal("50")},
+    ]
+    assert party_credits(Decimal("10.0001"), calculations) == [
+        {"calculation_id": "c1", "sales_rep_id": "r1", "amount": Decimal("5.0001")},
+        {"calculation_id": "c2", "sales_rep_id": "r2", "amount": Decimal("5.0000")},
+    ]
@@ -0,0 +1,31 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from utils.pagination import decode_cursor, encode_cursor, keyset_filter
+
+
+def test_cursor_round_trips_datetimes_and_plain_values():
+    created = datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc)
+    assert decode_cursor(encode_cursor({"id": "x1", "created_at": created})) == (created, "x1")
+    assert decode_cursor(encode_cursor({"id": 7, "name": "b"}, field="name")) == ("b", "7")
+
+
+def test_cursor_is_url_safe_without_padding():
+    cursor = encode_cursor({"id": "?" * 10, "created_at": "~" * 11})
+    assert "=" not in cursor and "+" not in cursor and "/" not in cursor
+
+
+@pytest.mark.parametrize("cursor", ["!!!", "bm90IGpzb24", encode_cursor({"id": "x", "created_at": 1})[:-4]])
+def test_malformed_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        decode_cursor(cursor)
+
+
+def test_keyset_filter_continues_after_cursor():
+    created = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    cursor = encode_cursor({"id": "x1", "created_at": created})
+    after = {"$or": [{"created_at": {"$lt": created}}, {"created_at": created, "id": {"$lt": "x1"}}]}
+    assert keyset_filter({}, cursor) == after
+    assert keyset_filter({"status": "new"}, cursor) == {"$and": [{"status": "new"}, after]}
+    assert keyset_filter({"status": "new"}, None) == {"status": "new"}
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from utils.transaction_ingest import BodyEncodingError, build_transactions, iter_records
+
+
+def records(body: bytes, fmt: str = "csv", chunk: int = 7):
+    async def stream():
+        for i in range(0, len(body), chunk):
+            yield body[i:i + chunk]
+
+    async def collect():
+        return [(number, record) async for number, record in iter_records(stream(), fmt)]
+
+    return asyncio.run(collect())
+
+
+def test_csv_rows_become_dicts_keyed_by_header():
+    parsed = records(b"\xef\xbb\xbfsales_rep_id, product_id\r\nr1,p1\r\n\r\nr2,p2")
+    assert parsed == [(2, {"sales_rep_id": "r1", "product_id": "p1"}), (4, {"sales_rep_id": "r2", "product_id": "p2"})]
+
+
+def test_csv_quoted_field_spans_lines_and_reports_its_first_line():
+    parsed = records(b'id,note\n1,"two\nlines"\n2,plain\n')
+    assert parsed == [(2, {"id": "1", "note": "two\nlines"}), (4, {"id": "2", "note": "plain"})]
+
+
+def test_csv_errors_are_yielded_per_line():
+    parsed = records(b'a,b\n1\n2,"open\n')
+    assert parsed[0][0] == 2 and "expected 2 columns, got 1" in str(parsed[0][1])
+    assert parsed[1][0] == 3 and "unterminated quoted field" in str(parsed[1][1])
+
+
+def test_ndjson_reports_invalid_lines():
+    parsed = records(b'{"a": 1}\nnot json\n\n{"a": 2}\n', fmt="ndjson")
+    assert parsed[0] == (1, {"a": 1})
+    assert parsed[1][0] == 2 and isinstance(parsed[1][1], ValueError)
+    assert parsed[2] == (4, {"a": 2})
+
+
+def test_invalid_utf8_raises_body_encoding_error():
+    with pytest.raises(BodyEncodingError, match="line 2"):
+        records(b"a,b\n\xff,1\n")
+
+
+def test_build_transactions_validates_and_totals():
+    valid = {"sales_rep_id": "r1", "product_id": "p1", "quantity": "3", "unit_price": "19.99999",
+             "transaction_date": "2024-01-01T00:00:00Z"}
+    docs, errors = build_transactions([(2, valid), (3, {"sales_rep_id": "r1"}), (4, ValueError("bad row"))])
+    assert len(docs) == 1 and str(docs[0]['total_amount']) == "60.0000"
+    assert [e['line'] for e in errors] == [3, 4]
+    assert errors[1]['error'] == "bad row"